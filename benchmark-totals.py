@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+''' Compare tile total aggregation with per-addition rounding against full precision.
+
+Builds synthetic tiles of precincts with simulated votes and random district
+overlap fractions. Times the old approach, which rounded every product and
+every addition of every field, against planscore.tiles and planscore.observe
+aggregation, which sum at full precision and round in three stages. Reports
+the largest difference of each from exactly summed, once-rounded totals.
+'''
+import argparse, collections, time
+import numpy
+from planscore import tiles, observe, score, constants, data
+
+def make_precincts(rng, precinct_count):
+    ''' Return list of synthetic prepared precincts without geometries.
+    '''
+    precincts = []
+
+    for _ in range(precinct_count):
+        properties = {'Voters': rng.uniform(0, 2000), 'Red Votes': rng.uniform(0, 1000),
+            'Blue Votes': rng.uniform(0, 1000), 'Population': rng.uniform(0, 4000)}
+        simulations = {name: rng.uniform(0, 1000, len(fields))
+            for (name, fields) in score.SIMULATION_FIELDS.items()}
+        precincts.append(dict(properties=properties, simulations=simulations))
+
+    return precincts
+
+def get_fields(precinct):
+    ''' Return dictionary of every field value in a precinct, as old tiles stored them.
+    '''
+    fields = dict(precinct['properties'])
+
+    for (name, field_names) in score.SIMULATION_FIELDS.items():
+        fields.update(zip(field_names, precinct['simulations'][name].tolist()))
+
+    return fields
+
+def aggregate_rounded(tile_fields, tile_fractions):
+    ''' Return district totals summed the old way, rounding on every operation.
+    '''
+    districts = collections.defaultdict(lambda: collections.defaultdict(int))
+
+    for (fields, fractions) in zip(tile_fields, tile_fractions):
+        for (district_index, row) in enumerate(fractions):
+            tile_totals = collections.defaultdict(int)
+
+            # Formerly tiles.score_precinct() and tiles.score_district()
+            for (precinct_fields, fraction) in zip(fields, row):
+                for (name, value) in precinct_fields.items():
+                    precinct_value = round(fraction * value, constants.ROUND_COUNT)
+                    tile_totals[name] = round(precinct_value + tile_totals[name], constants.ROUND_COUNT)
+
+            # Formerly observe.accumulate_district_totals()
+            for (name, value) in tile_totals.items():
+                districts[district_index][name] = round(districts[district_index][name] + value, constants.ROUND_COUNT)
+
+    return [districts[index] for index in sorted(districts)]
+
+def aggregate_current(tile_precincts, tile_fractions, upload):
+    ''' Return district totals summed like planscore.tiles and planscore.observe.
+    '''
+    partial_totals = {}
+
+    for (precincts, fractions) in zip(tile_precincts, tile_fractions):
+        columns, values = tiles.get_precinct_attributes(precincts)
+        tile_totals = {data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index):
+            tiles.unpack_attributes(columns, row.dot(values)) for (index, row) in enumerate(fractions)}
+        tiles.add_batch_totals(partial_totals, tiles.round_tile_totals(tile_totals))
+
+    districts = observe.start_district_totals(upload)
+    observe.add_tile_totals(districts, tiles.round_tile_totals(partial_totals), upload)
+
+    return observe.finish_district_totals(districts)
+
+def aggregate_exact(tile_precincts, tile_fractions):
+    ''' Return district × field array of exact totals, in get_precinct_attributes() order.
+    '''
+    sums = None
+
+    for (precincts, fractions) in zip(tile_precincts, tile_fractions):
+        columns, values = tiles.get_precinct_attributes(precincts)
+        tile_sums = fractions.dot(values)
+        sums = tile_sums if sums is None else sums + tile_sums
+
+    return columns, sums
+
+def compare(columns, exact_sums, district_totals, get_values):
+    ''' Return largest difference from exact totals rounded once for publishing.
+    '''
+    largest = 0
+
+    for (row, totals) in zip(exact_sums, district_totals):
+        for (name, column) in columns.items():
+            expected = numpy.round(row[column], constants.ROUND_COUNT)
+            actual = numpy.array(get_values(totals, name), dtype=float)
+            largest = max(largest, float(numpy.abs(numpy.round(actual, constants.ROUND_COUNT) - expected).max()))
+
+    return largest
+
+parser = argparse.ArgumentParser(description='Benchmark aggregation of tile totals')
+
+parser.add_argument('--tiles', type=int, default=4, help='Number of tiles. Default 4.')
+parser.add_argument('--precincts', type=int, default=50, help='Number of precincts per tile. Default 50.')
+parser.add_argument('--districts', type=int, default=4, help='Number of districts per tile. Default 4.')
+parser.add_argument('--seed', type=int, default=0, help='Random seed. Default 0.')
+
+def main():
+    args = parser.parse_args()
+    rng = numpy.random.RandomState(args.seed)
+    upload = data.Upload('benchmark', None, districts=[None] * args.districts)
+
+    tile_precincts = [make_precincts(rng, args.precincts) for _ in range(args.tiles)]
+    tile_fractions = [rng.uniform(0, 1, (args.districts, args.precincts)) for _ in range(args.tiles)]
+    tile_fields = [[get_fields(precinct) for precinct in precincts] for precincts in tile_precincts]
+    columns, exact_sums = aggregate_exact(tile_precincts, tile_fractions)
+
+    start = time.process_time()
+    rounded_districts = aggregate_rounded(tile_fields, tile_fractions)
+    rounded_seconds = time.process_time() - start
+
+    start = time.process_time()
+    current_districts = aggregate_current(tile_precincts, tile_fractions, upload)
+    current_seconds = time.process_time() - start
+
+    rounded_error = compare(columns, exact_sums, rounded_districts, lambda totals, name:
+        [totals[field] for field in score.SIMULATION_FIELDS[name]]
+        if (name in score.SIMULATION_FIELDS) else totals[name])
+
+    current_error = compare(columns, exact_sums, [district['totals'] for district in current_districts],
+        lambda totals, name: totals[name])
+
+    print('{} tiles × {} precincts × {} districts, {} fields per precinct'.format(
+        args.tiles, args.precincts, args.districts, len(tile_fields[0][0])))
+    print('Per-addition rounding: {:.3f} CPU seconds, largest published error {:.2f}'.format(
+        rounded_seconds, rounded_error))
+    print('Full precision:        {:.3f} CPU seconds, largest published error {:.2f}'.format(
+        current_seconds, current_error))
+
+if __name__ == '__main__':
+    exit(main())
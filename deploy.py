@@ -46,6 +46,18 @@ def publish_function(lam, name, path, env, role):
     
     print('      done in {:.1f} seconds'.format(time.time() - start_time), file=sys.stderr)
 
+def map_watch_queue(lam, name, queue_arn):
+    ''' Deliver delayed straggler checks from the watch queue to the observer.
+    '''
+    if name != 'PlanScore-ObserveTiles':
+        return
+    
+    mappings = lam.list_event_source_mappings(EventSourceArn=queue_arn, FunctionName=name)
+    
+    if not mappings['EventSourceMappings']:
+        print('    * create event source mapping', name, file=sys.stderr)
+        lam.create_event_source_mapping(EventSourceArn=queue_arn, FunctionName=name, BatchSize=1)
+
 parser = argparse.ArgumentParser(description='Update Lambda function.')
 parser.add_argument('path', help='Function code path')
 parser.add_argument('name', help='Function name')
@@ -53,8 +65,15 @@ parser.add_argument('name', help='Function name')
 if __name__ == '__main__':
     args = parser.parse_args()
     env = {k: os.environ[k]
-        for k in ('PLANSCORE_SECRET', 'WEBSITE_BASE', 'AWS')
+        for k in ('PLANSCORE_SECRET', 'WEBSITE_BASE', 'AWS', 'WATCH_QUEUE_URL')
         if k in os.environ}
     
+    if args.name in ('PlanScore-AfterUpload', 'PlanScore-ObserveTiles') and 'WATCH_QUEUE_URL' not in env:
+        # Uploads would never be given up on without straggler checks
+        parser.error('WATCH_QUEUE_URL is required for {}'.format(args.name))
+    
     lam = boto3.client('lambda', region_name='us-east-1')
     publish_function(lam, args.name, args.path, env, os.environ.get('AWS_IAM_ROLE'))
+    
+    if 'WATCH_QUEUE_ARN' in os.environ:
+        map_watch_queue(lam, args.name, os.environ['WATCH_QUEUE_ARN'])
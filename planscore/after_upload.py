@@ -3,12 +3,15 @@
 Fans out asynchronous parallel calls to planscore.district function, then
 starts and observer process with planscore.score function.
 '''
-import os, io, json, urllib.parse, gzip, functools, time, math, threading
-import boto3, osgeo.ogr
-from . import util, data, score, website, prepare_state, constants, tiles, observe
+import os, io, json, urllib.parse, gzip, functools, time, math, threading, posixpath, queue, random, collections, concurrent.futures
+import boto3, botocore.config, botocore.exceptions, osgeo.ogr
+from . import util, data, score, website, prepare_state, constants, tiles, observe, bundle
 
 FUNCTION_NAME = 'PlanScore-AfterUpload'
 
+# Lambda error codes for invocations that should be retried after a pause
+THROTTLE_ERROR_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling')
+
 osgeo.ogr.UseExceptions()
 
 states_path = os.path.join(os.path.dirname(__file__), 'geodata', 'cb_2013_us_state_20m.geojson')
@@ -59,46 +62,219 @@ def commence_upload_scoring(s3, bucket, upload):
         storage = data.Storage(s3, bucket, model.key_prefix)
         observe.put_upload_index(storage, upload)
         put_geojson_file(s3, bucket, upload, ds_path)
-        geometry_keys = put_district_geometries(s3, bucket, upload, ds_path)
-        
-        # Used so that the length of the upload districts array is correct
-        district_blanks = [None] * len(geometry_keys)
-        forward_upload = upload.clone(model=model, districts=district_blanks)
         
         # New tile-based method comes first to preserve user experience
-        tile_keys = load_model_tiles(storage, forward_upload.model)
-        start_tile_observer_lambda(storage, forward_upload, tile_keys)
-        fan_out_tile_lambdas(storage, forward_upload, tile_keys)
+        district_geoms = load_district_geometries(ds_path)
+        put_district_geometries(s3, bucket, upload, district_geoms)
+        
+        # Compactness is scored here once, so the forwarded upload has it
+        # for provisional and final scores, and the upload districts array
+        # has the correct length
+        district_scores = observe.populate_compactness(district_geoms)
+        forward_upload = upload.clone(model=model, districts=district_scores)
+        
+        model_tile_keys = load_model_tiles(storage, forward_upload.model)
+        tile_districts = put_tile_district_pieces(storage, forward_upload, model_tile_keys, district_geoms)
+        tile_costs = get_tile_costs(storage, forward_upload.model, tile_districts)
+        tile_batches = pack_tile_batches(tile_districts, tile_costs)
+        put_tile_index(storage, forward_upload, tile_batches)
+        
+        if tile_batches:
+            if not constants.WATCH_QUEUE_URL:
+                # Nothing would check for stragglers or give up, see observe.schedule_watch()
+                raise ValueError('WATCH_QUEUE_URL is not set, not starting tile Lambdas')
+            
+            # Last tile to complete starts the observer, see observe.record_tile_completion()
+            dispatch_times = fan_out_tile_lambdas(storage, forward_upload, tile_batches)
+            tile_dispatch = put_tile_dispatch(storage, forward_upload, tile_batches, tile_costs, dispatch_times)
+            
+            # First check for stragglers comes due with the earliest deadline
+            next_deadline = min(map(observe.get_straggler_deadline, tile_dispatch.values()))
+            observe.schedule_watch(storage, forward_upload, next_deadline - time.time())
+        else:
+            # No tiles to wait for
+            observe.invoke_observer_lambda(storage, forward_upload)
 
-def put_district_geometries(s3, bucket, upload, path):
+def load_district_geometries(path):
+    ''' Return list of district OGR geometries in EPSG:4326, in district order.
     '''
-    '''
-    print('put_district_geometries:', (bucket, path))
     ds = osgeo.ogr.Open(path)
-    keys = []
 
     if not ds:
         raise RuntimeError('Could not open file to fan out district invocations')
 
     _, features = ordered_districts(ds.GetLayer(0))
+    geometries = []
     
-    for (index, feature) in enumerate(features):
-        geometry = feature.GetGeometryRef()
+    for feature in features:
+        geometry = feature.GetGeometryRef().Clone()
 
         if geometry.GetSpatialReference():
             geometry.TransformTo(prepare_state.EPSG4326)
         
-        key = data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
+        geometries.append(geometry)
+    
+    return geometries
+
+def put_bundle(s3, bucket, key, body):
+    ''' Save a planscore.bundle file, gzipped where possible.
+    '''
+    if constants.S3_ENDPOINT_URL:
+        # Do not attempt gzip when using localstack S3, since it's not supported.
+        args = dict()
+    else:
+        body, args = gzip.compress(body), dict(ContentEncoding='gzip')
+    
+    s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
+        Body=body, ContentType='application/octet-stream', **args)
+
+def put_district_geometries(s3, bucket, upload, geometries):
+    ''' Save one planscore.bundle file with district geometries for this upload.
+    
+        Geometries come from load_district_geometries(), in district order.
+    '''
+    print('put_district_geometries:', (bucket, len(geometries)))
+    body = bundle.dumps([{} for _ in geometries], [geometry.ExportToWkb() for geometry in geometries],
+        [geometry.GetEnvelope() for geometry in geometries])
+    
+    put_bundle(s3, bucket, data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id), body)
+
+def get_tile_parents(tile_zxys):
+    ''' Return set of (z, x, y) tuples for every tile containing one of the given tiles.
+    '''
+    parents = set()
+    
+    for tile_zxy in tile_zxys:
+        z, x, y = map(int, tile_zxy.split('/'))
+        parents.update((z - level, x >> level, y >> level) for level in range(1, z + 1))
+    
+    return parents
+
+def clip_district_pieces(district_geom, tile_zxys, tile_parents):
+    ''' Return dictionary of district pieces clipped to each given tile, by tile zxy.
+    
+        Clips down the quadtree of web mercator tiles from the whole world,
+        following only branches from get_tile_parents() toward given tiles.
+        Each level clips the smaller pieces of the level above instead of the
+        whole district again, and pieces that fit in a single child tile are
+        passed down without clipping. Districts only touching a tile along
+        its edge are left out.
+    '''
+    pieces, stack = {}, [((0, 0, 0), district_geom)]
+    
+    while stack:
+        (z, x, y), piece_geom = stack.pop()
+        piece_envelope = piece_geom.GetEnvelope()
         
-        s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
-            Body=geometry.ExportToWkt(), ContentType='text/plain')
+        for (child_x, child_y) in ((x*2, y*2), (x*2+1, y*2), (x*2, y*2+1), (x*2+1, y*2+1)):
+            child_zxy = '{}/{}/{}'.format(z + 1, child_x, child_y)
+            is_parent = (z + 1, child_x, child_y) in tile_parents
+            
+            if not is_parent and child_zxy not in tile_zxys:
+                continue
+            
+            child_geom = tiles.tile_geometry(child_zxy)
+            child_envelope = child_geom.GetEnvelope()
+            
+            if tiles.envelope_contains(child_envelope, piece_envelope):
+                child_piece_geom = piece_geom
+            elif child_envelope[0] <= piece_envelope[1] and piece_envelope[0] <= child_envelope[1] \
+                and child_envelope[2] <= piece_envelope[3] and piece_envelope[2] <= child_envelope[3]:
+                child_piece_geom = piece_geom.Intersection(child_geom)
+            else:
+                continue
+            
+            if child_piece_geom.IsEmpty() or child_piece_geom.Area() == 0:
+                # Districts touching along the tile edge don't count
+                continue
+            
+            if child_zxy in tile_zxys:
+                pieces[child_zxy] = child_piece_geom
+            
+            if is_parent:
+                stack.append(((z + 1, child_x, child_y), child_piece_geom))
+    
+    return pieces
+
+def put_tile_district_pieces(storage, upload, tile_keys, district_geoms):
+    ''' Save district pieces clipped to each model tile, see clip_district_pieces().
+    
+        Each tile gets a planscore.bundle file of district geometry keys and
+        clipped pieces, and tiles that no district covers are left out. Pieces
+        are saved by a pool of threads. Returns an ordered dictionary with the
+        number of district pieces in each covered tile, in tile_keys order,
+        which is the exact selection of tiles in the plan footprint.
+    '''
+    tile_zxys = collections.OrderedDict((tiles.get_tile_zxy(upload.model.key_prefix, tile_key), tile_key)
+        for tile_key in tile_keys)
+    tile_parents = get_tile_parents(tile_zxys.keys())
+    tile_pieces, start_time = collections.defaultdict(list), time.time()
+    
+    for (index, district_geom) in enumerate(district_geoms):
+        for (tile_zxy, piece_geom) in clip_district_pieces(district_geom, tile_zxys, tile_parents).items():
+            tile_pieces[tile_zxy].append((index, piece_geom))
+    
+    print('put_tile_district_pieces:', len(tile_pieces), 'of', len(tile_keys),
+        'tiles covered after {:.1f} seconds.'.format(time.time() - start_time))
+    
+    def put_tile_pieces(tile_zxy):
+        pieces = tile_pieces[tile_zxy]
+        body = bundle.dumps(
+            [dict(key=data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index))
+                for (index, _) in pieces],
+            [geom.ExportToWkb() for (_, geom) in pieces],
+            [geom.GetEnvelope() for (_, geom) in pieces])
         
-        keys.append(key)
+        put_bundle(storage.s3, storage.bucket,
+            data.UPLOAD_TILE_PIECES_KEY.format(id=upload.id, zxy=tile_zxy), body)
+    
+    covered_zxys = [tile_zxy for tile_zxy in tile_zxys if tile_zxy in tile_pieces]
     
-    return keys
+    with concurrent.futures.ThreadPoolExecutor(constants.TILE_PIECES_THREADS) as executor:
+        list(executor.map(put_tile_pieces, covered_zxys))
+    
+    return collections.OrderedDict((tile_zxys[tile_zxy], len(tile_pieces[tile_zxy]))
+        for tile_zxy in covered_zxys)
 
-def load_model_tiles(storage, model):
+# Parsed model manifests by (bucket, key), see fetch_model_manifest()
+_model_manifests = collections.OrderedDict()
+
+def fetch_model_manifest(s3, bucket, key):
+    ''' Get a parsed model manifest, cached for the life of a warm container.
+    
+        The cache is keyed on bucket and key only, because every invocation
+        brings its own S3 client. Errors are raised rather than cached.
+    '''
+    if (bucket, key) in _model_manifests:
+        return _model_manifests[(bucket, key)]
+    
+    object = s3.get_object(Bucket=bucket, Key=key)
+    
+    if object.get('ContentEncoding') == 'gzip':
+        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+    
+    _model_manifests[(bucket, key)] = json.load(object['Body'])
+    
+    while len(_model_manifests) > constants.MODEL_MANIFEST_CACHE_SIZE:
+        _model_manifests.popitem(last=False)
+    
+    return _model_manifests[(bucket, key)]
+
+def load_model_manifest(storage, model):
+    ''' Get model manifest written by planscore.prepare_state, or None.
     '''
+    directory = posixpath.relpath(model.key_prefix.rstrip('/'), 'data')
+    key = prepare_state.MANIFEST_KEY_FORMAT.format(directory=directory)
+    
+    try:
+        return fetch_model_manifest(storage.s3, storage.bucket, key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+def list_model_tiles(storage, model):
+    ''' Return list of S3 object dictionaries for model tiles.
     '''
     prefix = '{}/'.format(model.key_prefix.rstrip('/'))
     marker, contents = '', []
@@ -116,60 +292,222 @@ def load_model_tiles(storage, model):
         
         marker = contents[-1]['Key']
     
-    # Sort largest items first
-    contents.sort(key=lambda obj: obj['Size'], reverse=True)
-    return [object['Key'] for object in contents][:constants.MAX_TILES_RUN]
+    # Skip the model manifest, costs, and anything else that isn't a tile
+    return [object for object in contents if posixpath.splitext(object['Key'])[1]
+        in (posixpath.splitext(prepare_state.KEY_FORMAT)[1], prepare_state.BUNDLE_EXTENSION)]
 
-def fan_out_tile_lambdas(storage, upload, tile_keys):
+def load_model_tiles(storage, model):
+    ''' Return list of model tile keys, most costly first.
+    
+        Tiles come from the model manifest if there is one, with S3 listing
+        as a fallback. Tiles in the plan footprint are selected while clipping
+        districts to them in put_tile_district_pieces().
     '''
+    manifest = load_model_manifest(storage, model)
+    
+    if manifest is None:
+        contents = list_model_tiles(storage, model)
+    else:
+        # Vertex count is a closer match than byte size to overlay work
+        contents = [dict(Key=tile['key'], Size=tile['size'], Vertices=tile['vertices'])
+            for tile in manifest['tiles']]
+    
+    # Sort largest items first, see also pack_tile_batches()
+    contents.sort(key=lambda obj: obj.get('Vertices', obj['Size']), reverse=True)
+    return [object['Key'] for object in contents]
+
+def estimate_tile_costs(tile_districts, tile_vertices, model_costs):
+    ''' Return dictionary of estimated seconds to score each tile.
+    
+        tile_districts has the number of districts crossing each tile,
+        tile_vertices comes from the model manifest, and model_costs has
+        measured seconds per district from planscore.observe. Unmeasured
+        tiles are estimated from their vertex counts at the rate seen for
+        measured ones, and tiles with neither are left out.
     '''
-    def invoke_lambda(tile_keys, upload, storage):
-        '''
-        '''
-        lam = boto3.client('lambda', endpoint_url=constants.LAMBDA_ENDPOINT_URL)
+    measured_keys = [key for key in model_costs if tile_vertices.get(key)]
+    
+    if measured_keys:
+        seconds_per_vertex = sum(model_costs[key] for key in measured_keys) \
+            / sum(tile_vertices[key] for key in measured_keys)
+    else:
+        seconds_per_vertex = constants.TILE_SECONDS_PER_VERTEX
+    
+    costs = {}
+    
+    for (tile_key, district_count) in tile_districts.items():
+        if tile_key in model_costs:
+            costs[tile_key] = model_costs[tile_key] * district_count
+        elif tile_key in tile_vertices:
+            costs[tile_key] = seconds_per_vertex * tile_vertices[tile_key] * district_count
+    
+    return costs
+
+def get_tile_costs(storage, model, tile_districts):
+    ''' Return dictionary of estimated seconds to score each tile.
+    
+        Combines the model manifest with runtimes measured for earlier uploads.
+    '''
+    manifest = load_model_manifest(storage, model)
+    tile_vertices = {tile['key']: tile['vertices'] for tile in manifest['tiles']} if manifest else {}
+    
+    return estimate_tile_costs(tile_districts, tile_vertices,
+        observe.load_model_costs(storage, model))
+
+def pack_tile_batches(tile_keys, tile_costs, target_cost=None, max_size=None):
+    ''' Return list of tile key batches, most costly first.
+    
+        Tiles are sorted by cost so the slowest start first and finish
+        early enough not to hold up the whole upload. Each costly tile gets
+        a batch of its own, and the long tail of cheap ones is packed
+        together up to a target cost. Tiles with unknown cost are batched
+        by count alone.
+    '''
+    target_cost = target_cost or constants.TILE_BATCH_COST
+    max_size = max_size or constants.TILE_BATCH_SIZE
+    default_cost = target_cost / max_size
+    batches, batch_cost = [], 0
+    
+    sorted_keys = sorted(tile_keys, key=lambda key: tile_costs.get(key, default_cost), reverse=True)
+    
+    for tile_key in sorted_keys:
+        tile_cost = tile_costs.get(tile_key, default_cost)
         
+        if not batches or len(batches[-1]) >= max_size or batch_cost + tile_cost > target_cost:
+            batches.append([])
+            batch_cost = 0
+        
+        batches[-1].append(tile_key)
+        batch_cost += tile_cost
+    
+    return batches
+
+def invoke_lambda_with_backoff(lam, function_name, payload, throttled):
+    ''' Invoke a Lambda function asynchronously, return True if it was accepted.
+    
+        Throttled invocations are retried with jittered exponential backoff,
+        and the throttled() callback is called each time.
+    '''
+    for attempt in range(constants.INVOKE_MAX_ATTEMPTS):
+        try:
+            lam.invoke(FunctionName=function_name, InvocationType='Event', Payload=payload)
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] not in THROTTLE_ERROR_CODES:
+                print('invoke_lambda_with_backoff:', function_name, error)
+                return False
+            
+            throttled()
+            time.sleep(random.uniform(0, min(constants.INVOKE_MAX_BACKOFF, .1 * 2**attempt)))
+        else:
+            return True
+    
+    print('invoke_lambda_with_backoff: gave up on', function_name,
+        'after', constants.INVOKE_MAX_ATTEMPTS, 'attempts')
+    return False
+
+def fan_out_tile_lambdas(storage, upload, tile_batches, concurrency=None, max_concurrency=None):
+    ''' Invoke a tile Lambda for each batch of tile keys from a pool of threads.
+    
+        Concurrency is halved each time Lambda throttles an invocation,
+        and grows back by one after each round of accepted invocations.
+        Payloads come from planscore.observe.get_tile_event(). Returns
+        dictionary of accepted invocation times by batch index.
+    '''
+    concurrency = concurrency or constants.FAN_OUT_CONCURRENCY
+    max_concurrency = max(concurrency, max_concurrency or constants.FAN_OUT_MAX_CONCURRENCY)
+    
+    lam = boto3.client('lambda', endpoint_url=constants.LAMBDA_ENDPOINT_URL,
+        config=botocore.config.Config(max_pool_connections=max_concurrency))
+    
+    tile_queue, dispatch_times = queue.Queue(), {}
+    state, lock = dict(limit=concurrency, invoked=0, failed=0, throttled=0), threading.Lock()
+    
+    for (batch_index, tile_batch) in enumerate(tile_batches):
+        tile_queue.put((batch_index, tile_batch))
+    
+    def throttled():
+        with lock:
+            state['limit'] = max(1, state['limit'] // 2)
+            state['throttled'] += 1
+    
+    def invoke_lambdas(thread_index):
         while True:
+            if thread_index >= state['limit']:
+                # Paused by throttling, wait for concurrency to grow back
+                if tile_queue.empty():
+                    return
+                time.sleep(.05)
+                continue
+            
             try:
-                tile_key = tile_keys.pop(0)
-            except IndexError:
-                break
-
-            payload = dict(upload=upload.to_dict(), storage=storage.to_event(),
-                tile_key=tile_key)
+                batch_index, tile_batch = tile_queue.get_nowait()
+            except queue.Empty:
+                return
             
-            lam.invoke(FunctionName=tiles.FUNCTION_NAME, InvocationType='Event',
-                Payload=json.dumps(payload).encode('utf8'))
+            tile_event = observe.get_tile_event(storage, upload, tile_batches, batch_index)
+            tile_payload = json.dumps(tile_event).encode('utf8')
+            accepted = invoke_lambda_with_backoff(lam, tiles.FUNCTION_NAME, tile_payload, throttled)
+            
+            with lock:
+                if not accepted:
+                    state['failed'] += 1
+                    continue
+                
+                state['invoked'] += 1
+                dispatch_times[batch_index] = time.time()
+                
+                if state['invoked'] % state['limit'] == 0:
+                    state['limit'] = min(max_concurrency, state['limit'] + 1)
     
     threads, start_time = [], time.time()
     
-    print('fan_out_tile_lambdas: starting threads for',
-        len(tile_keys), 'tile_keys from', upload.model.key_prefix)
+    print('fan_out_tile_lambdas: starting', max_concurrency, 'threads for',
+        len(tile_batches), 'tile batches from', upload.model.key_prefix)
 
-    for i in range(8):
-        threads.append(threading.Thread(target=invoke_lambda,
-            args=(tile_keys, upload, storage)))
-        
+    for thread_index in range(max_concurrency):
+        threads.append(threading.Thread(target=invoke_lambdas, args=(thread_index, )))
         threads[-1].start()
 
     for thread in threads:
         thread.join()
+    
+    elapsed = time.time() - start_time
 
-    print('fan_out_tile_lambdas: completed threads after',
-        int(time.time() - start_time), 'seconds.')
+    print('fan_out_tile_lambdas: invoked {invoked} batches, {failed} failed, '
+        '{throttled} throttled, after {0:.1f} seconds at {1:.0f}/sec.'.format(
+        elapsed, state['invoked'] / max(elapsed, .001), **state))
+    
+    return dispatch_times
 
-def start_tile_observer_lambda(storage, upload, tile_keys):
+def put_tile_dispatch(storage, upload, tile_batches, tile_costs, dispatch_times):
+    ''' Save and return dispatch time, attempts, and estimated cost of each tile batch.
+    
+        Used by planscore.observe.watch_tile_batches() to find stragglers.
+        Batches with unknown costs or no accepted invocation are left
+        for the observer to judge.
     '''
+    tile_dispatch = {}
+    
+    for (batch_index, tile_batch) in enumerate(tile_batches):
+        batch_costs = [tile_costs.get(tile_key) for tile_key in tile_batch]
+        dispatch_time = dispatch_times.get(batch_index)
+        
+        tile_dispatch[batch_index] = dict(time=dispatch_time,
+            attempts=(0 if dispatch_time is None else 1),
+            cost=(None if None in batch_costs else sum(batch_costs)))
+    
+    observe.put_tile_dispatch(storage, upload, tile_dispatch)
+    
+    return tile_dispatch
+
+def put_tile_index(storage, upload, tile_batches):
+    ''' Save upload and its batches of tile keys for the observer to find later.
     '''
+    tile_index = dict(upload=upload.to_dict(), tiles=tile_batches)
+    
     storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
         Key=data.UPLOAD_TILE_INDEX_KEY.format(id=upload.id),
-        Body=json.dumps(tile_keys).encode('utf8'))
-    
-    lam = boto3.client('lambda', endpoint_url=constants.LAMBDA_ENDPOINT_URL)
-
-    payload = dict(upload=upload.to_dict(), storage=storage.to_event())
-
-    lam.invoke(FunctionName=observe.FUNCTION_NAME, InvocationType='Event',
-        Payload=json.dumps(payload).encode('utf8'))
+        Body=json.dumps(tile_index).encode('utf8'))
 
 def guess_state_model(path):
     ''' Guess state model for the given input path.
@@ -0,0 +1,131 @@
+''' Compact binary encoding for lists of geographic features.
+
+Used for model tiles in place of GeoJSON, so that tiles can be read straight
+into OGR geometries and numeric arrays without a JSON round trip. All numbers
+are little-endian:
+
+    header      magic b'PSB', version uint8, feature count uint32,
+                properties length uint32, simulations length uint32
+    envelopes   feature count × 4 float64 (xmin, xmax, ymin, ymax), NaN
+                for missing or empty geometries
+    lengths     feature count × uint32 WKB geometry lengths, 0 for missing
+    properties  UTF-8 JSON array with one properties object per feature
+    simulations UTF-8 JSON array of {"name", "columns"} simulation blocks
+    blocks      for each simulation block, columns × float64 offsets,
+                columns × float64 scales, then feature count × columns
+                uint16 quantized values
+    geometries  concatenated WKB geometries
+
+Simulated votes are quantized per column: value = offset + scale × q, with
+offset the column minimum and scale its range / 65535. Decoded values are
+within half a step of the original, at most (max - min) / 131070 per column,
+e.g. 0.0077 votes for a column of precinct votes ranging from 0 to 1000.
+Version 1 bundles without simulation blocks can still be read.
+'''
+import struct, json
+import numpy
+
+MAGIC, VERSION = b'PSB', 2
+HEADERS = {1: struct.Struct('<3sBII'), 2: struct.Struct('<3sBIII')}
+QUANTIZED_STEPS = 0xFFFF
+
+def quantize_columns(values):
+    ''' Return offsets, scales, and uint16 steps for a features × columns array.
+    '''
+    offsets = values.min(axis=0)
+    scales = (values.max(axis=0) - offsets) / QUANTIZED_STEPS
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        steps = numpy.where(scales > 0, (values - offsets) / scales, 0)
+
+    return offsets, scales, numpy.round(steps).astype('<u2')
+
+def dumps(properties, geometries, envelopes, simulations=None):
+    ''' Return bundle bytes for lists of properties, WKB geometries, and envelopes.
+
+        Simulations are an optional list with a dictionary of simulated
+        vote arrays for each feature. Shorter or missing arrays are zero-filled.
+    '''
+    properties_json = json.dumps(properties, separators=(',', ':')).encode('utf8')
+    envelopes_array = numpy.array(envelopes, dtype='<f8').reshape(-1, 4)
+    lengths_array = numpy.array([len(wkb or b'') for wkb in geometries], dtype='<u4')
+    simulations = simulations or [{}] * len(properties)
+
+    if not (len(properties) == len(geometries) == len(envelopes_array) == len(simulations)):
+        raise ValueError('Mismatched properties, geometries, envelopes, and simulations')
+
+    blocks, block_chunks = [], []
+
+    for name in sorted({name for sims in simulations for name in sims}):
+        columns = max(len(sims.get(name, [])) for sims in simulations)
+        values = numpy.zeros((len(simulations), columns))
+
+        for (index, sims) in enumerate(simulations):
+            array = sims.get(name, [])
+            values[index,:len(array)] = [value or 0 for value in array]
+
+        offsets, scales, steps = quantize_columns(values)
+        blocks.append(dict(name=name, columns=columns))
+        block_chunks.extend([offsets.astype('<f8').tobytes(),
+            scales.astype('<f8').tobytes(), steps.tobytes()])
+
+    simulations_json = json.dumps(blocks, separators=(',', ':')).encode('utf8')
+    header = HEADERS[VERSION].pack(MAGIC, VERSION, len(properties),
+        len(properties_json), len(simulations_json))
+
+    return b''.join([header, envelopes_array.tobytes(), lengths_array.tobytes(),
+        properties_json, simulations_json] + block_chunks
+        + [bytes(wkb or b'') for wkb in geometries])
+
+def loads(body):
+    ''' Return lists of properties, WKB geometries, an array of envelopes, and simulations.
+
+        Missing geometries are returned as None. Simulations are a list with
+        a dictionary of decoded simulated vote arrays for each feature.
+    '''
+    magic, version = struct.unpack_from('<3sB', body, 0)
+
+    if magic != MAGIC or version not in HEADERS:
+        raise ValueError('Not a recognized feature bundle')
+
+    if version == 1:
+        _, _, count, properties_length = HEADERS[version].unpack_from(body, 0)
+        simulations_length = 0
+    else:
+        _, _, count, properties_length, simulations_length = HEADERS[version].unpack_from(body, 0)
+
+    offset = HEADERS[version].size
+    envelopes = numpy.frombuffer(body, dtype='<f8', count=count * 4, offset=offset).reshape(count, 4)
+
+    offset += envelopes.nbytes
+    lengths = numpy.frombuffer(body, dtype='<u4', count=count, offset=offset)
+
+    offset += lengths.nbytes
+    properties = json.loads(body[offset:offset + properties_length].decode('utf8'))
+
+    offset += properties_length
+    blocks = json.loads(body[offset:offset + simulations_length].decode('utf8') or '[]')
+    simulations = [dict() for _ in range(count)]
+
+    offset += simulations_length
+
+    for block in blocks:
+        columns = block['columns']
+        offsets = numpy.frombuffer(body, dtype='<f8', count=columns, offset=offset)
+        scales = numpy.frombuffer(body, dtype='<f8', count=columns, offset=offset + offsets.nbytes)
+        offset += offsets.nbytes + scales.nbytes
+
+        steps = numpy.frombuffer(body, dtype='<u2', count=count * columns, offset=offset)
+        values = steps.reshape(count, columns) * scales + offsets
+        offset += steps.nbytes
+
+        for (sims, row) in zip(simulations, values):
+            sims[block['name']] = row
+
+    geometries = []
+
+    for length in lengths.tolist():
+        geometries.append(body[offset:offset + length] if length else None)
+        offset += length
+
+    return properties, geometries, envelopes, simulations
@@ -44,21 +44,90 @@ API_UPLOADED_RELPATH = 'uploaded'
 
 S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', _local_url(4572))
 LAMBDA_ENDPOINT_URL = os.environ.get('LAMBDA_ENDPOINT_URL', _local_url(4574))
+SQS_ENDPOINT_URL = os.environ.get('SQS_ENDPOINT_URL', _local_url(4576))
 S3_URL_PATTERN = urllib.parse.urljoin(S3_ENDPOINT_URL, '/{b}/{k}')
 
 if os.environ.get('AWS') == 'amazonaws.com':
-    S3_ENDPOINT_URL, LAMBDA_ENDPOINT_URL = None, None
+    S3_ENDPOINT_URL, LAMBDA_ENDPOINT_URL, SQS_ENDPOINT_URL = None, None, None
     S3_URL_PATTERN = 'https://{b}.s3.amazonaws.com/{k}'
 
 # Time limit to process an upload, in seconds
 
 UPLOAD_TIME_LIMIT = 30 * 60
 
-# Amount to round different kinds of values
+# Amount to round different kinds of values, and intermediate totals in tile
+# outputs and partial sums, which are rounded finely enough that thousands of
+# them add up to unchanged published counts
 
 ROUND_COUNT = 2
 ROUND_FLOAT = 4
+ROUND_TILE = 7
 
-# For now, limit the number of tiles to run in parallel
+# Number of parsed model manifests kept in memory by a warm Lambda container
 
-MAX_TILES_RUN = 9999
\ No newline at end of file
+MODEL_MANIFEST_CACHE_SIZE = 8
+
+# Number of ensemble plans sent together to every local worker process,
+# which holds simulated district totals only for groups being scored
+
+ENSEMBLE_GROUP_SIZE = int(os.environ.get('ENSEMBLE_GROUP_SIZE', 16))
+
+# Number of concurrent tile Lambda invocations during fan-out, adjusted down
+# and back up again between 1 and the maximum in response to throttling
+
+FAN_OUT_CONCURRENCY = int(os.environ.get('FAN_OUT_CONCURRENCY', 16))
+FAN_OUT_MAX_CONCURRENCY = int(os.environ.get('FAN_OUT_MAX_CONCURRENCY', 64))
+
+# Tile Lambda batches: target cost in estimated seconds, most tiles
+# in one batch, and number of threads scoring tiles inside one invocation
+
+TILE_BATCH_COST = float(os.environ.get('TILE_BATCH_COST', 20))
+TILE_BATCH_SIZE = int(os.environ.get('TILE_BATCH_SIZE', 16))
+TILE_BATCH_THREADS = 4
+
+# Number of threads saving district pieces clipped to tiles after upload
+
+TILE_PIECES_THREADS = 16
+
+# Number of threads fetching completed tile outputs in the observer
+
+OBSERVE_FETCH_THREADS = 16
+
+# Most times the observer continues from a checkpoint before giving up
+
+OBSERVE_MAX_CONTINUATIONS = int(os.environ.get('OBSERVE_MAX_CONTINUATIONS', 12))
+
+# Most tile Lambda outputs merged into each partial sum before the
+# observer merges all partial sums, see planscore.observe.get_reduce_group()
+
+REDUCE_FAN_IN = int(os.environ.get('REDUCE_FAN_IN', 64))
+
+# Straggling tile batches are dispatched again once they run this many times
+# longer than their estimated cost, or at least this many seconds, and this
+# many more times at most
+
+STRAGGLER_FACTOR = float(os.environ.get('STRAGGLER_FACTOR', 3))
+STRAGGLER_MIN_SECONDS = float(os.environ.get('STRAGGLER_MIN_SECONDS', 30))
+STRAGGLER_MAX_ATTEMPTS = int(os.environ.get('STRAGGLER_MAX_ATTEMPTS', 3))
+
+# SQS queue whose delayed messages trigger straggler checks in the observer
+# Lambda, and the longest delay SQS allows, see planscore.observe.schedule_watch()
+
+WATCH_QUEUE_URL = os.environ.get('WATCH_QUEUE_URL')
+WATCH_MAX_DELAY = 900
+
+# Tile Lambda timeout in seconds, see deploy.py; a batch still unfinished
+# this long after dispatch has certainly failed
+
+TILE_TIMEOUT_SECONDS = 300
+
+# Tile cost model: starting guess at seconds per manifest vertex per district
+# until runtimes are measured, and weight given to each new measurement
+
+TILE_SECONDS_PER_VERTEX = 2e-6
+TILE_COST_WEIGHT = .5
+
+# Attempts and longest wait in seconds for a throttled Lambda invocation
+
+INVOKE_MAX_ATTEMPTS = 8
+INVOKE_MAX_BACKOFF = 5
\ No newline at end of file
@@ -7,8 +7,16 @@ UPLOAD_PLAINTEXT_KEY = 'uploads/{id}/index.txt'
 UPLOAD_GEOMETRY_KEY = 'uploads/{id}/geometry.json'
 UPLOAD_DISTRICTS_KEY = 'uploads/{id}/districts/{index}.json'
 UPLOAD_GEOMETRIES_KEY = 'uploads/{id}/geometries/{index}.wkt'
+UPLOAD_GEOMETRIES_BUNDLE_KEY = 'uploads/{id}/geometries.psb'
 UPLOAD_TILE_INDEX_KEY = 'uploads/{id}/tiles.json'
 UPLOAD_TILES_KEY = 'uploads/{id}/tiles/{zxy}.json'
+UPLOAD_TILE_PIECES_KEY = 'uploads/{id}/pieces/{zxy}.psb'
+UPLOAD_GROUP_TILES_KEY = 'uploads/{id}/groups/{group}/{zxy}.json'
+UPLOAD_PARTIALS_KEY = 'uploads/{id}/partials/{group}.json'
+UPLOAD_DISPATCH_KEY = 'uploads/{id}/dispatch.json'
+UPLOAD_CHECKPOINT_KEY = 'uploads/{id}/checkpoint.json'
+UPLOAD_TIMINGS_KEY = 'uploads/{id}/timings.json'
+MODEL_COSTS_KEY = '{prefix}/costs.json'
 
 class State (enum.Enum):
     XX = 'XX'
@@ -163,6 +171,15 @@ class Upload:
     def to_json(self):
         return json.dumps(self.to_dict(), sort_keys=True, indent=2)
     
+    def to_reference(self):
+        ''' Return minimal dictionary identifying this upload and its model.
+        '''
+        return dict(
+            id = self.id,
+            key = self.key,
+            model = (self.model.to_dict() if self.model else None),
+            )
+    
     def clone(self, model=None, districts=None, summary=None, progress=None,
         start_time=None, message=None):
         return Upload(self.id, self.key,
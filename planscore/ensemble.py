@@ -0,0 +1,318 @@
+''' Scores an ensemble of many district plans against a single state model.
+
+Model tiles are split among a set of local worker processes, and each worker
+loads and parses its own tiles once for the whole ensemble. Plan files are
+loaded in small groups and sent to every worker, which scores the group's
+districts against each of its tiles and returns summed district totals.
+Totals from all workers are merged and scored over a pool of processes, so
+memory use is bounded by group size rather than ensemble size. Writes two
+tab-delimited tables: one row of metrics per plan, and one row of totals per
+plan district, written as each group finishes.
+'''
+import argparse, os, csv, multiprocessing, tempfile, queue, traceback, collections, concurrent.futures
+import boto3, osgeo.ogr, numpy
+from . import constants, data, util, tiles, score, observe, after_upload, prepare_state
+
+def get_datasource_path(path, dirname):
+    ''' Return path to an OGR datasource for a plan file, unzipping if needed.
+    '''
+    if os.path.splitext(path)[1] == '.zip':
+        # Assume a shapefile
+        return util.unzip_shapefile(path, dirname)
+
+    return path
+
+def load_plan_geometries(path):
+    ''' Return list of district WKT strings for a plan file, in district order.
+    '''
+    with tempfile.TemporaryDirectory(prefix='load_plan_geometries-') as dirname:
+        ds = osgeo.ogr.Open(get_datasource_path(path, dirname))
+
+        if not ds:
+            raise RuntimeError(f'Could not open plan file {path}')
+
+        _, features = after_upload.ordered_districts(ds.GetLayer(0))
+        geometries = [feature.GetGeometryRef() for feature in features]
+
+        for geometry in geometries:
+            if geometry.GetSpatialReference():
+                geometry.TransformTo(prepare_state.EPSG4326)
+
+        return [geometry.ExportToWkt() for geometry in geometries]
+
+def load_ensemble(paths, model, first_index=0):
+    ''' Return lists of uploads and district WKT strings for plan files.
+    
+        Upload IDs count up from first_index, the position of the first plan file.
+    '''
+    uploads, plan_geometries = [], []
+
+    for (index, path) in enumerate(paths, first_index):
+        geometries = load_plan_geometries(path)
+        uploads.append(data.Upload(id=str(index), key=path, model=model,
+            districts=[None] * len(geometries)))
+        plan_geometries.append(geometries)
+
+    return uploads, plan_geometries
+
+def get_plan_envelopes(geometries):
+    ''' Return district × 4 array of (xmin, xmax, ymin, ymax) for plan geometries.
+    '''
+    return numpy.array([geometry.GetEnvelope() for geometry in geometries], dtype=float).reshape(-1, 4)
+
+def load_tile(storage, tile_key):
+    ''' Return dictionary with a model tile's geometry and prepared precincts.
+    
+        Precinct envelopes and attributes are computed once here, so every
+        plan scored against the tile reuses them.
+    '''
+    tile_geom = tiles.tile_geometry(tiles.get_tile_zxy(storage.prefix, tile_key))
+    precincts = tiles.load_prepared_precincts(storage, tile_key)
+    
+    return dict(key=tile_key, geometry=tile_geom, precincts=precincts,
+        envelopes=tiles.get_precinct_envelopes(precincts),
+        attributes=tiles.get_precinct_attributes(precincts))
+
+def score_tile(tile, uploads, plan_geometries, plan_envelopes=None):
+    ''' Return dictionary of tile totals for every plan, keyed by plan index.
+
+        Tiles come from load_tile(), and tile totals match the output of
+        planscore.tiles.lambda_handler(). Plan envelopes from
+        get_plan_envelopes() are computed here if not given.
+    '''
+    if plan_envelopes is None:
+        plan_envelopes = [get_plan_envelopes(geometries) for geometries in plan_geometries]
+    
+    xmin1, xmax1, ymin1, ymax1 = tile['geometry'].GetEnvelope()
+    plan_totals = {}
+
+    for (index, (upload, geometries, districts_envelope)) in enumerate(zip(uploads, plan_geometries, plan_envelopes)):
+        # Skip cheaply when districts don't come near the tile
+        xmin2, xmax2, ymin2, ymax2 = districts_envelope.T
+        nearby = numpy.flatnonzero((xmin2 <= xmax1) & (xmax2 >= xmin1) & (ymin2 <= ymax1) & (ymax2 >= ymin1))
+        
+        if not len(nearby):
+            continue
+        
+        geometry_keys = [data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=district_index)
+            for district_index in nearby]
+        district_geoms = [geometries[district_index] for district_index in nearby]
+        
+        plan_totals[index] = dict(zip(geometry_keys, tiles.score_districts(district_geoms,
+            tile['precincts'], tile['geometry'], tile['envelopes'], tile['attributes'])))
+
+    return plan_totals
+
+def score_plans(loaded_tiles, uploads, plan_wkts):
+    ''' Return list of summed tile totals for a group of plans over loaded tiles.
+    
+        Each plan gets one dictionary keyed by geometry key, like a tile output,
+        covering only districts that cross the loaded tiles.
+    '''
+    plan_geometries = [[osgeo.ogr.CreateGeometryFromWkt(wkt) for wkt in wkts] for wkts in plan_wkts]
+    plan_envelopes = [get_plan_envelopes(geometries) for geometries in plan_geometries]
+    plan_totals = [{} for _ in uploads]
+    
+    for tile in loaded_tiles:
+        for (plan_index, tile_total) in score_tile(tile, uploads, plan_geometries, plan_envelopes).items():
+            tiles.add_batch_totals(plan_totals[plan_index], tile_total)
+    
+    return plan_totals
+
+def split_tile_keys(tile_keys, count):
+    ''' Return a list of tile keys for each of count workers.
+    
+        Tiles come most costly first from load_model_tiles(), and are dealt
+        out in turn so each worker gets a similar share of the work.
+    '''
+    return [tile_keys[index::count] for index in range(count)]
+
+def run_worker(storage_event, tile_keys, plan_queue, totals_queue):
+    ''' Load a share of model tiles once, then score each group of plans against them.
+    
+        Groups arrive on plan_queue as (group index, uploads, plan WKTs) until
+        None, and summed totals from score_plans() go back on totals_queue as
+        (group index, totals). Errors are sent back in place of totals.
+    '''
+    try:
+        s3 = boto3.client('s3', endpoint_url=constants.S3_ENDPOINT_URL)
+        storage = data.Storage.from_event(storage_event, s3)
+        loaded_tiles = [load_tile(storage, tile_key) for tile_key in tile_keys]
+    
+        for (group_index, uploads, plan_wkts) in iter(plan_queue.get, None):
+            totals_queue.put((group_index, score_plans(loaded_tiles, uploads, plan_wkts)))
+    except Exception:
+        totals_queue.put((None, traceback.format_exc()))
+
+def get_worker_totals(totals_queue, workers, group_index, received):
+    ''' Return list of summed totals from every worker for one group of plans.
+    
+        Totals for later groups arriving first are kept in received, a
+        dictionary of lists keyed by group index.
+    '''
+    while len(received.get(group_index, [])) < len(workers):
+        try:
+            index, totals = totals_queue.get(timeout=5)
+        except queue.Empty:
+            if not all(worker.is_alive() for worker in workers):
+                raise RuntimeError('Ensemble worker process stopped unexpectedly')
+            continue
+        
+        if index is None:
+            raise RuntimeError(f'Ensemble worker process failed:\n{totals}')
+        
+        received.setdefault(index, []).append(totals)
+    
+    return received.pop(group_index)
+
+def merge_plan_totals(uploads, worker_totals):
+    ''' Return list of district arrays for a group of plans from all worker totals.
+    '''
+    plan_districts = [observe.start_district_totals(upload) for upload in uploads]
+    
+    for plan_totals in worker_totals:
+        for (upload, districts, tile_total) in zip(uploads, plan_districts, plan_totals):
+            observe.add_tile_totals(districts, tile_total, upload)
+    
+    return plan_districts
+
+def score_group(uploads, plan_districts):
+    ''' Return list of scored uploads for a group of plans with merged district totals.
+    
+        Summaries keep only plain values, as used in the plan table.
+    '''
+    scored_uploads = [score_plan(upload, districts) for (upload, districts)
+        in zip(uploads, plan_districts)]
+    
+    return [upload.clone(summary={name: value for (name, value) in upload.summary.items()
+        if type(value) is not dict}) for upload in scored_uploads]
+
+def iterate_plan_districts(storage, model, plan_groups, tile_keys, processes):
+    ''' Generate uploads and merged district arrays for each group of plans, in order.
+    
+        Starts one worker process for each share of model tiles, and sends
+        each group to every worker while the group before it is still being
+        scored so workers are kept busy.
+    '''
+    totals_queue, workers, plan_queues = multiprocessing.Queue(), [], []
+    
+    for worker_tile_keys in split_tile_keys(tile_keys, max(1, min(processes, len(tile_keys)))):
+        plan_queues.append(multiprocessing.Queue(2))
+        workers.append(multiprocessing.Process(target=run_worker, daemon=True,
+            args=(storage.to_event(), worker_tile_keys, plan_queues[-1], totals_queue)))
+        workers[-1].start()
+    
+    pending, received = collections.deque(), {}
+    
+    def finish_group():
+        index, uploads = pending.popleft()
+        worker_totals = get_worker_totals(totals_queue, workers, index, received)
+        print('iterate_plan_districts: {}/{} plan groups complete'.format(index + 1, len(plan_groups)))
+        return uploads, merge_plan_totals(uploads, worker_totals)
+    
+    try:
+        for (group_index, (first_index, paths)) in enumerate(plan_groups):
+            uploads, plan_wkts = load_ensemble(paths, model, first_index)
+            
+            for plan_queue in plan_queues:
+                plan_queue.put((group_index, uploads, plan_wkts))
+            
+            pending.append((group_index, uploads))
+            
+            if len(pending) > 1:
+                yield finish_group()
+        
+        while pending:
+            yield finish_group()
+    finally:
+        for (plan_queue, worker) in zip(plan_queues, workers):
+            if worker.is_alive():
+                plan_queue.put(None)
+        
+        for worker in workers:
+            worker.join(timeout=5)
+
+def score_ensemble(storage, model, paths, tile_keys, processes=None, group_size=None):
+    ''' Generate scored uploads for an ensemble of plan files, in plan order.
+    
+        Each model tile is loaded once by one worker process, see
+        iterate_plan_districts(). Merged groups are scored over a pool of
+        processes, with no more groups waiting than there are processes.
+    '''
+    processes = processes or os.cpu_count()
+    group_size = group_size or constants.ENSEMBLE_GROUP_SIZE
+    plan_groups = [(start, paths[start:start+group_size])
+        for start in range(0, len(paths), group_size)]
+    scoring = collections.deque()
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for (uploads, plan_districts) in iterate_plan_districts(storage, model,
+            plan_groups, tile_keys, processes):
+            scoring.append(executor.submit(score_group, uploads, plan_districts))
+            
+            if len(scoring) > processes:
+                yield from scoring.popleft().result()
+        
+        while scoring:
+            yield from scoring.popleft().result()
+
+def score_plan(upload, districts):
+    ''' Return upload scored with accumulated district totals.
+    '''
+    upload2 = upload.clone(districts=observe.finish_district_totals(districts))
+    return score.calculate_biases(score.calculate_bias(upload2))
+
+def write_tables(plans_file, districts_file, uploads):
+    ''' Write tab-delimited tables of plan metrics and district totals as uploads arrive.
+    
+        Columns come from the first upload, and every plan in an ensemble
+        is expected to share them.
+    '''
+    plan_rows, district_rows = None, None
+    
+    for upload in uploads:
+        if plan_rows is None:
+            plan_columns = sorted(name for (name, value) in upload.summary.items()
+                if type(value) is not dict)
+            district_columns = sorted({name for district in upload.districts
+                for name in district['totals']})
+            
+            plan_rows = csv.DictWriter(plans_file, ['Plan'] + plan_columns,
+                dialect='excel-tab', extrasaction='ignore')
+            district_rows = csv.DictWriter(districts_file, ['Plan', 'District'] + district_columns,
+                dialect='excel-tab', extrasaction='ignore')
+            plan_rows.writeheader()
+            district_rows.writeheader()
+        
+        plan_rows.writerow(dict(upload.summary, Plan=upload.key))
+        
+        for (index, district) in enumerate(upload.districts):
+            district_rows.writerow(dict(district['totals'], Plan=upload.key, District=index + 1))
+
+parser = argparse.ArgumentParser(description='Score an ensemble of plans against one model')
+
+parser.add_argument('plans_output', help='Name of tab-delimited file for plan metrics')
+parser.add_argument('districts_output', help='Name of tab-delimited file for district totals')
+parser.add_argument('filenames', nargs='+', help='Names of geographic files with district plans')
+parser.add_argument('--processes', type=int, default=None,
+    help='Number of processes loading tiles, and again scoring plans. Default one per CPU.')
+parser.add_argument('--group-size', type=int, default=None,
+    help='Number of plans sent to workers together. Default {}.'.format(constants.ENSEMBLE_GROUP_SIZE))
+
+def main():
+    args = parser.parse_args()
+    s3 = boto3.client('s3', endpoint_url=constants.S3_ENDPOINT_URL)
+
+    # Every plan in the ensemble is expected to share the first plan's model
+    with tempfile.TemporaryDirectory(prefix='planscore-ensemble-') as dirname:
+        model = after_upload.guess_state_model(get_datasource_path(args.filenames[0], dirname))
+
+    storage = data.Storage(s3, constants.S3_BUCKET, model.key_prefix)
+    print('Scoring', len(args.filenames), 'plans against', model.key_prefix)
+
+    tile_keys = after_upload.load_model_tiles(storage, model)
+    scored_uploads = score_ensemble(storage, model, args.filenames, tile_keys,
+        args.processes, args.group_size)
+
+    with open(args.plans_output, 'w') as plans_file, open(args.districts_output, 'w') as districts_file:
+        write_tables(plans_file, districts_file, scored_uploads)
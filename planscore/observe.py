@@ -1,9 +1,14 @@
-import boto3, botocore.exceptions, time, json, posixpath, io, gzip, collections, copy
+import boto3, botocore.exceptions, time, json, posixpath, io, gzip, collections, copy, math, concurrent.futures
 from . import data, constants, tiles, score, compactness
-import osgeo.ogr
+import numpy
 
 FUNCTION_NAME = 'PlanScore-ObserveTiles'
 
+OVERDUE_MESSAGE = 'Giving up on this plan after it took too long, sorry.'
+
+# S3 error codes for conditional writes that lost to another write
+CONDITIONAL_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
 def put_upload_index(storage, upload):
     ''' Save a JSON index and a plaintext file for this upload.
     '''
@@ -19,11 +24,409 @@ def put_upload_index(storage, upload):
     storage.s3.put_object(Bucket=storage.bucket, Key=key2, Body=body2,
         ContentType='text/plain', ACL='public-read')
 
-def get_expected_tile(enqueued_key, upload):
-    ''' Return an expect tile key for an enqueued one.
+def load_upload_index(storage, upload):
+    ''' Get the last published version of an upload from its JSON index.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket, Key=upload.index_key())
+    
+    return data.Upload.from_json(object['Body'].read().decode('utf8'))
+
+def put_conditional_object(s3, header, value, **kwargs):
+    ''' Put an S3 object with a conditional write header, return true if written.
+    
+        Returns false if S3 rejected the write because its If-Match or
+        If-None-Match condition failed. The header is added just before the
+        request is signed, because boto3 == 1.4.4 predates conditional writes,
+        so the client must not be putting other objects from other threads.
+    '''
+    def add_header(request, **kwargs):
+        request.headers[header] = value
+    
+    handler_id = 'put_conditional_object-{}'.format(id(add_header))
+    s3.meta.events.register('before-sign.s3.PutObject', add_header, unique_id=handler_id)
+    
+    try:
+        s3.put_object(**kwargs)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] not in CONDITIONAL_ERROR_CODES:
+            raise
+        return False
+    finally:
+        s3.meta.events.unregister('before-sign.s3.PutObject', unique_id=handler_id)
+    
+    return True
+
+def load_upload_index_etag(storage, upload):
+    ''' Get the last published version of an upload and the ETag of its JSON index.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket, Key=upload.index_key())
+    
+    return data.Upload.from_json(object['Body'].read().decode('utf8')), object['ETag']
+
+def load_tile_index(storage, upload):
+    ''' Get forwarded upload and list of enqueued tile batches for an upload.
+    
+        Written by planscore.after_upload.put_tile_index() before tiles start.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket,
+        Key=data.UPLOAD_TILE_INDEX_KEY.format(id=upload.id))
+    
+    tile_index = json.load(object['Body'])
+    
+    return data.Upload.from_dict(tile_index['upload']), tile_index['tiles']
+
+def is_upload_finished(upload):
+    ''' Return true if an upload has been completely and finally scored.
+    '''
+    return bool(upload.progress and upload.progress.is_complete()
+        and upload.summary and not upload.summary.get('Provisional'))
+
+def is_upload_given_up(upload):
+    ''' Return true if an upload was given up on, see put_overdue_upload().
+    '''
+    return upload.message == OVERDUE_MESSAGE
+
+def is_upload_stopped(upload):
+    ''' Return true if an upload needs no more work, finished or given up on.
+    '''
+    return is_upload_finished(upload) or is_upload_given_up(upload)
+
+def invoke_observer_lambda(storage, upload, continuation=0, provisional=False):
+    ''' Invoke the observer Lambda to score an upload from its tile outputs.
+    
+        Continuation counts invocations resuming from a saved checkpoint.
+        Provisional invocations score only partial sums merged so far,
+        see publish_provisional_scores().
+    '''
+    lam = boto3.client('lambda', endpoint_url=constants.LAMBDA_ENDPOINT_URL)
+    payload = dict(upload=upload.to_reference(), storage=storage.to_event(),
+        continuation=continuation, provisional=provisional)
+
+    lam.invoke(FunctionName=FUNCTION_NAME, InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf8'))
+
+def schedule_watch(storage, upload, delay, merge_time=None):
+    ''' Check tile batches for stragglers after a delay, see watch_tile_batches().
+    
+        Sends a delayed message to the watch queue, which triggers the observer
+        Lambda, so nothing runs while waiting. Delays are capped at
+        constants.WATCH_MAX_DELAY, and later deadlines are reached by checking
+        again. Merge time is passed along to the check. The queue is required,
+        because nothing else would ever give up on an upload whose tile
+        Lambdas failed.
+    '''
+    if not constants.WATCH_QUEUE_URL:
+        raise ValueError('WATCH_QUEUE_URL is not set, can not check for stragglers')
+    
+    sqs = boto3.client('sqs', endpoint_url=constants.SQS_ENDPOINT_URL)
+    payload = dict(upload=upload.to_reference(), storage=storage.to_event(),
+        merge_time=merge_time)
+    
+    sqs.send_message(QueueUrl=constants.WATCH_QUEUE_URL, MessageBody=json.dumps(payload),
+        DelaySeconds=min(constants.WATCH_MAX_DELAY, max(0, math.ceil(delay))))
+
+def get_reduce_group(batch_index, batch_count):
+    ''' Return dictionary with index, size, and count of tile output groups for one batch.
+    
+        Consecutive batches are grouped about as many at a time as there are
+        groups, so smaller uploads still merge several partial sums for
+        provisional scores, and no more than constants.REDUCE_FAN_IN at a time.
+    '''
+    fan_in = min(constants.REDUCE_FAN_IN, max(1, math.ceil(math.sqrt(batch_count))))
+    index = batch_index // fan_in
+    
+    return dict(index=index, size=min(fan_in, batch_count - index * fan_in),
+        count=math.ceil(batch_count / fan_in))
+
+def get_group_prefix(upload, group_index):
+    ''' Return S3 prefix for completion markers of one group of tile outputs.
+    '''
+    return posixpath.dirname(data.UPLOAD_GROUP_TILES_KEY.format(
+        id=upload.id, group=group_index, zxy='-')) + '/'
+
+def get_markers_prefix(upload):
+    ''' Return S3 prefix for completion markers of all groups of tile outputs.
+    '''
+    return posixpath.dirname(get_group_prefix(upload, '-').rstrip('/')) + '/'
+
+def get_group_tile(marker_key, upload, group_index):
+    ''' Return tile output key for a group completion marker key.
+    '''
+    zxy, _ = posixpath.splitext(posixpath.relpath(marker_key, get_group_prefix(upload, group_index)))
+    
+    return data.UPLOAD_TILES_KEY.format(id=upload.id, zxy=zxy)
+
+def reduce_tile_group(storage, upload, group_index, tile_keys):
+    ''' Merge one group of tile outputs into a single partial sum output.
+    
+        Partial sums look like tile outputs, so the observer reads them
+        the same way, and are rounded like them by tiles.round_tile_totals().
+        Timings and errors are carried along for the observer.
+    '''
+    partial_totals, timings, errors = {}, {}, {}
+    
+    with concurrent.futures.ThreadPoolExecutor(constants.OBSERVE_FETCH_THREADS) as executor:
+        for tile_output in executor.map(lambda key: fetch_tile_output(storage, key), tile_keys):
+            timings.update(tile_output.get('timings') or {})
+            errors.update(tile_output.get('errors') or {})
+            
+            if type(tile_output.get('totals')) is dict:
+                tiles.add_batch_totals(partial_totals, tile_output['totals'])
+            else:
+                # Failed batches list their tile errors already
+                print('reduce_tile_group: weird tile:', repr(tile_output.get('totals')))
+    
+    storage.s3.put_object(Bucket=storage.bucket,
+        Key=data.UPLOAD_PARTIALS_KEY.format(id=upload.id, group=group_index),
+        Body=json.dumps(dict(totals=tiles.round_tile_totals(partial_totals), timings=timings, errors=errors,
+            tiles=sorted(tile_keys)), default=tiles.list_array).encode('utf8'),
+        ContentType='text/plain', ACL='public-read')
+
+def record_tile_completion(storage, upload, tile_zxy, group):
+    ''' Note a newly-written tile output, and merge its group after the last one.
+    
+        Each tile Lambda writes a completion marker under its group's prefix,
+        so listing one group counts its completed tiles without a shared
+        counter to update. The last tile in a group merges it into a partial
+        sum, then invokes the observer for provisional scores so far, or for
+        final scores once every partial sum exists. Nothing is merged for an
+        upload already finished or given up on. Returns true if this
+        completion merged its group.
+    '''
+    storage.s3.put_object(Bucket=storage.bucket, Body=b'',
+        Key=data.UPLOAD_GROUP_TILES_KEY.format(id=upload.id, group=group['index'], zxy=tile_zxy))
+    
+    marker_keys = list_completed_keys(storage, get_group_prefix(upload, group['index']))
+    
+    if len(marker_keys) < group['size']:
+        return False
+    
+    if is_upload_stopped(load_upload_index(storage, upload)):
+        # Duplicate tile finishing late, see planscore.tiles.lambda_handler()
+        print('record_tile_completion: upload', upload.id, 'already finished or given up on')
+        return False
+    
+    reduce_tile_group(storage, upload, group['index'],
+        [get_group_tile(key, upload, group['index']) for key in marker_keys])
+    
+    partial_keys = list_completed_keys(storage, get_partials_prefix(upload))
+    
+    if len(partial_keys) < group['count']:
+        invoke_observer_lambda(storage, upload, provisional=True)
+    else:
+        # Groups finishing together may both invoke it, see lambda_handler()
+        print('record_tile_completion: all', group['count'], 'groups merged')
+        invoke_observer_lambda(storage, upload)
+    
+    return True
+
+def get_partials_prefix(upload):
+    ''' Return S3 prefix for partial sums of tile output groups.
+    '''
+    return posixpath.dirname(data.UPLOAD_PARTIALS_KEY.format(id=upload.id, group='-')) + '/'
+
+def put_provisional_upload(storage, upload, progress, index_etag=None):
+    ''' Publish an upload with provisional scores and progress so far.
+    
+        Only the JSON index is replaced, and only after reading it again here.
+        It is left alone if it changed since it was read with index_etag,
+        was given up on, or shows complete or further progress, so a final or
+        overdue index is never replaced even by an S3 that ignores conditional
+        writes, such as localstack. The write is also an S3 conditional write
+        that fails if the index changed since this last read. Returns true
+        if published.
+    '''
+    index_upload, current_etag = load_upload_index_etag(storage, upload)
+    
+    if index_etag is not None and current_etag != index_etag:
+        print('put_provisional_upload: index changed, not replacing it')
+        return False
+    
+    if is_upload_given_up(index_upload) or (index_upload.progress
+        and (index_upload.progress.is_complete()
+        or index_upload.progress.completed > progress.completed)):
+        print('put_provisional_upload: index is ahead, not replacing it')
+        return False
+    
+    provisional_upload = upload.clone(progress=progress,
+        message='Scoring this newly-uploaded plan. {} complete{}. Reload this page'
+            ' to see the result.'.format(progress.to_percentage(),
+            ', scores shown are provisional' if upload.summary else ''))
+    
+    print('put_provisional_upload: {}/{} complete'.format(*progress.to_list()))
+    
+    if not put_conditional_object(storage.s3, 'If-Match', current_etag,
+        Bucket=storage.bucket, Key=provisional_upload.index_key(),
+        Body=provisional_upload.to_json().encode('utf8'),
+        ContentType='text/json', ACL='public-read'):
+        print('put_provisional_upload: index changed, not replacing it')
+        return False
+    
+    return True
+
+def get_tile_event(storage, upload, tile_batches, batch_index):
+    ''' Return tile Lambda event for one batch of tile keys.
+    
+        Events carry a reference to the upload rather than all of it, and
+        the batch's group of tile outputs to be merged.
+    '''
+    return dict(upload=upload.to_reference(), storage=storage.to_event(),
+        tile_keys=tile_batches[batch_index],
+        group=get_reduce_group(batch_index, len(tile_batches)))
+
+def get_batch_marker(upload, tile_batches, batch_index):
+    ''' Return group completion marker key for one batch of tile keys.
+    '''
+    group = get_reduce_group(batch_index, len(tile_batches))
+    tile_zxy = tiles.get_tile_zxy(upload.model.key_prefix, tile_batches[batch_index][0])
+    
+    return data.UPLOAD_GROUP_TILES_KEY.format(id=upload.id, group=group['index'], zxy=tile_zxy)
+
+def load_tile_dispatch(storage, upload):
+    ''' Get dictionary of dispatch time, attempts, and cost for each tile batch index.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket,
+        Key=data.UPLOAD_DISPATCH_KEY.format(id=upload.id))
+    
+    return {int(index): dispatch for (index, dispatch) in json.load(object['Body']).items()}
+
+def put_tile_dispatch(storage, upload, tile_dispatch):
+    ''' Save dictionary of dispatch time, attempts, and cost for each tile batch index.
+    '''
+    storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
+        Key=data.UPLOAD_DISPATCH_KEY.format(id=upload.id), ContentType='text/json',
+        Body=json.dumps(tile_dispatch, sort_keys=True).encode('utf8'))
+
+def get_straggler_deadline(dispatch):
+    ''' Return time after which a dispatched tile batch counts as a straggler.
+    
+        Batches that were never accepted by Lambda are due immediately,
+        and no batch is given longer than the tile Lambda timeout.
+    '''
+    if dispatch.get('time') is None:
+        return 0
+    
+    expected_seconds = dispatch.get('cost') or constants.TILE_BATCH_COST
+    
+    return dispatch['time'] + min(constants.TILE_TIMEOUT_SECONDS, max(
+        constants.STRAGGLER_MIN_SECONDS, constants.STRAGGLER_FACTOR * expected_seconds))
+
+def redispatch_stragglers(storage, upload, tile_batches, tile_dispatch, outstanding, now):
+    ''' Invoke tile Lambdas again for straggling batches, return next deadline or None.
+    
+        None means that every outstanding batch is overdue after its last
+        attempt. Failed invocations count as attempts too, so the next
+        deadline backs off and a batch that can never be invoked is given
+        up on. Batches with a failed tile never finish, so they are retried
+        here too. Updates tile_dispatch in place. Duplicate outputs are
+        harmless, see planscore.tiles.lambda_handler().
+    '''
+    lam = boto3.client('lambda', endpoint_url=constants.LAMBDA_ENDPOINT_URL)
+    next_deadline = None
+    
+    for batch_index in outstanding:
+        dispatch = tile_dispatch.setdefault(batch_index, dict(time=None, attempts=0))
+        
+        if get_straggler_deadline(dispatch) < now:
+            if dispatch['attempts'] > constants.STRAGGLER_MAX_ATTEMPTS:
+                # Overdue after the last attempt
+                continue
+            
+            payload = get_tile_event(storage, upload, tile_batches, batch_index)
+            print('redispatch_stragglers: batch', batch_index, 'after', dispatch['attempts'], 'attempts')
+            
+            try:
+                lam.invoke(FunctionName=tiles.FUNCTION_NAME, InvocationType='Event',
+                    Payload=json.dumps(payload).encode('utf8'))
+            except botocore.exceptions.ClientError as error:
+                # Throttled or worse, try again after the next deadline
+                print('redispatch_stragglers: error', error)
+            
+            dispatch.update(time=now, attempts=dispatch['attempts'] + 1)
+        
+        deadline = get_straggler_deadline(dispatch)
+        next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+    
+    return next_deadline
+
+def put_overdue_upload(storage, upload, progress):
+    ''' Publish an upload that is being given up on after it took too long.
+    
+        The published message records the give-up, see is_upload_given_up().
+        Afterwards the watcher and observer stop, tile Lambdas skip their
+        batches, and provisional updates are no longer published.
+    '''
+    put_upload_index(storage, upload.clone(progress=progress, message=OVERDUE_MESSAGE))
+
+def merge_missing_groups(storage, upload, marker_keys, group_indexes):
+    ''' Merge groups of tile outputs whose last tile Lambda failed to merge them.
+    '''
+    for group_index in group_indexes:
+        group_prefix = get_group_prefix(upload, group_index)
+        print('merge_missing_groups: merging group', group_index)
+        reduce_tile_group(storage, upload, group_index, [get_group_tile(key, upload, group_index)
+            for key in marker_keys if key.startswith(group_prefix)])
+
+def watch_tile_batches(storage, upload, merge_time=None):
+    ''' Check once for tile batches that take much longer than expected.
+    
+        Straggling batches are dispatched again, and the next check is
+        scheduled for the next straggler deadline, until every group of
+        batches has been merged or the upload is finished or given up on.
+        Gives up once every outstanding batch is overdue after its last
+        attempt, or the upload is past constants.UPLOAD_TIME_LIMIT. Groups left unmerged by a failed tile Lambda are merged by a
+        check after merge_time, constants.STRAGGLER_MIN_SECONDS after all
+        batches were seen complete, and the observer invoked in its place.
     '''
-    return data.UPLOAD_TILES_KEY.format(id=upload.id,
-        zxy=tiles.get_tile_zxy(upload.model.key_prefix, enqueued_key))
+    upload1, tile_batches = load_tile_index(storage, upload)
+    
+    if is_upload_stopped(load_upload_index(storage, upload1)):
+        print('watch_tile_batches: upload', upload1.id, 'already finished or given up on')
+        return
+    
+    marker_keys = list_completed_keys(storage, get_markers_prefix(upload1))
+    batch_markers = [get_batch_marker(upload1, tile_batches, index)
+        for index in range(len(tile_batches))]
+    outstanding = [index for (index, key) in enumerate(batch_markers) if key not in marker_keys]
+    now = time.time()
+    
+    if outstanding:
+        if upload1.is_overdue():
+            next_deadline = None
+        else:
+            tile_dispatch = load_tile_dispatch(storage, upload1)
+            next_deadline = redispatch_stragglers(storage, upload1, tile_batches,
+                tile_dispatch, outstanding, now)
+    
+        if next_deadline is None:
+            print('watch_tile_batches: giving up on', len(outstanding), 'tile batches')
+            put_overdue_upload(storage, upload1,
+                data.Progress(len(batch_markers) - len(outstanding), len(batch_markers)))
+            return
+        
+        put_tile_dispatch(storage, upload1, tile_dispatch)
+        schedule_watch(storage, upload1, next_deadline - now)
+        return
+    
+    group_count = get_reduce_group(0, len(tile_batches))['count']
+    partial_keys = list_completed_keys(storage, get_partials_prefix(upload1))
+    missing_groups = [index for index in range(group_count) if
+        data.UPLOAD_PARTIALS_KEY.format(id=upload1.id, group=index) not in partial_keys]
+    
+    if not missing_groups:
+        print('watch_tile_batches: all tile groups merged')
+        return
+    
+    if merge_time is None:
+        # Give the last tile Lambda of each group a chance to merge it
+        merge_time = now + constants.STRAGGLER_MIN_SECONDS
+    
+    if now < merge_time:
+        schedule_watch(storage, upload1, merge_time - now, merge_time)
+        return
+    
+    merge_missing_groups(storage, upload1, marker_keys, missing_groups)
+    invoke_observer_lambda(storage, upload1)
 
 def get_district_index(geometry_key, upload):
     ''' Return numeric index for a given geometry key.
@@ -36,24 +439,10 @@ def get_district_index(geometry_key, upload):
 def load_upload_geometries(storage, upload):
     ''' Get ordered list of OGR geometries for an upload.
     '''
-    geometries = {}
+    geometries = tiles.load_upload_geometries(storage, upload)
     
-    geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
-    response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
-
-    geometry_keys = [object['Key'] for object in response['Contents']]
-    
-    for geometry_key in geometry_keys:
-        district_index = get_district_index(geometry_key, upload)
-        object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
-
-        if object.get('ContentEncoding') == 'gzip':
-            object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
-    
-        district_geom = osgeo.ogr.CreateGeometryFromWkt(object['Body'].read().decode('utf8'))
-        geometries[district_index] = district_geom
-    
-    return [geom for (_, geom) in sorted(geometries.items())]
+    return [geometries[key] for key in
+        sorted(geometries, key=lambda key: get_district_index(key, upload))]
 
 def populate_compactness(geometries):
     '''
@@ -63,51 +452,176 @@ def populate_compactness(geometries):
     
     return districts
 
-def iterate_tile_totals(expected_tiles, storage, upload, context):
+def list_completed_keys(storage, prefix):
+    ''' Return set of keys already written under an S3 prefix.
     '''
-    '''
-    next_update = time.time()
+    marker, keys = '', set()
+    
+    while True:
+        response = storage.s3.list_objects(Bucket=storage.bucket,
+            Prefix=prefix, Marker=marker)
+        
+        contents = response.get('Contents', [])
+        keys.update(object['Key'] for object in contents)
+        
+        if not response.get('IsTruncated') or not contents:
+            break
+        
+        marker = contents[-1]['Key']
+    
+    return keys
 
-    # Look for each expected tile in turn
-    for (index, expected_tile) in enumerate(expected_tiles):
-        progress = data.Progress(index, len(expected_tiles))
-        upload = upload.clone(progress=progress,
-            message='Scoring this newly-uploaded plan. {} complete.'
-                ' Reload this page to see the result.'.format(progress.to_percentage()))
+def fetch_tile_output(storage, tile_key):
+    ''' Get parsed output of one tile Lambda.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket, Key=tile_key)
 
-        # Update S3, if it's time
-        if time.time() > next_update:
-            print('iterate_tile_totals: {}/{} tiles complete'.format(*progress.to_list()))
-            put_upload_index(storage, upload)
-            next_update = time.time() + 1
+    if object.get('ContentEncoding') == 'gzip':
+        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+    
+    return json.load(object['Body'])
 
-        # Wait for one expected tile
-        while True:
-            try:
-                object = storage.s3.get_object(Bucket=storage.bucket, Key=expected_tile)
-            except botocore.exceptions.ClientError:
-                # Did not find the expected tile, wait a little before checking
-                time.sleep(3)
-            else:
-                if object.get('ContentEncoding') == 'gzip':
-                    object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
-        
-                yield json.load(object['Body']).get('totals')
+def iterate_tile_totals(expected_tiles, storage, upload, context, timings=None, consumed=None):
+    ''' Generate totals for expected tiles in whatever order they complete.
+    
+        Completed tiles are found by listing the prefix shared by all expected
+        tile keys, and fetched over a pool of threads. Measured tile runtimes
+        are added to a timings dictionary if given. Keys of tiles already
+        generated are added to a consumed set if given, and tiles already in
+        it are skipped. Stops early when the Lambda context is running out
+        of time or the upload was given up on, leaving remaining tiles out
+        of the consumed set.
+    '''
+    consumed = set() if consumed is None else consumed
+    pending = [tile_key for tile_key in expected_tiles if tile_key not in consumed]
+    prefix = posixpath.commonpath([posixpath.dirname(key) for key in expected_tiles] or ['']) + '/'
+    
+    with concurrent.futures.ThreadPoolExecutor(constants.OBSERVE_FETCH_THREADS) as executor:
+        while pending:
+            completed_tiles = list_completed_keys(storage, prefix)
+            ready_tiles = [tile_key for tile_key in pending if tile_key in completed_tiles]
+            pending = [tile_key for tile_key in pending if tile_key not in completed_tiles]
             
-                # Found the expected tile, break out of this loop
+            futures = {executor.submit(fetch_tile_output, storage, tile_key): tile_key
+                for tile_key in ready_tiles}
+            
+            for future in concurrent.futures.as_completed(futures):
+                tile_output = future.result()
+                
+                if timings is not None:
+                    timings.update(tile_output.get('timings') or {})
+                
+                yield tile_output.get('totals')
+                consumed.add(futures[future])
+            
+            if not pending:
                 break
 
             remain_msec = context.get_remaining_time_in_millis()
 
             if remain_msec < 5000:
-                # Out of time, just stop
-                overdue_upload = upload.clone(message="Giving up on this plan after it took too long, sorry.")
-                put_upload_index(storage, overdue_upload)
+                # Out of time, stop so the caller can save a checkpoint
+                print('iterate_tile_totals: out of time with', len(pending), 'tiles pending')
                 return
+            
+            if not ready_tiles:
+                if is_upload_stopped(load_upload_index(storage, upload)):
+                    print('iterate_tile_totals: upload', upload.id, 'given up on')
+                    return
+                
+                # Nothing new finished, wait a little before checking
+                time.sleep(3)
 
     print('iterate_tile_totals: all tiles complete')
 
-def accumulate_district_totals(tile_totals, upload):
+def load_observer_checkpoint(storage, upload):
+    ''' Get saved district totals, consumed tiles, and timings for an upload, or None.
+    '''
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket,
+            Key=data.UPLOAD_CHECKPOINT_KEY.format(id=upload.id))
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    
+    checkpoint = json.load(object['Body'])
+    checkpoint['consumed'] = set(checkpoint['consumed'])
+    
+    return checkpoint
+
+def put_observer_checkpoint(storage, upload, districts, consumed, timings):
+    ''' Save unfinished district totals, consumed tiles, and timings for an upload.
+    
+        District totals are saved as accumulated, before any final adjustments.
+    '''
+    checkpoint = dict(districts=districts, consumed=sorted(consumed), timings=timings)
+    
+    storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
+        Key=data.UPLOAD_CHECKPOINT_KEY.format(id=upload.id), ContentType='text/json',
+        Body=json.dumps(checkpoint, default=tiles.list_array).encode('utf8'))
+
+def load_model_costs(storage, model):
+    ''' Get dictionary of measured seconds per district for each model tile.
+    '''
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket,
+            Key=data.MODEL_COSTS_KEY.format(prefix=model.key_prefix.rstrip('/')))
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise
+    
+    return json.load(object['Body'])
+
+def update_model_costs(model_costs, timings):
+    ''' Return new model costs blended with measured tile timings.
+    
+        Runtimes are divided by the number of districts scored, because
+        the same tile costs more when more districts cross it.
+    '''
+    costs, weight = dict(model_costs), constants.TILE_COST_WEIGHT
+    
+    for (tile_key, timing) in timings.items():
+        if not timing.get('districts'):
+            continue
+        
+        seconds = timing['seconds'] / timing['districts']
+        
+        if tile_key in costs:
+            costs[tile_key] = (1 - weight) * costs[tile_key] + weight * seconds
+        else:
+            costs[tile_key] = seconds
+    
+    return costs
+
+def put_model_costs(storage, upload, timings):
+    ''' Save measured tile runtimes to the model costs used for scheduling.
+    
+        Timings are first saved for the upload itself with an S3 conditional
+        write that fails if they already exist, so an observer invoked twice
+        for one upload blends them into the model costs only once. Concurrent
+        uploads of one model may overwrite each other's measurements, which
+        is fine for a running estimate.
+    '''
+    if not timings:
+        return
+    
+    if not put_conditional_object(storage.s3, 'If-None-Match', '*',
+        Bucket=storage.bucket, Key=data.UPLOAD_TIMINGS_KEY.format(id=upload.id),
+        Body=json.dumps(timings, sort_keys=True).encode('utf8'),
+        ContentType='text/json', ACL='bucket-owner-full-control'):
+        print('put_model_costs: already recorded timings for', upload.id)
+        return
+    
+    model = upload.model
+    costs = update_model_costs(load_model_costs(storage, model), timings)
+    
+    storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
+        Key=data.MODEL_COSTS_KEY.format(prefix=model.key_prefix.rstrip('/')),
+        Body=json.dumps(costs, sort_keys=True).encode('utf8'), ContentType='text/json')
+
+def start_district_totals(upload):
     ''' Return new district array for an upload, preserving existing values.
     '''
     districts = []
@@ -131,23 +645,103 @@ def accumulate_district_totals(tile_totals, upload):
 
         districts.append(new_district)
     
-    # update districts with tile totals
+    return districts
+
+def add_tile_totals(districts, tile_total, upload):
+    ''' Update district array in place with totals from one tile.
+    '''
+    if type(tile_total) is str:
+        # Not unheard-of
+        print('weird tile:', repr(tile_total))
+        return
+        
+    for (geometry_key, input_values) in tile_total.items():
+        geometry_index = get_district_index(geometry_key, upload)
+        district = districts[geometry_index]['totals']
+        for (key, value) in input_values.items():
+            if key in score.SIMULATION_FIELDS:
+                district[key] = numpy.add(district[key], value)
+            else:
+                district[key] += value
+
+def accumulate_district_totals(tile_totals, upload, districts=None):
+    ''' Return finished district array with totals from a sequence of tiles.
+    
+        An unfinished district array from start_district_totals() may be
+        given, and is updated in place.
+    '''
+    districts = start_district_totals(upload) if districts is None else districts
+    
     for tile_total in tile_totals:
-        if type(tile_total) is str:
-            # Not unheard-of
-            print('weird tile:', repr(tile_total))
-            continue
-            
-        for (geometry_key, input_values) in tile_total.items():
-            geometry_index = get_district_index(geometry_key, upload)
-            district = districts[geometry_index]['totals']
-            for (key, value) in input_values.items():
-                district[key] = round(district[key] + value, constants.ROUND_COUNT)
+        add_tile_totals(districts, tile_total, upload)
     
-    for district in districts:
-        district['totals'] = adjust_household_income(district['totals'])
+    return finish_district_totals(districts)
+
+def finish_district_totals(districts):
+    ''' Return district array with final adjustments to accumulated totals.
+    '''
+    return [dict(district, totals=round_totals(adjust_household_income(district['totals'])))
+        for district in districts]
+
+def score_provisional_upload(upload, districts):
+    ''' Return upload with scores for districts accumulated from some tiles.
     
-    return districts
+        Scores use the same functions as the final result but are marked
+        provisional, and left out while some districts have no simulated
+        votes yet or scores are undefined.
+    '''
+    partial_upload = upload.clone(districts=finish_district_totals(districts))
+    first_totals = partial_upload.districts[0]['totals']
+    simulation_names = [name for name in score.SIMULATION_FIELDS if name in first_totals]
+
+    if all(name in district['totals'] for district in partial_upload.districts
+        for name in simulation_names):
+        scored_upload = score.calculate_biases(score.calculate_bias(partial_upload))
+        summary = dict(scored_upload.summary, Provisional=True)
+    else:
+        # Districts with no tiles yet can't be scored
+        scored_upload, summary = partial_upload, dict(Provisional=True)
+
+    try:
+        # Missing votes in some districts can lead to undefined scores
+        json.dumps(summary, allow_nan=False)
+    except ValueError:
+        scored_upload, summary = partial_upload, dict(Provisional=True)
+
+    # Simulation arrays are removed from every district, scored or not
+    scored_districts = [dict(district, totals={k: v for (k, v) in district['totals'].items()
+        if k not in score.SIMULATION_FIELDS}) for district in scored_upload.districts]
+
+    return scored_upload.clone(districts=scored_districts, summary=summary)
+
+def publish_provisional_scores(storage, upload, tile_batches):
+    ''' Publish progress and provisional scores from partial sums merged so far.
+    
+        Runs in the observer for each merged group before the last one, see
+        record_tile_completion(), so tile Lambdas never score. The index is
+        read before partial sums are listed, so put_provisional_upload()
+        rejects this update if any other was published meanwhile.
+    '''
+    index_upload, index_etag = load_upload_index_etag(storage, upload)
+    
+    if is_upload_stopped(index_upload):
+        print('publish_provisional_scores: upload', upload.id, 'already finished or given up on')
+        return
+    
+    partial_keys = sorted(list_completed_keys(storage, get_partials_prefix(upload)))
+    marker_keys = list_completed_keys(storage, get_markers_prefix(upload))
+    
+    with concurrent.futures.ThreadPoolExecutor(constants.OBSERVE_FETCH_THREADS) as executor:
+        partial_totals = [partial.get('totals') for partial in
+            executor.map(lambda key: fetch_tile_output(storage, key), partial_keys)]
+    
+    districts = start_district_totals(upload)
+    
+    for tile_total in partial_totals:
+        add_tile_totals(districts, tile_total, upload)
+    
+    put_provisional_upload(storage, score_provisional_upload(upload, districts),
+        data.Progress(len(marker_keys), len(tile_batches)), index_etag)
 
 def adjust_household_income(input_totals):
     '''
@@ -161,25 +755,97 @@ def adjust_household_income(input_totals):
     
     return totals
 
-def lambda_handler(event, context):
+def round_totals(input_totals):
+    ''' Return totals with plain values rounded for publishing.
+    
+        This is the last of three rounding stages, see tiles.round_tile_totals().
+        Simulated votes are left as summed for scoring.
     '''
+    return {name: value if (name in score.SIMULATION_FIELDS)
+        else round(value, constants.ROUND_COUNT) for (name, value) in input_totals.items()}
+
+def lambda_handler(event, context):
+    ''' Score an upload from partial sums of tile outputs.
+    
+        Invoked by record_tile_completion() once every group of tiles is
+        merged, or by planscore.after_upload when there are no tiles. Groups
+        merged before the last invoke it for provisional scores instead, see
+        publish_provisional_scores(). Groups merged at once may invoke it
+        more than once, so it does nothing for an upload already finished,
+        and records tile timings once. When
+        running out of time, saves a checkpoint and invokes itself to continue
+        from it without reading any partial sum twice, giving up after
+        constants.OBSERVE_MAX_CONTINUATIONS. Messages from the watch queue
+        are handled by watch_tile_batches() instead, see schedule_watch().
     '''
     s3 = boto3.client('s3', endpoint_url=constants.S3_ENDPOINT_URL)
+    
+    if 'Records' in event:
+        for record in event['Records']:
+            watch_event = json.loads(record['body'])
+            watch_tile_batches(data.Storage.from_event(watch_event['storage'], s3),
+                data.Upload.from_dict(watch_event['upload']), watch_event.get('merge_time'))
+        return
+    
     storage = data.Storage.from_event(event['storage'], s3)
-    upload1 = data.Upload.from_dict(event['upload'])
+    continuation = event.get('continuation', 0)
+    
+    upload1, enqueued_tiles = load_tile_index(storage, data.Upload.from_dict(event['upload']))
+    
+    if event.get('provisional'):
+        publish_provisional_scores(storage, upload1, enqueued_tiles)
+        return
+    
+    if is_upload_stopped(load_upload_index(storage, upload1)):
+        print('lambda_handler: upload', upload1.id, 'already finished or given up on')
+        return
+    
+    # Tile outputs were merged into partial sums, see record_tile_completion()
+    group_count = get_reduce_group(0, len(enqueued_tiles))['count']
+    expected_tiles = [data.UPLOAD_PARTIALS_KEY.format(id=upload1.id, group=index)
+        for index in range(group_count)]
     
-    obj = storage.s3.get_object(Bucket=storage.bucket,
-        Key=data.UPLOAD_TILE_INDEX_KEY.format(id=upload1.id))
+    checkpoint = load_observer_checkpoint(storage, upload1)
+    
+    if checkpoint:
+        print('lambda_handler: continuing from', len(checkpoint['consumed']), 'tiles')
+        upload2 = upload1.clone(districts=checkpoint['districts'])
+        consumed, timings = checkpoint['consumed'], checkpoint['timings']
+    elif all(district and 'compactness' in district for district in upload1.districts):
+        # Compactness was scored during upload, see planscore.after_upload
+        upload2, consumed, timings = upload1, set(), {}
+    else:
+        geometries = load_upload_geometries(storage, upload1)
+        upload2 = upload1.clone(districts=populate_compactness(geometries))
+        consumed, timings = set(), {}
+    
+    districts = start_district_totals(upload2)
+    tile_totals = iterate_tile_totals(expected_tiles, storage, upload2, context, timings, consumed)
+    finished_districts = accumulate_district_totals(tile_totals, upload2, districts)
+    
+    if len(consumed) < len(expected_tiles):
+        progress = data.Progress(len(consumed), len(expected_tiles))
+        
+        if continuation >= constants.OBSERVE_MAX_CONTINUATIONS:
+            put_overdue_upload(storage, upload1, progress)
+            return
+        
+        if is_upload_stopped(load_upload_index(storage, upload1)):
+            # Given up on by the watcher while this invocation ran
+            print('lambda_handler: upload', upload1.id, 'given up on, not continuing')
+            return
+        
+        put_observer_checkpoint(storage, upload2, districts, consumed, timings)
+        invoke_observer_lambda(storage, upload1, continuation + 1)
+        return
     
-    enqueued_tiles = json.load(obj['Body'])
-    expected_tiles = [get_expected_tile(tile_key, upload1)
-        for tile_key in enqueued_tiles]
+    if is_upload_finished(load_upload_index(storage, upload1)):
+        # Another observer of the same tiles finished first
+        print('lambda_handler: upload', upload1.id, 'already finished')
+        return
     
-    geometries = load_upload_geometries(storage, upload1)
-    upload2 = upload1.clone(districts=populate_compactness(geometries))
-    tile_totals = iterate_tile_totals(expected_tiles, storage, upload2, context)
-    districts = accumulate_district_totals(tile_totals, upload2)
-    upload3 = upload2.clone(districts=districts)
+    put_model_costs(storage, upload2, timings)
+    upload3 = upload2.clone(districts=finished_districts)
     upload4 = score.calculate_bias(upload3)
     upload5 = score.calculate_biases(upload4)
 
@@ -1,7 +1,7 @@
-import argparse, math, itertools, io, gzip, os, json, tempfile
+import argparse, math, itertools, io, gzip, os, json, tempfile, collections
 from osgeo import ogr, osr
 import boto3, ModestMaps.Geo, ModestMaps.Core
-from . import constants
+from . import constants, bundle, score
 
 TILE_ZOOM = 12
 MAX_FEATURE_COUNT = 1000 # ~20sec processing time per tile
@@ -9,6 +9,12 @@ MIN_TILE_ZOOM, MAX_TILE_ZOOM = 9, 14
 INDEX_FIELD = 'PlanScore:Index'
 FRACTION_FIELD = 'PlanScore:Fraction'
 KEY_FORMAT = 'data/{directory}/{zxy}.geojson'
+BUNDLE_EXTENSION = '.psb'
+BUNDLE_KEY_FORMAT = 'data/{directory}/{zxy}' + BUNDLE_EXTENSION
+MANIFEST_KEY_FORMAT = 'data/{directory}/manifest.json'
+
+# Household income is a median and can't be added up across precincts
+MANIFEST_TOTAL_FIELDS = [name for name in score.FIELD_NAMES if name != 'Household Income 2016']
 
 EPSG4326 = osr.SpatialReference(); EPSG4326.ImportFromEPSG(4326)
 
@@ -136,6 +142,64 @@ def feature_geojson(ogr_feature, properties):
     return ''.join(('{"type": "Feature", "properties": ', properties_json,
         ', "geometry": ', geometry_json, '}'))
 
+def feature_bundle_parts(ogr_feature, properties):
+    ''' Return properties dict, WKB, envelope, and simulations for an OGR feature and properties dict.
+    
+        Simulated vote fields are moved out of properties into a dictionary
+        of value lists, so they can be stored as quantized numeric blocks.
+    '''
+    ogr_properties = {field: ogr_feature.GetField(field)
+        for field in (INDEX_FIELD, FRACTION_FIELD)}
+    
+    simulations = {array_name: [properties[name] for name in field_names if name in properties]
+        for (array_name, field_names) in score.SIMULATION_FIELDS.items()}
+    
+    simulation_fields = {name for field_names in score.SIMULATION_FIELDS.values() for name in field_names}
+    
+    bundle_properties = {name: value for (name, value) in properties.items()
+        if name not in simulation_fields}
+    
+    bundle_properties.update(ogr_properties)
+    simulations = {name: values for (name, values) in simulations.items() if values}
+    geometry = ogr_feature.GetGeometryRef()
+    
+    if geometry is None or geometry.IsEmpty():
+        return bundle_properties, None, (math.nan, ) * 4, simulations
+    
+    return bundle_properties, geometry.ExportToWkb(), geometry.GetEnvelope(), simulations
+
+def count_vertices(geometry):
+    ''' Return number of vertices in an OGR geometry and all its parts.
+    '''
+    if geometry is None:
+        return 0
+    
+    if geometry.GetGeometryCount():
+        return sum(count_vertices(geometry.GetGeometryRef(index))
+            for index in range(geometry.GetGeometryCount()))
+    
+    return geometry.GetPointCount()
+
+def tile_manifest_entry(key, tile_zxy, size, bbox_geom, ogr_features, feature_properties):
+    ''' Return a dictionary of cost signals and totals for one written tile.
+    
+        Totals are sums of precinct fields weighted by the fraction
+        of each precinct excerpted into the tile.
+    '''
+    totals = collections.OrderedDict()
+    
+    for (ogr_feature, properties) in zip(ogr_features, feature_properties):
+        fraction = ogr_feature.GetField(FRACTION_FIELD)
+        
+        for name in MANIFEST_TOTAL_FIELDS:
+            if name in properties:
+                totals[name] = totals.get(name, 0) + (properties[name] or 0) \
+                    * (1 if fraction is None else fraction)
+    
+    return dict(key=key, zxy=tile_zxy, size=size, features=len(ogr_features),
+        vertices=sum(count_vertices(feature.GetGeometryRef()) for feature in ogr_features),
+        envelope=list(bbox_geom.GetEnvelope()), totals=totals)
+
 parser = argparse.ArgumentParser(description='YESS')
 
 parser.add_argument('filename', help='Name of geographic file with precinct data')
@@ -145,6 +209,8 @@ parser.add_argument('--zoom', type=int, default=TILE_ZOOM,
     help='Zoom level. Default {}.'.format(TILE_ZOOM))
 parser.add_argument('--s3', action='store_true',
     help='Upload to S3 instead of local directory')
+parser.add_argument('--format', choices=('bundle', 'geojson'), default='bundle',
+    help='Tile format, GeoJSON is larger and slower but readable for debugging. Default bundle.')
 
 def main():
     args = parser.parse_args()
@@ -156,6 +222,7 @@ def main():
     layer = ds.GetLayer(0)
     
     tile_stack = list(iter_extent_coords(layer.GetExtent(), MIN_TILE_ZOOM))
+    manifest_tiles = []
     
     while tile_stack:
         tile = tile_stack.pop(0)
@@ -180,32 +247,52 @@ def main():
             print(stack_str, 'Defer', tile_zxy)
             continue
 
-        features_json = []
-    
-        for feature in bbox_features:
-            ogr_feature = excerpt_feature(feature, bbox_geom)
-            feature_properties = properties[feature.GetField(INDEX_FIELD)]
-            features_json.append(feature_geojson(ogr_feature, feature_properties))
-        
-        if not features_json:
-            continue
-    
-        buffer = io.StringIO()
-        print('{"type": "FeatureCollection", "features": [', file=buffer)
-        print(',\n'.join(features_json), file=buffer)
-        print(']}', file=buffer)
-        
-        key = KEY_FORMAT.format(directory=args.directory, zxy=tile_zxy)
+        ogr_features = [excerpt_feature(feature, bbox_geom) for feature in bbox_features]
+        feature_properties = [properties[feature.GetField(INDEX_FIELD)] for feature in bbox_features]
+
+        if args.format == 'geojson':
+            features_json = [feature_geojson(ogr_feature, props) for (ogr_feature, props)
+                in zip(ogr_features, feature_properties)]
+            
+            buffer = io.StringIO()
+            print('{"type": "FeatureCollection", "features": [', file=buffer)
+            print(',\n'.join(features_json), file=buffer)
+            print(']}', file=buffer)
+            
+            key = KEY_FORMAT.format(directory=args.directory, zxy=tile_zxy)
+            content_type, body = 'text/json', buffer.getvalue().encode('utf8')
+        else:
+            parts = [feature_bundle_parts(ogr_feature, props) for (ogr_feature, props)
+                in zip(ogr_features, feature_properties)]
+            
+            key = BUNDLE_KEY_FORMAT.format(directory=args.directory, zxy=tile_zxy)
+            content_type, body = 'application/octet-stream', bundle.dumps(*zip(*parts))
         
         if args.s3:
-            body = gzip.compress(buffer.getvalue().encode('utf8'))
+            body = gzip.compress(body)
             print(stack_str, 'Write', key, '-', '{:.1f}KB'.format(len(body) / 1024))
     
             s3.put_object(Bucket=constants.S3_BUCKET, Key=key, Body=body,
-                ContentEncoding='gzip', ContentType='text/json', ACL='public-read')
+                ContentEncoding='gzip', ContentType=content_type, ACL='public-read')
         else:
             os.makedirs(os.path.dirname(key), exist_ok=True)
             print(stack_str, 'Write', key)
     
-            with open(key, 'w') as file:
-                file.write(buffer.getvalue())
+            with open(key, 'wb') as file:
+                file.write(body)
+        
+        manifest_tiles.append(tile_manifest_entry(key, tile_zxy, len(body),
+            bbox_geom, ogr_features, feature_properties))
+    
+    key = MANIFEST_KEY_FORMAT.format(directory=args.directory)
+    body = json.dumps(dict(tiles=manifest_tiles), indent=1).encode('utf8')
+    print('Write', key, 'with', len(manifest_tiles), 'tiles')
+    
+    if args.s3:
+        s3.put_object(Bucket=constants.S3_BUCKET, Key=key, Body=gzip.compress(body),
+            ContentEncoding='gzip', ContentType='text/json', ACL='public-read')
+    else:
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        
+        with open(key, 'wb') as file:
+            file.write(body)
@@ -3,9 +3,9 @@
 When all districts are added up and present on S3, performs complete scoring
 of district plan and uploads summary JSON file.
 '''
-import io, os, gzip, posixpath, json, statistics, copy, time, itertools
+import io, os, gzip, posixpath, json, statistics, time, functools, collections, math
 from osgeo import ogr
-import boto3, botocore.exceptions
+import boto3, botocore.exceptions, numpy
 from . import data, constants
 
 ogr.UseExceptions()
@@ -52,9 +52,18 @@ FIELD_NAMES = (
     'US Senate 2016 - DEM', 'US Senate 2016 - REP'
     )
 
-# Fields for simulated election vote totals
-FIELD_NAMES += tuple([f'REP{sim:03d}' for sim in range(1000)])
-FIELD_NAMES += tuple([f'DEM{sim:03d}' for sim in range(1000)])
+# Fields for simulated election vote totals in model precincts, which are
+# carried through tiles and districts as one array per party instead.
+SIMULATION_FIELDS = {
+    'REP': tuple([f'REP{sim:03d}' for sim in range(1000)]),
+    'DEM': tuple([f'DEM{sim:03d}' for sim in range(1000)]),
+    }
+
+# Vote swings for dense curves, -15 to +15 points in 0.1 point steps
+SWING_CURVE_POINTS = numpy.linspace(-.15, .15, 301)
+
+# Largest swing × simulation × district array to compute at once
+SWING_CURVE_CHUNK_SIZE = 2**22
 
 def swing_vote(red_districts, blue_districts, amount):
     ''' Swing the vote by a percentage, positive toward blue.
@@ -127,6 +136,221 @@ def calculate_PB(red_districts, blue_districts):
     
     return blue_seatshare - blue_voteshare
 
+def swing_votes(reds, blues, amounts):
+    ''' Swing arrays of simulation × district votes, positive toward blue.
+    
+        Amounts may be a single percentage or one per simulation. Districts
+        with no votes stay at zero instead of being dropped as in swing_vote().
+    '''
+    amounts = numpy.reshape(amounts, (-1, 1)) if numpy.ndim(amounts) else amounts
+    totals = reds + blues
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        swung_reds = numpy.where(totals > 0, (reds/totals - amounts) * totals, 0)
+        swung_blues = numpy.where(totals > 0, (blues/totals + amounts) * totals, 0)
+    
+    # Leave unswung votes exactly as they were, like swing_vote()
+    swung_reds = numpy.where(amounts == 0, reds, swung_reds)
+    swung_blues = numpy.where(amounts == 0, blues, swung_blues)
+    
+    return swung_reds, swung_blues
+
+def calculate_EGs(reds, blues, vote_swing=0):
+    ''' Convert simulation × district vote arrays into an array of EG scores.
+    
+        Matches calculate_EG() for each simulation, with NaN for no votes.
+    '''
+    reds, blues = swing_votes(reds, blues, vote_swing)
+    totals = reds + blues
+    
+    # Winners waste their surplus, losers waste everything
+    wasted_reds = numpy.where(reds > blues, reds - totals/2, numpy.where(blues > reds, reds, 0))
+    wasted_blues = numpy.where(blues > reds, blues - totals/2, numpy.where(reds > blues, blues, 0))
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (wasted_reds.sum(axis=1) - wasted_blues.sum(axis=1)) / totals.sum(axis=1)
+
+def calculate_MMDs(reds, blues):
+    ''' Convert simulation × district vote arrays into an array of Mean-Median scores.
+    
+        Matches calculate_MMD() for each simulation.
+    '''
+    shares = numpy.sort(reds / (reds + blues), axis=1)
+    medians = shares[:, shares.shape[1]//2]
+    
+    return shares.mean(axis=1) - medians
+
+def calculate_PBs(reds, blues):
+    ''' Convert simulation × district vote arrays into an array of Partisan Bias scores.
+    
+        Matches calculate_PB() for each simulation.
+    '''
+    red_totals, blue_totals = reds.sum(axis=1), blues.sum(axis=1)
+    blue_margins = (blue_totals - red_totals) / (blue_totals + red_totals)
+    
+    reds_5050, blues_5050 = swing_votes(reds, blues, -blue_margins/2)
+    counted = (reds + blues) > 0
+    blue_seats = ((reds_5050 < blues_5050) & counted).sum(axis=1)
+    blue_seatshares = blue_seats / counted.sum(axis=1)
+    blue_voteshares = blue_totals / (blue_totals + red_totals)
+    
+    return blue_seatshares - blue_voteshares
+
+def calculate_declinations(reds, blues):
+    ''' Convert simulation × district vote arrays into an array of Declination scores.
+    
+        By convention, result is positive for blue and negative for red. Result
+        is NaN for simulations where one party wins every seat.
+    '''
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        shares = blues / (reds + blues)
+        blue_wins, red_wins = shares > .5, shares < .5
+        blue_seats, red_seats = blue_wins.sum(axis=1), red_wins.sum(axis=1)
+        seat_count = blue_seats + red_seats
+        
+        # Mean blue vote share in districts won by each party
+        blue_means = numpy.where(blue_wins, shares, 0).sum(axis=1) / blue_seats
+        red_means = numpy.where(red_wins, shares, 0).sum(axis=1) / red_seats
+    
+        blue_angles = numpy.arctan((2 * blue_means - 1) / (blue_seats / seat_count))
+        red_angles = numpy.arctan((1 - 2 * red_means) / (red_seats / seat_count))
+    
+    return 2 * (red_angles - blue_angles) / math.pi
+
+def calculate_seat_shares(reds, blues):
+    ''' Convert simulation × district vote arrays into an array of blue seat shares.
+    '''
+    return (blues > reds).sum(axis=1) / ((reds + blues) > 0).sum(axis=1)
+
+def calculate_vote_shares(reds, blues):
+    ''' Convert simulation × district vote arrays into an array of blue vote shares.
+    '''
+    return blues.sum(axis=1) / (reds + blues).sum(axis=1)
+
+# Registered metrics, each a kernel converting simulation × district vote
+# arrays into one value per simulation. Names are formatted with party names.
+METRICS = collections.OrderedDict()
+
+def register_metric(name, kernel):
+    ''' Add a metric kernel to the registry under a summary name.
+    '''
+    METRICS[name] = kernel
+    return kernel
+
+register_metric('Efficiency Gap', calculate_EGs)
+
+for points in (1, 2, 3, 4, 5):
+    register_metric(f'Efficiency Gap +{points} {{Dem}}',
+        functools.partial(calculate_EGs, vote_swing=points/100))
+    register_metric(f'Efficiency Gap +{points} {{Rep}}',
+        functools.partial(calculate_EGs, vote_swing=-points/100))
+
+register_metric('Mean-Median', calculate_MMDs)
+register_metric('Partisan Bias', calculate_PBs)
+register_metric('Declination', calculate_declinations)
+register_metric('Seat Share', calculate_seat_shares)
+register_metric('Vote Share', calculate_vote_shares)
+
+def calculate_metrics(reds, blues):
+    ''' Evaluate all registered metrics over simulation × district vote arrays.
+    
+        Returns a dictionary of per-simulation arrays keyed by metric name.
+    '''
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return {name: kernel(reds, blues) for (name, kernel) in METRICS.items()}
+
+def summarize_metric(values):
+    ''' Return mean and standard deviation of finite metric values, or None.
+    '''
+    finite_values = values[numpy.isfinite(values)]
+    mean = float(finite_values.mean()) if len(finite_values) > 0 else None
+    stdev = float(finite_values.std(ddof=1)) if len(finite_values) > 1 else None
+    
+    return mean, stdev
+
+def swing_shares(blue_shares, statewide_shares, amounts, proportional):
+    ''' Swing blue district vote shares, positive toward blue.
+    
+        Uniform swing adds the same amount to every district, unclipped like
+        swing_votes(), so curves agree with "Efficiency Gap +N" metrics even
+        for lopsided districts. Proportional swing shrinks the losing party's
+        vote in each district by the same fraction, so statewide share moves
+        by exactly the amount, clipped to 0-1 for swings past a sweep.
+    '''
+    if not proportional:
+        return blue_shares + amounts
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        red_fractions = (1 - statewide_shares - amounts) / (1 - statewide_shares)
+        blue_fractions = (statewide_shares + amounts) / statewide_shares
+    
+    # Linear in district share: offset + scale × share
+    offsets = numpy.where(amounts > 0, 1 - red_fractions, 0)
+    scales = numpy.where(amounts > 0, red_fractions, blue_fractions)
+    shares = blue_shares * scales + offsets
+    
+    numpy.maximum(shares, 0, out=shares)
+    numpy.minimum(shares, 1, out=shares)
+    
+    return shares
+
+def calculate_swing_curves(reds, blues, swings=SWING_CURVE_POINTS, proportional=False):
+    ''' Calculate seats-votes and EG-vs-swing curves over a range of vote swings.
+    
+        Accepts district vote arrays for one plan or simulation × district
+        arrays, and returns swing × simulation arrays of blue vote share,
+        blue seat share, and EG positive for blue.
+    '''
+    reds, blues = numpy.atleast_2d(reds).astype(float), numpy.atleast_2d(blues).astype(float)
+    totals = reds + blues
+    counted, election_votes = (totals > 0).astype(float), totals.sum(axis=1)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        blue_shares = numpy.where(totals > 0, blues / totals, 0)
+    
+    statewide_shares = (blues.sum(axis=1) / election_votes).reshape(-1, 1)
+    curves = {'Vote Share': [], 'Seat Share': [], 'Efficiency Gap': []}
+    chunk = max(1, SWING_CURVE_CHUNK_SIZE // totals.size)
+    
+    # Broadcast a chunk of swings along a new first axis
+    for start in range(0, len(swings), chunk):
+        amounts = numpy.reshape(swings[start:start+chunk], (-1, 1, 1))
+        shares = swing_shares(blue_shares, statewide_shares, amounts, proportional)
+        blue_votes = numpy.einsum('wsd,sd->ws', shares, totals)
+        
+        # Count blue wins, with ties counted as half
+        blue_wins, ties = shares > .5, shares == .5
+        blue_seats = numpy.einsum('wsd,sd->ws', blue_wins, counted)
+        blue_win_votes = numpy.einsum('wsd,sd->ws', blue_wins, totals)
+        
+        if ties.any():
+            blue_seats += numpy.einsum('wsd,sd->ws', ties, counted) / 2
+            blue_win_votes += numpy.einsum('wsd,sd->ws', ties, totals) / 2
+        
+        # Total wasted red minus blue votes works out to ½T - 2B for red
+        # wins and ½T - 2B + T for blue wins, and zero for ties.
+        wasted_votes = election_votes/2 - 2 * blue_votes + blue_win_votes
+
+        curves['Vote Share'].append(blue_votes / election_votes)
+        curves['Seat Share'].append(blue_seats / counted.sum(axis=1))
+        curves['Efficiency Gap'].append(wasted_votes / election_votes)
+    
+    return {name: numpy.concatenate(arrays) for (name, arrays) in curves.items()}
+
+def summarize_swing_curves(reds, blues):
+    ''' Return summary dictionary of mean uniform and proportional swing curves.
+    '''
+    summary_dict = dict()
+    
+    for (prefix, proportional) in (('Uniform', False), ('Proportional', True)):
+        curves = calculate_swing_curves(reds, blues, proportional=proportional)
+        curve_dict = {'Swing': [round(float(swing), 3) for swing in SWING_CURVE_POINTS]}
+        curve_dict.update({name: [round(float(value), constants.ROUND_FLOAT)
+            for value in values.mean(axis=1)] for (name, values) in curves.items()})
+        summary_dict[f'{prefix} Swing Curve'] = curve_dict
+    
+    return summary_dict
+
 def calculate_bias(upload):
     ''' Calculate partisan metrics for districts with plain vote counts.
     '''
@@ -143,90 +367,57 @@ def calculate_bias(upload):
         if red_field not in first_totals or blue_field not in first_totals:
             continue
     
-        red_districts = [d['totals'].get(red_field) or 0 for d in upload.districts]
-        blue_districts = [d['totals'].get(blue_field) or 0 for d in upload.districts]
+        # Plain vote counts are scored like a single simulation
+        reds = numpy.array([[d['totals'].get(red_field) or 0 for d in upload.districts]], dtype=float)
+        blues = numpy.array([[d['totals'].get(blue_field) or 0 for d in upload.districts]], dtype=float)
 
-        if prefix == 'Red/Blue':
-            summary_dict['Mean-Median'] = calculate_MMD(red_districts, blue_districts)
-            summary_dict['Partisan Bias'] = calculate_PB(red_districts, blue_districts)
-            summary_dict['Efficiency Gap'] = calculate_EG(red_districts, blue_districts)
-
-            # Calculate -5 to +5 point swings
-            swings = itertools.product([1, 2, 3, 4, 5], [(.01, 'Blue'), (-.01, 'Red')])
-            for (points, (swing, party)) in swings:
-                gap = calculate_EG(red_districts, blue_districts, swing * points)
-                summary_dict[f'Efficiency Gap +{points:.0f} {party}'] = gap
-        else:
-            summary_dict[f'{prefix} Mean-Median'] = calculate_MMD(red_districts, blue_districts)
-            summary_dict[f'{prefix} Partisan Bias'] = calculate_PB(red_districts, blue_districts)
-            summary_dict[f'{prefix} Efficiency Gap'] = calculate_EG(red_districts, blue_districts)
-
-            # Calculate -5 to +5 point swings
-            swings = itertools.product([1, 2, 3, 4, 5], [(.01, 'Dem'), (-.01, 'Rep')])
-            for (points, (swing, party)) in swings:
-                gap = calculate_EG(red_districts, blue_districts, swing * points)
-                summary_dict[f'{prefix} Efficiency Gap +{points:.0f} {party}'] = gap
+        for (name, values) in calculate_metrics(reds, blues).items():
+            if prefix == 'Red/Blue':
+                key = name.format(Dem='Blue', Rep='Red')
+            else:
+                key = '{} {}'.format(prefix, name.format(Dem='Dem', Rep='Rep'))
+            
+            summary_dict[key], _ = summarize_metric(values)
+        
+        for (name, curve) in summarize_swing_curves(reds, blues).items():
+            key = name if (prefix == 'Red/Blue') else '{} {}'.format(prefix, name)
+            summary_dict[key] = curve
     
     return upload.clone(summary=summary_dict)
 
 def calculate_biases(upload):
     ''' Calculate partisan metrics for districts with multiple simulations.
     '''
-    MMDs, PBs = list(), list()
-    EGs = {swing: list() for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)}
-    summary_dict, copied_districts = dict(), copy.deepcopy(upload.districts)
-    first_totals = copied_districts[0]['totals']
+    summary_dict, first_totals = dict(), upload.districts[0]['totals']
     
-    if f'REP000' not in first_totals or f'DEM000' not in first_totals:
+    if 'REP' not in first_totals or 'DEM' not in first_totals:
         return upload.clone()
     
-    # Prepare place for simulation vote totals in each district
-    all_red_districts = [list() for d in copied_districts]
-    all_blue_districts = [list() for d in copied_districts]
-
-    # Iterate over all simulations, tracking EG and vote totals
-    for sim in range(1000):
-        if f'REP{sim:03d}' not in first_totals or f'DEM{sim:03d}' not in first_totals:
-            continue
-        
-        sim_red_districts, sim_blue_districts = list(), list()
-
-        for (i, district) in enumerate(copied_districts):
-            red_votes = district['totals'].pop(f'REP{sim:03d}')
-            blue_votes = district['totals'].pop(f'DEM{sim:03d}')
-            sim_red_districts.append(red_votes)
-            sim_blue_districts.append(blue_votes)
-            all_red_districts[i].append(red_votes)
-            all_blue_districts[i].append(blue_votes)
-    
-        MMDs.append(calculate_MMD(sim_red_districts, sim_blue_districts))
-        PBs.append(calculate_PB(sim_red_districts, sim_blue_districts))
-        
-        for swing in EGs:
-            EGs[swing].append(calculate_EG(sim_red_districts, sim_blue_districts, swing/100))
+    # Build simulation × district arrays of vote totals
+    reds = numpy.array([d['totals']['REP'] for d in upload.districts], dtype=float).T
+    blues = numpy.array([d['totals']['DEM'] for d in upload.districts], dtype=float).T
+    
+    # Copy districts without simulation arrays
+    copied_districts = [dict(district, totals={k: v for (k, v) in district['totals'].items()
+        if k not in SIMULATION_FIELDS}) for district in upload.districts]
     
     # Finalize per-district vote totals and confidence intervals
+    red_means, red_SDs = reds.mean(axis=0), reds.std(axis=0, ddof=1)
+    blue_means, blue_SDs = blues.mean(axis=0), blues.std(axis=0, ddof=1)
+
     for (i, district) in enumerate(copied_districts):
-        red_votes, blue_votes = all_red_districts[i], all_blue_districts[i]
         district['totals'].update({
-            'Democratic Votes': round(statistics.mean(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes': round(statistics.mean(red_votes), constants.ROUND_COUNT),
-            'Democratic Votes SD': round(statistics.stdev(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes SD': round(statistics.stdev(red_votes), constants.ROUND_COUNT)
+            'Democratic Votes': round(float(blue_means[i]), constants.ROUND_COUNT),
+            'Republican Votes': round(float(red_means[i]), constants.ROUND_COUNT),
+            'Democratic Votes SD': round(float(blue_SDs[i]), constants.ROUND_COUNT),
+            'Republican Votes SD': round(float(red_SDs[i]), constants.ROUND_COUNT)
             })
 
-    summary_dict['Mean-Median'] = statistics.mean(MMDs)
-    summary_dict['Mean-Median SD'] = statistics.stdev(MMDs)
-    summary_dict['Partisan Bias'] = statistics.mean(PBs)
-    summary_dict['Partisan Bias SD'] = statistics.stdev(PBs)
-    summary_dict['Efficiency Gap'] = statistics.mean(EGs[0])
-    summary_dict['Efficiency Gap SD'] = statistics.stdev(EGs[0])
-    
-    for swing in (1, 2, 3, 4, 5):
-        summary_dict[f'Efficiency Gap +{swing} Dem'] = statistics.mean(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep'] = statistics.mean(EGs[-swing])
-        summary_dict[f'Efficiency Gap +{swing} Dem SD'] = statistics.stdev(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep SD'] = statistics.stdev(EGs[-swing])
+    for (name, values) in calculate_metrics(reds, blues).items():
+        key = name.format(Dem='Dem', Rep='Rep')
+        summary_dict[key], summary_dict[f'{key} SD'] = summarize_metric(values)
     
-    rounded_summary_dict = {k: round(v, constants.ROUND_FLOAT) for (k, v) in summary_dict.items()}
+    rounded_summary_dict = {k: None if (v is None) else round(v, constants.ROUND_FLOAT)
+        for (k, v) in summary_dict.items()}
+    rounded_summary_dict.update(summarize_swing_curves(reds, blues))
     return upload.clone(districts=copied_districts, summary=rounded_summary_dict)
@@ -1,5 +1,6 @@
-import unittest, unittest.mock, io, os, contextlib
-from .. import after_upload, data, constants
+import unittest, unittest.mock, io, os, contextlib, gzip, json, time
+import numpy, botocore.exceptions
+from .. import after_upload, data, constants, bundle, tiles
 from osgeo import ogr
 
 class TestAfterUpload (unittest.TestCase):
@@ -183,8 +184,106 @@ class TestAfterUpload (unittest.TestCase):
         s3 = unittest.mock.Mock()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
-        keys = after_upload.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
-        self.assertEqual(keys, ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'])
+        geometries = after_upload.load_district_geometries(null_plan_path)
+        after_upload.put_district_geometries(s3, 'bucket-name', upload, geometries)
+        
+        self.assertEqual(len(s3.put_object.mock_calls), 1, 'Should write a single bundle')
+        put_kwargs = s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/geometries.psb')
+        
+        body = put_kwargs['Body']
+        if put_kwargs.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        
+        _, geometries, envelopes, _ = bundle.loads(body)
+        self.assertEqual(len(geometries), 2)
+        self.assertEqual(envelopes.shape, (2, 4))
+    
+    def test_get_tile_parents(self):
+        ''' Every ancestor of each tile is listed once
+        '''
+        parents = after_upload.get_tile_parents(['2/1/2', '2/1/3'])
+        self.assertEqual(parents, {(1, 0, 1), (0, 0, 0)})
+    
+    def test_clip_district_pieces(self):
+        ''' Districts are clipped to the tiles they cover
+        '''
+        tile_zxys = ['12/2047/2047', '12/2048/2047', '12/2048/2048']
+        tile_parents = after_upload.get_tile_parents(tile_zxys)
+        
+        # Northeast of null island, within tile 12/2048/2047
+        district_geom = ogr.CreateGeometryFromWkt('POLYGON ((.01 .01, .01 .02, .02 .02, .02 .01, .01 .01))')
+        pieces = after_upload.clip_district_pieces(district_geom, tile_zxys, tile_parents)
+        self.assertEqual(list(pieces.keys()), ['12/2048/2047'])
+        self.assertAlmostEqual(pieces['12/2048/2047'].Area(), district_geom.Area())
+        
+        # Straddling null island, across all four tiles
+        district_geom = ogr.CreateGeometryFromWkt('POLYGON ((-.01 -.01, -.01 .01, .01 .01, .01 -.01, -.01 -.01))')
+        pieces = after_upload.clip_district_pieces(district_geom, tile_zxys, tile_parents)
+        self.assertEqual(sorted(pieces.keys()), sorted(tile_zxys),
+            'Should skip tile 12/2047/2048 which is not in the model')
+        
+        for piece_geom in pieces.values():
+            self.assertAlmostEqual(piece_geom.Area(), district_geom.Area() / 4)
+        
+        # Touching tiles 12/2047/2047 and 12/2048/2047 only along their shared edge
+        district_geom = ogr.CreateGeometryFromWkt('POLYGON ((0 .01, 0 .02, .01 .02, .01 .01, 0 .01))')
+        pieces = after_upload.clip_district_pieces(district_geom, tile_zxys, tile_parents)
+        self.assertEqual(list(pieces.keys()), ['12/2048/2047'])
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_put_tile_district_pieces(self, stdout):
+        ''' District pieces are saved for each covered tile
+        '''
+        storage = data.Storage(unittest.mock.Mock(), 'bucket-name', None)
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson',
+            model=data.Model(data.State.XX, None, 2, 'data/XX/003'))
+        district_geoms = [
+            ogr.CreateGeometryFromWkt('POLYGON ((.01 .01, .01 .02, .02 .02, .02 .01, .01 .01))'),
+            ogr.CreateGeometryFromWkt('POLYGON ((90 45, 90 46, 91 46, 91 45, 90 45))'),
+            ]
+        
+        tile_districts = after_upload.put_tile_district_pieces(storage, upload,
+            ['data/XX/003/12/2047/2047.psb', 'data/XX/003/12/2048/2047.psb'], district_geoms)
+        
+        self.assertEqual(tile_districts, {'data/XX/003/12/2048/2047.psb': 1},
+            'Should skip tiles far from any district')
+        
+        self.assertEqual(len(storage.s3.put_object.mock_calls), 1)
+        put_kwargs = storage.s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/pieces/12/2048/2047.psb')
+        
+        body = put_kwargs['Body']
+        if put_kwargs.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        
+        properties, geometries, envelopes, _ = bundle.loads(body)
+        self.assertEqual(properties, [{'key': 'uploads/ID/geometries/0.wkt'}])
+        self.assertEqual(len(geometries), 1)
+        self.assertEqual(envelopes.shape, (1, 4))
+    
+    @unittest.mock.patch('planscore.after_upload.put_bundle')
+    @unittest.mock.patch('sys.stdout')
+    def test_put_tile_district_pieces_large(self, stdout, put_bundle):
+        ''' A state house plan over thousands of tiles is clipped to every tile it covers
+        '''
+        storage = data.Storage(unittest.mock.Mock(), 'bucket-name', None)
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson',
+            model=data.Model(data.State.XX, None, 203, 'data/XX/003'))
+        tile_keys = [f'data/XX/003/12/{x}/{y}.psb' for x in range(2000, 2064) for y in range(1500, 1564)]
+        xmin, _, _, ymax = tiles.tile_geometry('12/2000/1500').GetEnvelope()
+        _, xmax, ymin, _ = tiles.tile_geometry('12/2063/1563').GetEnvelope()
+        
+        # Tall thin districts side by side, each crossing a column of tiles
+        xs = numpy.linspace(xmin, xmax, 204)
+        district_geoms = [ogr.CreateGeometryFromWkt('POLYGON (({0} {2}, {0} {3}, {1} {3}, {1} {2}, {0} {2}))'.format(
+            x1, x2, ymin, ymax)) for (x1, x2) in zip(xs[:-1], xs[1:])]
+        
+        tile_districts = after_upload.put_tile_district_pieces(storage, upload, tile_keys, district_geoms)
+        
+        self.assertEqual(list(tile_districts.keys()), tile_keys)
+        self.assertTrue(3 <= min(tile_districts.values()) <= max(tile_districts.values()) <= 6)
+        self.assertEqual(len(put_bundle.mock_calls), len(tile_keys))
     
     @unittest.mock.patch('sys.stdout')
     def test_load_model_tiles(self, stdout):
@@ -192,12 +291,15 @@ class TestAfterUpload (unittest.TestCase):
         '''
         storage, model = unittest.mock.Mock(), unittest.mock.Mock()
         model.key_prefix = 'data/XX'
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
         storage.s3.list_objects.return_value = {'Contents': [
             {'Key': 'data/XX/a.geojson', 'Size': 2},
             {'Key': 'data/XX/b.geojson', 'Size': 4},
             {'Key': 'data/XX/c.geojson', 'Size': 3},
             {'Key': 'data/XX/d.geojson', 'Size': 0},
             {'Key': 'data/XX/e.geojson', 'Size': 1},
+            {'Key': 'data/XX/manifest.json', 'Size': 5},
+            {'Key': 'data/XX/costs.json', 'Size': 5},
             ], 'IsTruncated': False}
         
         tile_keys = after_upload.load_model_tiles(storage, model)
@@ -208,7 +310,69 @@ class TestAfterUpload (unittest.TestCase):
         
         self.assertEqual(tile_keys,
             ['data/XX/b.geojson', 'data/XX/c.geojson', 'data/XX/a.geojson',
-            'data/XX/e.geojson', 'data/XX/d.geojson'][:constants.MAX_TILES_RUN])
+            'data/XX/e.geojson', 'data/XX/d.geojson'])
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_load_model_tiles_manifest(self, stdout):
+        ''' Tiles are read from a model manifest instead of listed
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX/003'
+        manifest = {'tiles': [
+            {'key': 'data/XX/003/12/2047/2047.psb', 'size': 4, 'vertices': 10},
+            {'key': 'data/XX/003/12/2048/2047.psb', 'size': 2, 'vertices': 30},
+            ]}
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(json.dumps(manifest).encode('utf8'))),
+            'ContentEncoding': 'gzip'}
+        
+        tile_keys1 = after_upload.load_model_tiles(storage, model)
+        tile_keys2 = after_upload.load_model_tiles(storage, model)
+        
+        self.assertEqual(tile_keys1, ['data/XX/003/12/2048/2047.psb', 'data/XX/003/12/2047/2047.psb'],
+            'Should sort by vertex count')
+        self.assertEqual(tile_keys2, tile_keys1)
+        storage.s3.get_object.assert_called_once_with(Bucket=storage.bucket,
+            Key='data/XX/003/manifest.json')
+        self.assertFalse(storage.s3.list_objects.called)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_load_model_tiles_many(self, stdout):
+        ''' Every tile of a large model is returned
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX/003'
+        manifest = {'tiles': [{'key': 'data/XX/003/14/{}/{}.psb'.format(x, y), 'size': 1, 'vertices': 1}
+            for x in range(250) for y in range(200)]}
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(manifest).encode('utf8'))}
+        
+        tile_keys = after_upload.load_model_tiles(storage, model)
+        
+        self.assertEqual(len(tile_keys), 50000)
+        self.assertEqual(set(tile_keys), {tile['key'] for tile in manifest['tiles']})
+    
+    def test_fetch_model_manifest(self):
+        ''' Manifests are cached across invocations with different S3 clients
+        '''
+        manifest = {'tiles': [{'key': 'data/XX/004/12/2047/2047.psb', 'size': 4, 'vertices': 10}]}
+        s3a, s3b = unittest.mock.Mock(), unittest.mock.Mock()
+        s3a.get_object.return_value = {'Body': io.BytesIO(json.dumps(manifest).encode('utf8'))}
+        
+        with unittest.mock.patch.dict(after_upload._model_manifests, clear=True):
+            manifest1 = after_upload.fetch_model_manifest(s3a, 'bucket-name', 'data/XX/004/manifest.json')
+            manifest2 = after_upload.fetch_model_manifest(s3b, 'bucket-name', 'data/XX/004/manifest.json')
+            
+            self.assertEqual(manifest1, manifest)
+            self.assertIs(manifest2, manifest1)
+            self.assertEqual(len(s3a.get_object.mock_calls), 1)
+            self.assertFalse(s3b.get_object.called)
+            
+            s3b.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            
+            with self.assertRaises(botocore.exceptions.ClientError):
+                after_upload.fetch_model_manifest(s3b, 'bucket-name', 'data/XX/005/manifest.json')
+            
+            self.assertEqual(list(after_upload._model_manifests),
+                [('bucket-name', 'data/XX/004/manifest.json')])
     
     @unittest.mock.patch('sys.stdout')
     @unittest.mock.patch('boto3.client')
@@ -222,39 +386,170 @@ class TestAfterUpload (unittest.TestCase):
         storage.to_event.return_value = None
         upload.model.to_dict.return_value = None
 
-        after_upload.fan_out_tile_lambdas(storage, upload,
-            ['data/XX/a.geojson', 'data/XX/b.geojson'])
+        dispatch_times = after_upload.fan_out_tile_lambdas(storage, upload,
+            [['data/XX/a.geojson', 'data/XX/b.geojson'], ['data/XX/c.geojson']])
         
+        self.assertEqual(sorted(dispatch_times.keys()), [0, 1])
         invocations = boto3_client.return_value.invoke.mock_calls
+        payloads = [json.loads(call[2]['Payload'].decode('utf8')) for call in invocations]
         self.assertEqual(len(invocations), 2)
-        self.assertIn(b'data/XX/a.geojson', invocations[0][2]['Payload'])
-        self.assertIn(b'data/XX/b.geojson', invocations[1][2]['Payload'])
+        self.assertEqual(sorted(payload['tile_keys'] for payload in payloads),
+            [['data/XX/a.geojson', 'data/XX/b.geojson'], ['data/XX/c.geojson']])
+        self.assertEqual(payloads[0]['upload'], {'id': 'ID', 'key': 'uploads/ID/upload/file.geojson',
+            'model': None}, 'Should only reference the upload')
+        self.assertEqual([payload['group'] for payload in payloads],
+            [dict(index=0, size=2, count=1)] * 2)
     
-    @unittest.mock.patch('time.time')
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.sleep')
     @unittest.mock.patch('boto3.client')
-    def test_start_tile_observer_lambda(self, boto3_client, time_time):
+    def test_fan_out_tile_lambdas_throttled(self, boto3_client, time_sleep, stdout):
+        ''' Throttled tile Lambda invocations are retried
         '''
+        storage = unittest.mock.Mock()
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', model=unittest.mock.Mock())
+        upload.model.key_prefix = 'data/XX'
+
+        storage.to_event.return_value = None
+        upload.model.to_dict.return_value = None
+        
+        throttle_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke')
+        boto3_client.return_value.invoke.side_effect = [throttle_error, None, None, None]
+
+        tile_batches = [['data/XX/a.geojson'], ['data/XX/b.geojson'], ['data/XX/c.geojson']]
+        after_upload.fan_out_tile_lambdas(storage, upload, tile_batches, 1, 4)
+        
+        invocations = boto3_client.return_value.invoke.mock_calls
+        self.assertEqual(len(invocations), 4)
+        self.assertEqual(len(time_sleep.mock_calls), 1)
+        self.assertEqual(sorted(json.loads(call[2]['Payload'].decode('utf8'))['tile_keys']
+            for call in invocations)[1:], tile_batches)
+    
+    def test_pack_tile_batches(self):
+        ''' Small tiles are packed together up to a target cost
+        '''
+        tile_keys = ['g', 'f', 'e', 'd', 'c', 'b', 'a']
+        tile_costs = {'a': 150, 'b': 60, 'c': 30, 'd': 20, 'e': 10, 'f': 10, 'g': 40}
+        
+        self.assertEqual(after_upload.pack_tile_batches(tile_keys, tile_costs, 100, 3),
+            [['a'], ['b', 'g'], ['c', 'd', 'f'], ['e']], 'Should dispatch costly tiles first')
+        self.assertEqual(after_upload.pack_tile_batches(tile_keys, {}, 100, 3),
+            [['g', 'f', 'e'], ['d', 'c', 'b'], ['a']])
+        self.assertEqual(after_upload.pack_tile_batches([], tile_costs, 100, 3), [])
+    
+    def test_estimate_tile_costs(self):
+        ''' Tile costs come from measured runtimes or vertex counts
+        '''
+        tile_districts = {'a': 2, 'b': 3, 'c': 1, 'd': 1}
+        tile_vertices = {'a': 1000, 'b': 4000, 'c': 2000}
+        
+        costs1 = after_upload.estimate_tile_costs(tile_districts, tile_vertices, {})
+        self.assertEqual(set(costs1.keys()), {'a', 'b', 'c'}, 'Should skip unknown tile')
+        self.assertAlmostEqual(costs1['b'], constants.TILE_SECONDS_PER_VERTEX * 12000)
+        
+        costs2 = after_upload.estimate_tile_costs(tile_districts, tile_vertices, {'a': .5, 'd': 2})
+        self.assertAlmostEqual(costs2['a'], 1, msg='Should scale measured cost by districts')
+        self.assertAlmostEqual(costs2['b'], .0005 * 4000 * 3, msg='Should use measured rate')
+        self.assertAlmostEqual(costs2['c'], .0005 * 2000)
+        self.assertAlmostEqual(costs2['d'], 2)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.load_model_costs')
+    def test_get_tile_costs(self, load_model_costs, stdout):
+        '''
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX/004'
+        manifest = {'tiles': [{'key': 'data/XX/004/12/2047/2047.psb', 'size': 4, 'vertices': 10}]}
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(manifest).encode('utf8'))}
+        load_model_costs.return_value = {'data/XX/004/12/2048/2047.psb': 3}
+        
+        tile_districts = {'data/XX/004/12/2047/2047.psb': 2, 'data/XX/004/12/2048/2047.psb': 1}
+        costs = after_upload.get_tile_costs(storage, model, tile_districts)
+        
+        self.assertEqual(costs['data/XX/004/12/2048/2047.psb'], 3)
+        self.assertIn('data/XX/004/12/2047/2047.psb', costs)
+        load_model_costs.assert_called_once_with(storage, model)
+        
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        model.key_prefix = 'data/XX/005'
+        load_model_costs.return_value = {}
+        self.assertEqual(after_upload.get_tile_costs(storage, model, tile_districts), {})
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.sleep')
+    def test_invoke_lambda_with_backoff(self, time_sleep, stdout):
+        '''
+        '''
+        lam, throttled = unittest.mock.Mock(), unittest.mock.Mock()
+        throttle_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke')
+        other_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ResourceNotFoundException'}}, 'Invoke')
+        
+        lam.invoke.side_effect = [throttle_error, throttle_error, None]
+        self.assertTrue(after_upload.invoke_lambda_with_backoff(lam, 'Function', b'{}', throttled))
+        self.assertEqual(len(throttled.mock_calls), 2)
+        self.assertEqual(lam.invoke.mock_calls[-1][2],
+            dict(FunctionName='Function', InvocationType='Event', Payload=b'{}'))
+        
+        lam.invoke.side_effect = [other_error]
+        self.assertFalse(after_upload.invoke_lambda_with_backoff(lam, 'Function', b'{}', throttled))
+        
+        lam.invoke.side_effect = throttle_error
+        self.assertFalse(after_upload.invoke_lambda_with_backoff(lam, 'Function', b'{}', throttled))
+        self.assertEqual(len(throttled.mock_calls), 2 + constants.INVOKE_MAX_ATTEMPTS)
+    
+    @unittest.mock.patch('planscore.observe.put_tile_dispatch')
+    def test_put_tile_dispatch(self, put_tile_dispatch):
+        ''' Dispatch record has a time, attempts, and cost for each batch
+        '''
+        storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        
+        tile_dispatch = after_upload.put_tile_dispatch(storage, upload, [['a', 'b'], ['c'], ['d']],
+            {'a': 1, 'b': 2, 'c': 3}, {0: 100, 2: 101})
+        
+        put_tile_dispatch.assert_called_once_with(storage, upload, {
+            0: dict(time=100, attempts=1, cost=3),
+            1: dict(time=None, attempts=0, cost=3),
+            2: dict(time=101, attempts=1, cost=None),
+            })
+        self.assertIs(tile_dispatch, put_tile_dispatch.mock_calls[0][1][2])
+    
+    def test_put_tile_index(self):
+        ''' Tile index includes the whole upload and its tile batches
         '''
         storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
-        storage.to_event.return_value = dict()
+        upload.id = 'ID'
         upload.to_dict.return_value = dict(start_time=1)
         
-        after_upload.start_tile_observer_lambda(storage, upload,
-            ['data/XX/a.geojson', 'data/XX/b.geojson'])
+        after_upload.put_tile_index(storage, upload,
+            [['data/XX/a.geojson', 'data/XX/b.geojson']])
         
         self.assertEqual(len(storage.s3.put_object.mock_calls), 1)
-        self.assertEqual(len(boto3_client.return_value.invoke.mock_calls), 1)
-        self.assertIn(b'"start_time": 1', boto3_client.return_value.invoke.mock_calls[0][2]['Payload'])
+        put_call = storage.s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_call['Key'], 'uploads/ID/tiles.json')
+        self.assertEqual(json.loads(put_call['Body'].decode('utf8')), dict(upload=dict(start_time=1),
+            tiles=[['data/XX/a.geojson', 'data/XX/b.geojson']]))
     
     @unittest.mock.patch('planscore.util.temporary_buffer_file')
     @unittest.mock.patch('planscore.observe.put_upload_index')
     @unittest.mock.patch('planscore.after_upload.put_geojson_file')
+    @unittest.mock.patch('planscore.observe.populate_compactness')
     @unittest.mock.patch('planscore.after_upload.put_district_geometries')
-    @unittest.mock.patch('planscore.after_upload.start_tile_observer_lambda')
+    @unittest.mock.patch('planscore.after_upload.get_tile_costs')
+    @unittest.mock.patch('planscore.after_upload.pack_tile_batches')
+    @unittest.mock.patch('planscore.after_upload.load_district_geometries')
+    @unittest.mock.patch('planscore.after_upload.put_tile_district_pieces')
+    @unittest.mock.patch('planscore.after_upload.put_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.schedule_watch')
+    @unittest.mock.patch('planscore.after_upload.put_tile_index')
     @unittest.mock.patch('planscore.after_upload.fan_out_tile_lambdas')
     @unittest.mock.patch('planscore.after_upload.load_model_tiles')
     @unittest.mock.patch('planscore.after_upload.guess_state_model')
-    def test_commence_upload_scoring_good_file(self, guess_state_model, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, put_geojson_file, put_upload_index, temporary_buffer_file):
+    @unittest.mock.patch('planscore.constants.WATCH_QUEUE_URL', 'https://sqs/queue')
+    def test_commence_upload_scoring_good_file(self, guess_state_model, load_model_tiles, fan_out_tile_lambdas, put_tile_index, schedule_watch, put_tile_dispatch, put_tile_district_pieces, load_district_geometries, pack_tile_batches, get_tile_costs, put_district_geometries, populate_compactness, put_geojson_file, put_upload_index, temporary_buffer_file):
         ''' A valid district plan file is scored and the results posted to S3
         '''
         id = 'ID'
@@ -267,7 +562,7 @@ class TestAfterUpload (unittest.TestCase):
             yield nullplan_path
 
         temporary_buffer_file.side_effect = nullplan_file
-        put_district_geometries.return_value = [unittest.mock.Mock()] * 2
+        put_tile_dispatch.return_value = {0: dict(time=time.time() + 60, cost=1), 1: dict(time=None)}
 
         s3, bucket = unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
@@ -284,29 +579,57 @@ class TestAfterUpload (unittest.TestCase):
         put_geojson_file.assert_called_once_with(s3, bucket, upload, nullplan_path)
         
         self.assertEqual(len(put_district_geometries.mock_calls), 1)
-        self.assertEqual(put_district_geometries.mock_calls[0][1][3], nullplan_path)
+        load_district_geometries.assert_called_once_with(nullplan_path)
+        self.assertIs(put_district_geometries.mock_calls[0][1][3], load_district_geometries.return_value)
 
         self.assertEqual(len(load_model_tiles.mock_calls), 1)
+        self.assertEqual(len(load_model_tiles.mock_calls[0][1]), 2, 'Should not select footprint twice')
+        self.assertEqual(len(put_tile_district_pieces.mock_calls), 1)
+        self.assertIs(put_tile_district_pieces.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertIs(put_tile_district_pieces.mock_calls[0][1][3], load_district_geometries.return_value)
         
         self.assertEqual(len(fan_out_tile_lambdas.mock_calls), 1)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][0].s3, s3)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], load_model_tiles.return_value)
-
-        self.assertEqual(len(start_tile_observer_lambda.mock_calls), 1)
-        self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], pack_tile_batches.return_value)
+
+        self.assertEqual(len(put_tile_index.mock_calls), 1)
+        self.assertEqual(put_tile_index.mock_calls[0][1][1].id, upload.id)
+        self.assertIs(put_tile_index.mock_calls[0][1][1].districts, populate_compactness.return_value)
+        self.assertIs(put_tile_index.mock_calls[0][1][2], pack_tile_batches.return_value)
+        self.assertEqual(len(schedule_watch.mock_calls), 1, 'Should watch for stragglers')
+        self.assertEqual(schedule_watch.mock_calls[0][1][1].id, upload.id)
+        self.assertLessEqual(schedule_watch.mock_calls[0][1][2], 0, 'Should check undispatched batches now')
+        self.assertIs(put_tile_dispatch.mock_calls[0][1][2], pack_tile_batches.return_value)
+        self.assertIs(put_tile_dispatch.mock_calls[0][1][4], fan_out_tile_lambdas.return_value)
+        pack_tile_batches.assert_called_once_with(put_tile_district_pieces.return_value, get_tile_costs.return_value)
+        self.assertIs(get_tile_costs.mock_calls[0][1][2], put_tile_district_pieces.return_value)
+        
+        # Without a watch queue, no tile Lambdas are started
+        with unittest.mock.patch('planscore.constants.WATCH_QUEUE_URL', None):
+            with self.assertRaises(ValueError):
+                after_upload.commence_upload_scoring(s3, bucket, upload)
+        
+        self.assertEqual(len(fan_out_tile_lambdas.mock_calls), 1)
     
     @unittest.mock.patch('planscore.util.temporary_buffer_file')
     @unittest.mock.patch('planscore.observe.put_upload_index')
     @unittest.mock.patch('planscore.after_upload.put_geojson_file')
     @unittest.mock.patch('planscore.util.unzip_shapefile')
+    @unittest.mock.patch('planscore.observe.populate_compactness')
     @unittest.mock.patch('planscore.after_upload.put_district_geometries')
-    @unittest.mock.patch('planscore.after_upload.start_tile_observer_lambda')
+    @unittest.mock.patch('planscore.after_upload.get_tile_costs')
+    @unittest.mock.patch('planscore.after_upload.pack_tile_batches')
+    @unittest.mock.patch('planscore.after_upload.load_district_geometries')
+    @unittest.mock.patch('planscore.after_upload.put_tile_district_pieces')
+    @unittest.mock.patch('planscore.after_upload.put_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.schedule_watch')
+    @unittest.mock.patch('planscore.after_upload.put_tile_index')
     @unittest.mock.patch('planscore.after_upload.fan_out_tile_lambdas')
     @unittest.mock.patch('planscore.after_upload.load_model_tiles')
     @unittest.mock.patch('planscore.after_upload.guess_state_model')
-    def test_commence_upload_scoring_zipped_file(self, guess_state_model, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, unzip_shapefile, put_geojson_file, put_upload_index, temporary_buffer_file):
+    @unittest.mock.patch('planscore.constants.WATCH_QUEUE_URL', 'https://sqs/queue')
+    def test_commence_upload_scoring_zipped_file(self, guess_state_model, load_model_tiles, fan_out_tile_lambdas, put_tile_index, schedule_watch, put_tile_dispatch, put_tile_district_pieces, load_district_geometries, pack_tile_batches, get_tile_costs, put_district_geometries, populate_compactness, unzip_shapefile, put_geojson_file, put_upload_index, temporary_buffer_file):
         ''' A valid district plan zipfile is scored and the results posted to S3
         '''
         id = 'ID'
@@ -319,7 +642,7 @@ class TestAfterUpload (unittest.TestCase):
             yield nullplan_path
 
         temporary_buffer_file.side_effect = nullplan_file
-        put_district_geometries.return_value = [unittest.mock.Mock()] * 2
+        put_tile_dispatch.return_value = {0: dict(time=time.time() + 60, cost=1), 1: dict(time=None)}
 
         s3, bucket = unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
@@ -339,18 +662,31 @@ class TestAfterUpload (unittest.TestCase):
         self.assertIs(put_geojson_file.mock_calls[0][1][3], unzip_shapefile.return_value)
         
         self.assertEqual(len(put_district_geometries.mock_calls), 1)
-        self.assertEqual(put_district_geometries.mock_calls[0][1][3], unzip_shapefile.return_value)
+        load_district_geometries.assert_called_once_with(unzip_shapefile.return_value)
+        self.assertIs(put_district_geometries.mock_calls[0][1][3], load_district_geometries.return_value)
 
         self.assertEqual(len(load_model_tiles.mock_calls), 1)
+        self.assertEqual(len(load_model_tiles.mock_calls[0][1]), 2, 'Should not select footprint twice')
+        self.assertEqual(len(put_tile_district_pieces.mock_calls), 1)
+        self.assertIs(put_tile_district_pieces.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertIs(put_tile_district_pieces.mock_calls[0][1][3], load_district_geometries.return_value)
         
         self.assertEqual(len(fan_out_tile_lambdas.mock_calls), 1)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][0].s3, s3)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], pack_tile_batches.return_value)
         
-        self.assertEqual(len(start_tile_observer_lambda.mock_calls), 1)
-        self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertEqual(len(put_tile_index.mock_calls), 1)
+        self.assertEqual(put_tile_index.mock_calls[0][1][1].id, upload.id)
+        self.assertIs(put_tile_index.mock_calls[0][1][1].districts, populate_compactness.return_value)
+        self.assertIs(put_tile_index.mock_calls[0][1][2], pack_tile_batches.return_value)
+        self.assertEqual(len(schedule_watch.mock_calls), 1, 'Should watch for stragglers')
+        self.assertEqual(schedule_watch.mock_calls[0][1][1].id, upload.id)
+        self.assertLessEqual(schedule_watch.mock_calls[0][1][2], 0, 'Should check undispatched batches now')
+        self.assertIs(put_tile_dispatch.mock_calls[0][1][2], pack_tile_batches.return_value)
+        self.assertIs(put_tile_dispatch.mock_calls[0][1][4], fan_out_tile_lambdas.return_value)
+        pack_tile_batches.assert_called_once_with(put_tile_district_pieces.return_value, get_tile_costs.return_value)
+        self.assertIs(get_tile_costs.mock_calls[0][1][2], put_tile_district_pieces.return_value)
     
     def test_commence_upload_scoring_bad_file(self):
         ''' An invalid district file fails in an expected way
@@ -0,0 +1,74 @@
+import unittest, json
+import numpy
+from .. import bundle
+
+class TestBundle (unittest.TestCase):
+
+    def test_dumps_loads(self):
+        ''' Features survive a round trip through the bundle format
+        '''
+        properties = [{'Voters': 1, 'PlanScore:Fraction': .5}, {'Voters': 2, 'Name': 'Précinct'}]
+        geometries = [b'\x01\x01\x00\x00\x00' + bytes(16), None]
+        envelopes = [(0, 1, 2, 3), (numpy.nan, ) * 4]
+        
+        body = bundle.dumps(properties, geometries, envelopes)
+        properties2, geometries2, envelopes2, simulations2 = bundle.loads(body)
+        
+        self.assertEqual(body[:3], b'PSB')
+        self.assertEqual(simulations2, [{}, {}])
+        self.assertEqual(properties2, properties)
+        self.assertEqual(geometries2, geometries)
+        self.assertEqual(envelopes2[0].tolist(), [0, 1, 2, 3])
+        self.assertTrue(numpy.isnan(envelopes2[1]).all())
+    
+    def test_dumps_loads_empty(self):
+        ''' An empty list of features can be bundled
+        '''
+        properties, geometries, envelopes, simulations = bundle.loads(bundle.dumps([], [], []))
+        
+        self.assertEqual(properties, [])
+        self.assertEqual(simulations, [])
+        self.assertEqual(geometries, [])
+        self.assertEqual(envelopes.shape, (0, 4))
+    
+    def test_dumps_loads_simulations(self):
+        ''' Simulated votes survive a round trip within the documented error
+        '''
+        reps = numpy.array([[0, 12.5, 7], [999.9, 3.25, 7], [431.7, 0, 7]])
+        simulations = [{'REP': list(row), 'DEM': [1, 2]} for row in reps]
+        simulations[2]['DEM'] = [3]
+        
+        body = bundle.dumps([{}, {}, {}], [None, None, None], [(numpy.nan, ) * 4] * 3, simulations)
+        _, _, _, simulations2 = bundle.loads(body)
+        
+        reps2 = numpy.array([sims['REP'] for sims in simulations2])
+        max_errors = (reps.max(axis=0) - reps.min(axis=0)) / (bundle.QUANTIZED_STEPS * 2)
+        
+        self.assertTrue((abs(reps2 - reps) <= max_errors + 1e-12).all())
+        self.assertEqual(reps2[:,0].min(), 0, 'Column minimums should be exact')
+        self.assertEqual(reps2[:,2].tolist(), [7, 7, 7], 'Constant columns should be exact')
+        self.assertEqual([sims['DEM'].tolist() for sims in simulations2], [[1, 2], [1, 2], [3, 0]])
+    
+    def test_dumps_loads_version1(self):
+        ''' Version 1 bundles without simulations can still be read
+        '''
+        properties = json.dumps([{'Voters': 1}]).encode('utf8')
+        body = b''.join([bundle.HEADERS[1].pack(b'PSB', 1, 1, len(properties)),
+            numpy.array([0, 1, 2, 3], dtype='<f8').tobytes(),
+            numpy.array([0], dtype='<u4').tobytes(), properties])
+        
+        properties2, geometries2, envelopes2, simulations2 = bundle.loads(body)
+        
+        self.assertEqual(properties2, [{'Voters': 1}])
+        self.assertEqual(geometries2, [None])
+        self.assertEqual(envelopes2.tolist(), [[0, 1, 2, 3]])
+        self.assertEqual(simulations2, [{}])
+    
+    def test_bad_input(self):
+        ''' Mismatched or unrecognized input raises errors
+        '''
+        with self.assertRaises(ValueError):
+            bundle.dumps([{}], [], [])
+        
+        with self.assertRaises(ValueError):
+            bundle.loads(b'{"type": "FeatureCollection", "features": []}')
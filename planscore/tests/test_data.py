@@ -144,6 +144,22 @@ class TestData (unittest.TestCase):
         self.assertEqual(upload12.key, upload11.key)
         self.assertEqual(upload12.message, upload11.message)
     
+    def test_upload_reference(self):
+        ''' data.Upload instances can be referenced without their districts
+        '''
+        model = data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX/003')
+        upload1 = data.Upload(id='ID', key='uploads/ID/upload/whatever.json',
+            model=model, districts=[None, None], summary={'Efficiency Gap': .1})
+        
+        reference = upload1.to_reference()
+        upload2 = data.Upload.from_dict(reference)
+        
+        self.assertEqual(set(reference.keys()), {'id', 'key', 'model'})
+        self.assertEqual(upload2.id, upload1.id)
+        self.assertEqual(upload2.key, upload1.key)
+        self.assertEqual(upload2.model.key_prefix, model.key_prefix)
+        self.assertEqual(upload2.districts, [])
+    
     def test_upload_plaintext(self):
         ''' data.Upload instances can be converted to plaintext
         '''
@@ -0,0 +1,233 @@
+import unittest, unittest.mock, io, os, json, csv, queue
+from .. import ensemble, data
+
+class TestEnsemble (unittest.TestCase):
+
+    @unittest.mock.patch('sys.stdout')
+    def test_load_plan_geometries(self, stdout):
+        ''' District geometries are loaded in order from a plan file
+        '''
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        geometries1 = ensemble.load_plan_geometries(null_plan_path)
+
+        self.assertEqual(len(geometries1), 2)
+        self.assertTrue(geometries1[0].startswith('POLYGON'))
+
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.shp.zip')
+        geometries2 = ensemble.load_plan_geometries(null_plan_path)
+
+        self.assertEqual(len(geometries2), 2)
+
+    @unittest.mock.patch('planscore.ensemble.load_plan_geometries')
+    def test_load_ensemble(self, load_plan_geometries):
+        ''' Each plan file becomes an upload with its own ID
+        '''
+        load_plan_geometries.side_effect = [['POLYGON 1', 'POLYGON 2'], ['POLYGON 3']]
+        uploads, plan_wkts = ensemble.load_ensemble(['plan1.shp', 'plan2.shp'], None)
+
+        self.assertEqual([upload.id for upload in uploads], ['0', '1'])
+        self.assertEqual([upload.key for upload in uploads], ['plan1.shp', 'plan2.shp'])
+        self.assertEqual([len(upload.districts) for upload in uploads], [2, 1])
+        self.assertEqual(plan_wkts, [['POLYGON 1', 'POLYGON 2'], ['POLYGON 3']])
+
+        load_plan_geometries.side_effect = [['POLYGON 4']]
+        uploads, _ = ensemble.load_ensemble(['plan3.shp'], None, 3)
+        self.assertEqual(uploads[0].id, '3')
+
+    @unittest.mock.patch('planscore.tiles.load_tile_precincts')
+    @unittest.mock.patch('planscore.tiles.tile_geometry')
+    def test_load_tile(self, tile_geometry, load_tile_precincts):
+        ''' Tile precincts are loaded and prepared once for every plan
+        '''
+        load_tile_precincts.return_value = []
+        storage = data.Storage(None, 'bucket', 'data/XX/001')
+
+        tile = ensemble.load_tile(storage, 'data/XX/001/12/2047/2047.geojson')
+
+        self.assertEqual(tile_geometry.mock_calls[0][1], ('12/2047/2047', ))
+        self.assertEqual(len(load_tile_precincts.mock_calls), 1)
+        self.assertIs(tile['geometry'], tile_geometry.return_value)
+        self.assertEqual(tile['precincts'], [])
+        self.assertEqual(tile['envelopes'].shape, (0, 4))
+
+    @unittest.mock.patch('planscore.tiles.score_districts')
+    def test_score_tile(self, score_districts):
+        ''' Every plan is scored from a single load of tile precincts
+        '''
+        score_districts.return_value = [{'Voters': 1}]
+        tile = dict(geometry=unittest.mock.Mock(), precincts=[], envelopes='envelopes', attributes='attributes')
+        tile['geometry'].GetEnvelope.return_value = (0, 1, 0, 1)
+        uploads = [data.Upload('0', None), data.Upload('1', None)]
+
+        near_geom, far_geom = unittest.mock.Mock(), unittest.mock.Mock()
+        near_geom.GetEnvelope.return_value = (.5, 1.5, .5, 1.5)
+        far_geom.GetEnvelope.return_value = (2, 3, 2, 3)
+
+        plan_totals = ensemble.score_tile(tile, uploads, [[near_geom, far_geom], [far_geom]])
+
+        self.assertEqual(plan_totals, {0: {'uploads/0/geometries/0.wkt': {'Voters': 1}}})
+        self.assertEqual(len(score_districts.mock_calls), 1)
+        self.assertEqual(score_districts.mock_calls[0][1],
+            ([near_geom], [], tile['geometry'], 'envelopes', 'attributes'))
+
+    @unittest.mock.patch('planscore.ensemble.score_tile')
+    @unittest.mock.patch('osgeo.ogr.CreateGeometryFromWkt')
+    def test_score_plans(self, CreateGeometryFromWkt, score_tile):
+        ''' Tile totals are summed for each plan in a group over loaded tiles
+        '''
+        CreateGeometryFromWkt.return_value.GetEnvelope.return_value = (0, 1, 0, 1)
+        score_tile.side_effect = [{1: {'uploads/1/geometries/0.wkt': {'Voters': 1, 'REP': [1, 2]}}},
+            {1: {'uploads/1/geometries/0.wkt': {'Voters': 2, 'REP': [3, 4]}}}]
+
+        uploads = [data.Upload('0', None, districts=[None, None]), data.Upload('1', None, districts=[None, None])]
+        plan_totals = ensemble.score_plans(['tile1', 'tile2'], uploads, [['POLYGON 1', 'POLYGON 2']] * 2)
+
+        self.assertEqual(len(score_tile.mock_calls), 2)
+        self.assertEqual(score_tile.mock_calls[0][1][0], 'tile1')
+        self.assertEqual(CreateGeometryFromWkt.call_count, 4)
+        self.assertEqual(score_tile.mock_calls[0][1][3][0].shape, (2, 4))
+        self.assertEqual(plan_totals[0], {})
+        self.assertEqual(plan_totals[1]['uploads/1/geometries/0.wkt']['Voters'], 3)
+        self.assertEqual(plan_totals[1]['uploads/1/geometries/0.wkt']['REP'].tolist(), [4, 6])
+
+    def test_split_tile_keys(self):
+        ''' Tiles are dealt out among workers in turn
+        '''
+        self.assertEqual(ensemble.split_tile_keys(['t1', 't2', 't3', 't4', 't5'], 2),
+            [['t1', 't3', 't5'], ['t2', 't4']])
+
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.ensemble.score_plans')
+    @unittest.mock.patch('planscore.ensemble.load_tile')
+    def test_run_worker(self, load_tile, score_plans, boto3_client):
+        ''' Workers load their tiles once and score every group of plans against them
+        '''
+        plan_queue, totals_queue = queue.Queue(), queue.Queue()
+        plan_queue.put((0, ['upload0'], [['POLYGON 1']]))
+        plan_queue.put((1, ['upload1'], [['POLYGON 2']]))
+        plan_queue.put(None)
+
+        ensemble.run_worker(dict(bucket='bucket', prefix='data/XX/001'), ['tile1', 'tile2'], plan_queue, totals_queue)
+
+        self.assertEqual(len(load_tile.mock_calls), 2, 'Should load each tile once')
+        self.assertEqual(score_plans.mock_calls[1][1], ([load_tile.return_value] * 2, ['upload1'], [['POLYGON 2']]))
+        self.assertEqual(totals_queue.get_nowait(), (0, score_plans.return_value))
+        self.assertEqual(totals_queue.get_nowait(), (1, score_plans.return_value))
+
+        # Errors are sent back instead of totals
+        plan_queue.put((2, ['upload2'], [['POLYGON 3']]))
+        score_plans.side_effect = ValueError('Bad plan')
+        ensemble.run_worker(dict(bucket='bucket', prefix='data/XX/001'), ['tile1'], plan_queue, totals_queue)
+
+        index, error = totals_queue.get_nowait()
+        self.assertIsNone(index)
+        self.assertIn('Bad plan', error)
+
+    def test_get_worker_totals(self):
+        ''' Totals from every worker are collected for one group at a time
+        '''
+        workers, totals_queue, received = [unittest.mock.Mock(), unittest.mock.Mock()], queue.Queue(), {}
+        for message in [(0, 'a0'), (1, 'a1'), (0, 'b0'), (1, 'b1')]:
+            totals_queue.put(message)
+
+        self.assertEqual(ensemble.get_worker_totals(totals_queue, workers, 0, received), ['a0', 'b0'])
+        self.assertEqual(received, {1: ['a1']})
+        self.assertEqual(ensemble.get_worker_totals(totals_queue, workers, 1, received), ['a1', 'b1'])
+
+        totals_queue.put((None, 'Traceback'))
+        with self.assertRaises(RuntimeError):
+            ensemble.get_worker_totals(totals_queue, workers, 2, received)
+
+    def test_merge_plan_totals(self):
+        ''' Totals from all workers are merged and scored for each plan in a group
+        '''
+        worker_totals = []
+
+        for zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
+            tile_key = f'uploads/sample-plan/tiles/{zxy}.json'
+            filename = os.path.join(os.path.dirname(__file__), 'data', tile_key)
+            with open(filename) as file:
+                worker_totals.append([{}, json.load(file).get('totals')])
+
+        uploads = [data.Upload('no-plan', None, districts=[None, None]),
+            data.Upload('sample-plan', None, districts=[None, None])]
+
+        plan_districts = ensemble.merge_plan_totals(uploads, worker_totals)
+        scored_uploads = ensemble.score_group(uploads, plan_districts)
+
+        self.assertEqual(len(scored_uploads), 2)
+        self.assertEqual(scored_uploads[1].districts[0]['totals']['Voters'], 567.09)
+        self.assertEqual(scored_uploads[1].districts[1]['totals']['Voters'], 932.89)
+        self.assertIn('Efficiency Gap', scored_uploads[1].summary)
+        self.assertFalse([value for value in scored_uploads[1].summary.values()
+            if type(value) is dict])
+        self.assertNotIn('REP', scored_uploads[1].districts[0]['totals'])
+        self.assertNotIn('Efficiency Gap', scored_uploads[0].summary)
+
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.ensemble.load_ensemble')
+    @unittest.mock.patch('multiprocessing.Process')
+    @unittest.mock.patch('multiprocessing.Queue')
+    def test_iterate_plan_districts(self, Queue, Process, load_ensemble, stdout):
+        ''' Each worker gets a share of tiles and every group of plans, and groups come back in order
+        '''
+        plan_queue, totals_queue = unittest.mock.Mock(), unittest.mock.Mock()
+        Queue.side_effect = [totals_queue, plan_queue, plan_queue]
+        totals_queue.get.side_effect = [(1, [{}]), (0, [{}]), (0, [{}]), (1, [{}])]
+        load_ensemble.side_effect = lambda paths, model, first_index: \
+            ([data.Upload(str(first_index), path, districts=[None]) for path in paths], [['POLYGON']])
+        storage = data.Storage(None, 'bucket', 'data/XX/001')
+
+        plan_groups = [(0, ['plan0.shp']), (1, ['plan1.shp'])]
+        results = list(ensemble.iterate_plan_districts(storage, 'model', plan_groups, ['t1', 't2', 't3'], 2))
+
+        self.assertEqual([uploads[0].key for (uploads, _) in results], ['plan0.shp', 'plan1.shp'])
+        self.assertEqual([call[2]['args'][1] for call in Process.mock_calls if 'args' in call[2]],
+            [['t1', 't3'], ['t2']])
+        self.assertEqual([call[1][0][0] for call in plan_queue.put.mock_calls if call[1][0]], [0, 0, 1, 1])
+        self.assertEqual(plan_queue.put.mock_calls[-1][1], (None, ))
+
+    @unittest.mock.patch('planscore.ensemble.score_group')
+    @unittest.mock.patch('planscore.ensemble.iterate_plan_districts')
+    @unittest.mock.patch('concurrent.futures.ProcessPoolExecutor')
+    def test_score_ensemble(self, ProcessPoolExecutor, iterate_plan_districts, score_group):
+        ''' Merged plan groups are scored over a process pool, in plan order
+        '''
+        executor = ProcessPoolExecutor.return_value.__enter__.return_value
+        executor.submit.side_effect = lambda function, uploads, districts: \
+            unittest.mock.Mock(result=unittest.mock.Mock(return_value=uploads))
+        iterate_plan_districts.return_value = [(['upload0', 'upload1'], 'districts'), (['upload2'], 'districts')]
+        storage = data.Storage(None, 'bucket', 'data/XX/001')
+
+        scored_uploads = ensemble.score_ensemble(storage, 'model',
+            ['plan0.shp', 'plan1.shp', 'plan2.shp'], ['tile1', 'tile2'], 1, 2)
+
+        self.assertFalse(ProcessPoolExecutor.mock_calls, 'Should not start a pool until iterated')
+        self.assertEqual(list(scored_uploads), ['upload0', 'upload1', 'upload2'])
+        self.assertEqual(ProcessPoolExecutor.mock_calls[0][1], (1, ))
+        self.assertIs(executor.submit.mock_calls[0][1][0], ensemble.score_group)
+        self.assertEqual(iterate_plan_districts.mock_calls[0][1][1:],
+            ('model', [(0, ['plan0.shp', 'plan1.shp']), (2, ['plan2.shp'])], ['tile1', 'tile2'], 1))
+
+    def test_write_tables(self):
+        ''' Plan and district tables have one row per plan and district
+        '''
+        uploads = [
+            data.Upload('0', 'plan1.shp', summary={'Efficiency Gap': .1, 'Curve': {'Swing': []}},
+                districts=[dict(totals={'Voters': 1}), dict(totals={'Voters': 2})]),
+            data.Upload('1', 'plan2.shp', summary={'Efficiency Gap': -.1},
+                districts=[dict(totals={'Voters': 3})]),
+            ]
+
+        plans_file, districts_file = io.StringIO(), io.StringIO()
+        ensemble.write_tables(plans_file, districts_file, iter(uploads))
+
+        plans = list(csv.DictReader(io.StringIO(plans_file.getvalue()), dialect='excel-tab'))
+        districts = list(csv.DictReader(io.StringIO(districts_file.getvalue()), dialect='excel-tab'))
+
+        self.assertEqual(plans, [{'Plan': 'plan1.shp', 'Efficiency Gap': '0.1'},
+            {'Plan': 'plan2.shp', 'Efficiency Gap': '-0.1'}])
+
+        self.assertEqual(districts, [{'Plan': 'plan1.shp', 'District': '1', 'Voters': '1'},
+            {'Plan': 'plan1.shp', 'District': '2', 'Voters': '2'},
+            {'Plan': 'plan2.shp', 'District': '1', 'Voters': '3'}])
@@ -1,6 +1,6 @@
-import unittest, unittest.mock, os, io, itertools, gzip, json
-import botocore.exceptions
-from .. import observe, data
+import unittest, unittest.mock, os, io, itertools, gzip, json, time
+import botocore.exceptions, numpy
+from .. import observe, data, score, constants, tiles
 
 should_gzip = itertools.cycle([True, False])
 
@@ -37,18 +37,6 @@ class TestObserveTiles (unittest.TestCase):
             Body=upload.to_plaintext.return_value.encode.return_value,
             ACL='public-read', ContentType='text/plain'))
 
-    def test_expected_tile(self):
-        ''' Expected tile is returned for an enqueued one.
-        '''
-        upload = unittest.mock.Mock()
-        upload.model.key_prefix = 'data/XX'
-        upload.id = 'ID'
-        
-        enqueued_key = 'data/XX/12/656/1582.geojson'
-        expected_key = 'uploads/ID/tiles/12/656/1582.json'
-        
-        self.assertEqual(observe.get_expected_tile(enqueued_key, upload), expected_key)
-    
     def test_get_district_index(self):
         '''
         '''
@@ -94,34 +82,798 @@ class TestObserveTiles (unittest.TestCase):
         self.assertEqual(len(districts), len(geometries))
         self.assertEqual(districts[0]['compactness'], get_scores.return_value)
     
+    def test_load_tile_index(self):
+        ''' Forwarded upload and tile batches are read from the tile index
+        '''
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(dict(
+            upload=dict(id='ID', key='uploads/ID/upload/file.geojson', start_time=1),
+            tiles=[['data/XX/12/2047/2047.psb']])).encode('utf8'))}
+        
+        upload, enqueued_tiles = observe.load_tile_index(storage, data.Upload('ID', None))
+        
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'], 'uploads/ID/tiles.json')
+        self.assertEqual(upload.start_time, 1)
+        self.assertEqual(enqueued_tiles, [['data/XX/12/2047/2047.psb']])
+    
+    def test_is_upload_finished(self):
+        ''' Only final scores with complete progress count as finished
+        '''
+        self.assertFalse(observe.is_upload_finished(data.Upload('ID', None)))
+        self.assertFalse(observe.is_upload_finished(data.Upload('ID', None,
+            progress=data.Progress(1, 2), summary={'Efficiency Gap': .1})))
+        self.assertFalse(observe.is_upload_finished(data.Upload('ID', None,
+            progress=data.Progress(2, 2), summary={'Efficiency Gap': .1, 'Provisional': True})))
+        self.assertTrue(observe.is_upload_finished(data.Upload('ID', None,
+            progress=data.Progress(2, 2), summary={'Efficiency Gap': .1})))
+    
+    def test_is_upload_stopped(self):
+        ''' Uploads given up on need no more work, like finished ones
+        '''
+        self.assertFalse(observe.is_upload_stopped(data.Upload('ID', None, message='Scoring')))
+        self.assertTrue(observe.is_upload_stopped(data.Upload('ID', None,
+            progress=data.Progress(2, 2), summary={'Efficiency Gap': .1})))
+        self.assertTrue(observe.is_upload_stopped(data.Upload('ID', None,
+            progress=data.Progress(1, 2), message=observe.OVERDUE_MESSAGE)))
+    
+    def test_get_reduce_group(self):
+        ''' Consecutive batches are grouped for merging
+        '''
+        with unittest.mock.patch('planscore.constants.REDUCE_FAN_IN', 3):
+            self.assertEqual(observe.get_reduce_group(0, 7), dict(index=0, size=3, count=3))
+            self.assertEqual(observe.get_reduce_group(5, 7), dict(index=1, size=3, count=3))
+            self.assertEqual(observe.get_reduce_group(6, 7), dict(index=2, size=1, count=3))
+        
+        # Fan-in scales with the number of batches
+        self.assertEqual(observe.get_reduce_group(0, 1), dict(index=0, size=1, count=1))
+        self.assertEqual(observe.get_reduce_group(99, 100), dict(index=9, size=10, count=10))
+        self.assertEqual(observe.get_reduce_group(0, 10000), dict(index=0, size=64, count=157))
+    
+    def test_get_group_tile(self):
+        ''' Group completion markers point back to tile outputs
+        '''
+        upload = data.Upload('ID', None)
+        self.assertEqual(observe.get_group_prefix(upload, 2), 'uploads/ID/groups/2/')
+        self.assertEqual(observe.get_group_tile('uploads/ID/groups/2/12/2047/2047.json', upload, 2),
+            'uploads/ID/tiles/12/2047/2047.json')
+    
+    def test_reduce_tile_group(self):
+        ''' A group of tile outputs is merged into one partial sum
+        '''
+        upload = data.Upload('sample-plan', None)
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.side_effect = mock_s3_get_object
+        
+        tile_keys = [f'uploads/sample-plan/tiles/{zxy}.json' for zxy
+            in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048')]
+        
+        observe.reduce_tile_group(storage, upload, 1, tile_keys)
+        
+        put_kwargs = storage.s3.put_object.mock_calls[0][2]
+        partial = json.loads(put_kwargs['Body'].decode('utf8'))
+        
+        self.assertEqual(put_kwargs['Key'], 'uploads/sample-plan/partials/1.json')
+        self.assertEqual(partial['tiles'], tile_keys)
+        self.assertAlmostEqual(partial['totals']['uploads/sample-plan/geometries/0.wkt']['Voters'], 567.09, 2)
+        self.assertAlmostEqual(partial['totals']['uploads/sample-plan/geometries/1.wkt']['Voters'], 932.89, 2)
+        self.assertEqual(len(partial['totals']['uploads/sample-plan/geometries/0.wkt']['REP']), 10)
+        
+        districts = observe.accumulate_district_totals([partial['totals']],
+            data.Upload('sample-plan', None, districts=[None, None]))
+        self.assertEqual(districts[0]['totals']['Voters'], 567.09)
+        self.assertAlmostEqual(districts[0]['totals']['REP'][0], 310.01, 2)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.invoke_observer_lambda')
+    @unittest.mock.patch('planscore.observe.reduce_tile_group')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    def test_record_tile_completion(self, load_upload_index, list_completed_keys, reduce_tile_group,
+        invoke_observer_lambda, stdout):
+        ''' The last tile in a group merges it into a partial sum
+        '''
+        storage, upload = unittest.mock.Mock(), data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        load_upload_index.return_value = upload
+        group = dict(index=1, size=2, count=2)
+        
+        list_completed_keys.side_effect = [{'uploads/ID/groups/1/12/2047/2047.json'}]
+        self.assertFalse(observe.record_tile_completion(storage, upload, '12/2047/2047', group))
+        self.assertEqual(storage.s3.put_object.mock_calls[0][2]['Key'], 'uploads/ID/groups/1/12/2047/2047.json')
+        self.assertEqual(list_completed_keys.mock_calls[0][1][1], 'uploads/ID/groups/1/')
+        self.assertEqual(len(reduce_tile_group.mock_calls), 0)
+        self.assertEqual(len(invoke_observer_lambda.mock_calls), 0)
+        
+        list_completed_keys.side_effect = [{'uploads/ID/groups/1/12/2047/2047.json',
+            'uploads/ID/groups/1/12/2047/2048.json'}, {'uploads/ID/partials/1.json'}]
+        self.assertTrue(observe.record_tile_completion(storage, upload, '12/2047/2048', group))
+        self.assertEqual(reduce_tile_group.mock_calls[0][1][2], 1)
+        self.assertEqual(sorted(reduce_tile_group.mock_calls[0][1][3]),
+            ['uploads/ID/tiles/12/2047/2047.json', 'uploads/ID/tiles/12/2047/2048.json'])
+        self.assertEqual(list_completed_keys.mock_calls[2][1][1], 'uploads/ID/partials/')
+        self.assertEqual(invoke_observer_lambda.mock_calls[0][1], (storage, upload))
+        self.assertEqual(invoke_observer_lambda.mock_calls[0][2], dict(provisional=True))
+        
+        # The last partial sum starts the observer for final scores
+        list_completed_keys.side_effect = [{'uploads/ID/groups/1/12/2047/2047.json',
+            'uploads/ID/groups/1/12/2047/2048.json'}, {'uploads/ID/partials/0.json', 'uploads/ID/partials/1.json'}]
+        self.assertTrue(observe.record_tile_completion(storage, upload, '12/2047/2048', group))
+        self.assertEqual(invoke_observer_lambda.mock_calls[1][1], (storage, upload))
+        self.assertEqual(invoke_observer_lambda.mock_calls[1][2], {})
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_conditional_object')
+    @unittest.mock.patch('planscore.observe.invoke_observer_lambda')
+    @unittest.mock.patch('planscore.observe.reduce_tile_group')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    def test_record_tile_completion_duplicate(self, list_completed_keys, reduce_tile_group,
+        invoke_observer_lambda, put_conditional_object, stdout):
+        ''' A duplicate tile arriving after final scores leaves the index alone
+        '''
+        storage = unittest.mock.Mock()
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', districts=[None, None])
+        final_upload = upload.clone(progress=data.Progress(2, 2), summary={'Efficiency Gap': 0})
+        storage.s3.get_object.side_effect = lambda **kwargs: {'ETag': '"1"',
+            'Body': io.BytesIO(final_upload.to_json().encode('utf8'))}
+        group = dict(index=0, size=2, count=2)
+        
+        list_completed_keys.side_effect = [{'uploads/ID/groups/0/12/2047/2047.json',
+            'uploads/ID/groups/0/12/2047/2048.json'}]
+        self.assertFalse(observe.record_tile_completion(storage, upload, '12/2047/2048', group))
+        self.assertEqual(len(reduce_tile_group.mock_calls), 0)
+        self.assertEqual(len(invoke_observer_lambda.mock_calls), 0)
+        
+        # A provisional observer started before the final one finished changes nothing
+        list_completed_keys.side_effect = [{'uploads/ID/partials/0.json'},
+            {'uploads/ID/groups/0/12/2047/2047.json', 'uploads/ID/groups/0/12/2047/2048.json'}]
+        observe.publish_provisional_scores(storage, upload, [['a'], ['b']])
+        self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(1, 2), '"1"'))
+        self.assertEqual(len(put_conditional_object.mock_calls), 0)
+    
+    def test_put_conditional_object(self):
+        ''' Conditional headers are added to one signed S3 request
+        '''
+        s3, request = unittest.mock.Mock(), unittest.mock.Mock(headers={})
+        s3.put_object.side_effect = lambda **kwargs: \
+            s3.meta.events.register.mock_calls[0][1][1](request=request, operation_name='PutObject')
+        
+        self.assertTrue(observe.put_conditional_object(s3, 'If-Match', '"1"', Bucket='bucket', Key='key'))
+        self.assertEqual(request.headers, {'If-Match': '"1"'})
+        s3.put_object.assert_called_once_with(Bucket='bucket', Key='key')
+        self.assertEqual(s3.meta.events.register.mock_calls[0][1][0], 'before-sign.s3.PutObject')
+        self.assertEqual(s3.meta.events.unregister.mock_calls[0][2],
+            dict(unique_id=s3.meta.events.register.mock_calls[0][2]['unique_id']))
+        
+        s3.put_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.assertFalse(observe.put_conditional_object(s3, 'If-Match', '"1"', Bucket='bucket', Key='key'))
+        self.assertEqual(len(s3.meta.events.unregister.mock_calls), 2)
+        
+        s3.put_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+        with self.assertRaises(botocore.exceptions.ClientError):
+            observe.put_conditional_object(s3, 'If-Match', '"1"', Bucket='bucket', Key='key')
+        self.assertEqual(len(s3.meta.events.unregister.mock_calls), 3)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_conditional_object')
+    def test_put_provisional_upload(self, put_conditional_object, stdout):
+        ''' Provisional uploads replace only an unchanged index that is still in progress
+        '''
+        storage, put_conditional_object.return_value = unittest.mock.Mock(), True
+        upload = data.Upload('ID', None, summary={'Provisional': True})
+        
+        def index_object(upload, etag):
+            return {'Body': io.BytesIO(upload.to_json().encode('utf8')), 'ETag': etag}
+        
+        storage.s3.get_object.side_effect = lambda **kwargs: index_object(upload, '"1"')
+        
+        self.assertTrue(observe.put_provisional_upload(storage, upload, data.Progress(1, 4)))
+        storage.s3.get_object.assert_called_once_with(Bucket=storage.bucket, Key='uploads/ID/index.json')
+        self.assertEqual(len(put_conditional_object.mock_calls), 1, 'Should only write the JSON index')
+        self.assertEqual(put_conditional_object.mock_calls[0][1], (storage.s3, 'If-Match', '"1"'))
+        put_kwargs = put_conditional_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/index.json')
+        put_upload = data.Upload.from_json(put_kwargs['Body'].decode('utf8'))
+        self.assertEqual(put_upload.progress.to_list(), [1, 4])
+        self.assertIn('provisional', put_upload.message)
+        
+        # A given ETag still matching the index is written over
+        self.assertTrue(observe.put_provisional_upload(storage, upload, data.Progress(2, 4), '"1"'))
+        self.assertEqual(len(storage.s3.get_object.mock_calls), 2, 'Should read the index again')
+        
+        # An index changed since it was read is left alone, even if S3 would allow it
+        self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(3, 4), '"0"'))
+        self.assertEqual(len(put_conditional_object.mock_calls), 2)
+        
+        put_conditional_object.return_value = False
+        self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(3, 4), '"1"'))
+        put_conditional_object.return_value = True
+        
+        # Progress never goes backwards
+        storage.s3.get_object.side_effect = lambda **kwargs: \
+            index_object(upload.clone(progress=data.Progress(3, 4)), '"2"')
+        self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(2, 4)))
+        self.assertEqual(len(put_conditional_object.mock_calls), 3)
+        
+        # Complete indexes are never replaced, final or not
+        for index_upload in (upload.clone(progress=data.Progress(4, 4), summary={'Efficiency Gap': 0}),
+            upload.clone(progress=data.Progress(4, 4)), upload.clone(message=observe.OVERDUE_MESSAGE)):
+            storage.s3.get_object.side_effect = lambda **kwargs: index_object(index_upload, '"3"')
+            self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(3, 4)))
+            self.assertFalse(observe.put_provisional_upload(storage, upload, data.Progress(3, 4), '"3"'))
+        
+        self.assertEqual(len(put_conditional_object.mock_calls), 3)
+    
+    def test_get_tile_event(self):
+        ''' Tile events reference the upload and name the batch's group
+        '''
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson',
+            model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        tile_batches = [['data/XX/12/2047/2047.psb', 'data/XX/12/2047/2048.psb'], ['data/XX/12/2048/2048.psb']]
+        
+        event = observe.get_tile_event(storage, upload, tile_batches, 1)
+        
+        self.assertEqual(event['upload'], upload.to_reference())
+        self.assertEqual(event['tile_keys'], ['data/XX/12/2048/2048.psb'])
+        self.assertEqual(event['group'], dict(index=0, size=2, count=1))
+        self.assertEqual(observe.get_batch_marker(upload, tile_batches, 1),
+            'uploads/ID/groups/0/12/2048/2048.json')
+    
+    def test_get_straggler_deadline(self):
+        ''' Stragglers are due a multiple of their estimated cost after dispatch
+        '''
+        self.assertEqual(observe.get_straggler_deadline(dict(time=None, attempts=0)), 0)
+        self.assertEqual(observe.get_straggler_deadline(dict(time=100, attempts=1, cost=1)),
+            100 + constants.STRAGGLER_MIN_SECONDS)
+        self.assertEqual(observe.get_straggler_deadline(dict(time=100, attempts=1, cost=100)),
+            100 + constants.STRAGGLER_FACTOR * 100)
+        self.assertEqual(observe.get_straggler_deadline(dict(time=100, attempts=1, cost=None)),
+            100 + max(constants.STRAGGLER_MIN_SECONDS, constants.STRAGGLER_FACTOR * constants.TILE_BATCH_COST))
+        self.assertEqual(observe.get_straggler_deadline(dict(time=100, attempts=1, cost=1000)),
+            100 + constants.TILE_TIMEOUT_SECONDS, 'Should not wait past the tile Lambda timeout')
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    def test_redispatch_stragglers(self, boto3_client, stdout):
+        ''' Overdue batches are dispatched again until they run out of attempts
+        '''
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        tile_batches = [['data/XX/12/2047/2047.psb'], ['data/XX/12/2047/2048.psb'],
+            ['data/XX/12/2048/2047.psb'], ['data/XX/12/2048/2048.psb']]
+        tile_dispatch = {
+            0: dict(time=1000, attempts=1, cost=1),
+            1: dict(time=1, attempts=1, cost=1),
+            2: dict(time=1, attempts=constants.STRAGGLER_MAX_ATTEMPTS + 1, cost=1),
+            }
+        
+        next_deadline = observe.redispatch_stragglers(storage, upload, tile_batches,
+            tile_dispatch, [0, 1, 2, 3], 1001)
+        
+        invocations = boto3_client.return_value.invoke.mock_calls
+        payloads = [json.loads(call[2]['Payload'].decode('utf8')) for call in invocations]
+        self.assertEqual([payload['tile_keys'] for payload in payloads], tile_batches[1:2] + tile_batches[3:])
+        self.assertEqual(tile_dispatch[1], dict(time=1001, attempts=2, cost=1))
+        self.assertEqual(tile_dispatch[3], dict(time=1001, attempts=1))
+        self.assertEqual(next_deadline, 1000 + constants.STRAGGLER_MIN_SECONDS)
+        
+        next_deadline = observe.redispatch_stragglers(storage, upload, tile_batches,
+            tile_dispatch, [2], 1001)
+        self.assertIsNone(next_deadline, 'Should give up after last attempt')
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('planscore.observe.schedule_watch')
+    @unittest.mock.patch('planscore.observe.put_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    @unittest.mock.patch('planscore.observe.redispatch_stragglers')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_watch_tile_batches(self, load_tile_index, load_tile_dispatch, load_upload_index,
+        list_completed_keys, redispatch_stragglers, put_upload_index, put_tile_dispatch,
+        schedule_watch, time_sleep, stdout):
+        ''' Watcher checks once, schedules the next check when stragglers are due, and never sleeps
+        '''
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        load_tile_index.return_value = upload, [['data/XX/12/2047/2047.psb'], ['data/XX/12/2047/2048.psb']]
+        load_upload_index.return_value = upload
+        
+        list_completed_keys.side_effect = [{'uploads/ID/groups/0/12/2047/2047.json'}]
+        redispatch_stragglers.return_value = time.time() + 3600
+        
+        observe.watch_tile_batches(None, upload)
+        
+        self.assertEqual(list_completed_keys.mock_calls[0][1][1], 'uploads/ID/groups/')
+        self.assertEqual(redispatch_stragglers.mock_calls[0][1][4], [1])
+        self.assertIs(put_tile_dispatch.mock_calls[0][1][2], load_tile_dispatch.return_value)
+        self.assertEqual(schedule_watch.mock_calls[0][1][:2], (None, upload))
+        self.assertAlmostEqual(schedule_watch.mock_calls[0][1][2], 3600, -1, 'Should check again at the deadline')
+        self.assertEqual(len(put_upload_index.mock_calls), 0)
+        
+        # Stops once every batch is complete and merged
+        list_completed_keys.side_effect = [{'uploads/ID/groups/0/12/2047/2047.json',
+            'uploads/ID/groups/0/12/2047/2048.json'}, {'uploads/ID/partials/0.json'}]
+        
+        observe.watch_tile_batches(None, upload)
+        
+        self.assertEqual(list_completed_keys.mock_calls[2][1][1], 'uploads/ID/partials/')
+        self.assertEqual(len(redispatch_stragglers.mock_calls), 1)
+        self.assertEqual(len(schedule_watch.mock_calls), 1)
+        
+        # Gives up when every straggler has run out of attempts
+        list_completed_keys.side_effect = [{'uploads/ID/groups/0/12/2047/2047.json'}]
+        redispatch_stragglers.return_value = None
+        
+        observe.watch_tile_batches(None, upload)
+        
+        self.assertIn('Giving up', put_upload_index.mock_calls[0][1][1].message)
+        self.assertEqual(put_upload_index.mock_calls[0][1][1].progress.to_list(), [1, 2])
+        self.assertEqual(len(schedule_watch.mock_calls), 1)
+        
+        # Does nothing for an upload already given up on
+        load_upload_index.return_value = upload.clone(message=observe.OVERDUE_MESSAGE)
+        observe.watch_tile_batches(None, upload)
+        
+        self.assertEqual(len(list_completed_keys.mock_calls), 4)
+        self.assertEqual(len(time_sleep.mock_calls), 0)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.time')
+    @unittest.mock.patch('planscore.observe.schedule_watch')
+    @unittest.mock.patch('planscore.observe.invoke_observer_lambda')
+    @unittest.mock.patch('planscore.observe.reduce_tile_group')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_watch_tile_batches_unmerged(self, load_tile_index, load_tile_dispatch, load_upload_index,
+        list_completed_keys, reduce_tile_group, invoke_observer_lambda, schedule_watch, time_time, stdout):
+        ''' Watcher merges groups left unmerged by a failed tile Lambda and starts the observer
+        '''
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        load_tile_index.return_value = upload, [['data/XX/12/2047/2047.psb'], ['data/XX/12/2047/2048.psb'],
+            ['data/XX/12/2048/2047.psb'], ['data/XX/12/2048/2048.psb']]
+        load_upload_index.return_value = upload
+        time_time.return_value = 1000
+        
+        marker_keys = {'uploads/ID/groups/0/12/2047/2047.json', 'uploads/ID/groups/0/12/2047/2048.json',
+            'uploads/ID/groups/1/12/2048/2047.json', 'uploads/ID/groups/1/12/2048/2048.json'}
+        list_completed_keys.side_effect = [marker_keys, {'uploads/ID/partials/0.json'}] * 3
+        
+        observe.watch_tile_batches(None, upload)
+        
+        merge_time = 1000 + constants.STRAGGLER_MIN_SECONDS
+        self.assertEqual(schedule_watch.mock_calls[0][1][2:], (constants.STRAGGLER_MIN_SECONDS, merge_time),
+            'Should give the tile Lambda time to merge first')
+        self.assertEqual(len(reduce_tile_group.mock_calls), 0)
+        
+        # A check arriving early waits for the rest of the time
+        time_time.return_value = merge_time - 1
+        observe.watch_tile_batches(None, upload, merge_time)
+        
+        self.assertEqual(schedule_watch.mock_calls[1][1][2:], (1, merge_time))
+        self.assertEqual(len(reduce_tile_group.mock_calls), 0)
+        
+        time_time.return_value = merge_time + 1
+        observe.watch_tile_batches(None, upload, merge_time)
+        
+        self.assertEqual(len(schedule_watch.mock_calls), 2)
+        self.assertEqual(len(reduce_tile_group.mock_calls), 1)
+        self.assertEqual(reduce_tile_group.mock_calls[0][1][2], 1)
+        self.assertEqual(sorted(reduce_tile_group.mock_calls[0][1][3]),
+            ['uploads/ID/tiles/12/2048/2047.json', 'uploads/ID/tiles/12/2048/2048.json'])
+        self.assertEqual(invoke_observer_lambda.mock_calls[0][1], (None, upload))
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.time')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.schedule_watch')
+    @unittest.mock.patch('planscore.observe.put_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_dispatch')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_watch_tile_batches_failing(self, load_tile_index, load_tile_dispatch, load_upload_index,
+        list_completed_keys, put_upload_index, put_tile_dispatch, schedule_watch, boto3_client,
+        time_time, stdout):
+        ''' Watcher backs off and gives up on batches whose tile Lambda can never be invoked
+        '''
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'),
+            start_time=1000)
+        load_tile_index.return_value = upload, [['data/XX/12/2047/2047.psb'], ['data/XX/12/2047/2048.psb']]
+        load_tile_dispatch.return_value = {0: dict(time=1000, attempts=1, cost=1), 1: dict(time=1000, attempts=1, cost=1)}
+        load_upload_index.return_value = upload
+        list_completed_keys.return_value = {'uploads/ID/groups/0/12/2047/2047.json'}
+        boto3_client.return_value.invoke.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AccessDeniedException'}}, 'Invoke')
+        
+        time_time.return_value = 1000 + constants.STRAGGLER_MIN_SECONDS + 1
+        
+        for _ in range(constants.STRAGGLER_MAX_ATTEMPTS + 2):
+            observe.watch_tile_batches(storage, upload)
+            
+            if put_upload_index.mock_calls:
+                break
+            
+            delay = schedule_watch.mock_calls[-1][1][2]
+            self.assertGreaterEqual(delay, constants.STRAGGLER_MIN_SECONDS, 'Should back off')
+            time_time.return_value += delay + 1
+        
+        self.assertEqual(len(boto3_client.return_value.invoke.mock_calls), constants.STRAGGLER_MAX_ATTEMPTS)
+        self.assertEqual(load_tile_dispatch.return_value[1]['attempts'], constants.STRAGGLER_MAX_ATTEMPTS + 1)
+        self.assertEqual(load_tile_dispatch.return_value[0]['attempts'], 1, 'Completed batch is left alone')
+        self.assertEqual(put_upload_index.mock_calls[0][1][1].message, observe.OVERDUE_MESSAGE)
+        self.assertEqual(put_upload_index.mock_calls[0][1][1].progress.to_list(), [1, 2])
+        
+        # Past the upload time limit, gives up without checking dispatch times
+        put_upload_index.reset_mock()
+        load_tile_dispatch.reset_mock()
+        time_time.return_value = 1000 + constants.UPLOAD_TIME_LIMIT + 1
+        load_upload_index.return_value = upload
+        
+        observe.watch_tile_batches(storage, upload)
+        
+        self.assertEqual(len(load_tile_dispatch.mock_calls), 0)
+        self.assertEqual(put_upload_index.mock_calls[0][1][1].message, observe.OVERDUE_MESSAGE)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    def test_schedule_watch(self, boto3_client, stdout):
+        ''' Straggler checks are delayed SQS messages, no longer than SQS allows
+        '''
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', start_time=1)
+        
+        with unittest.mock.patch('planscore.constants.WATCH_QUEUE_URL', 'https://sqs/queue'):
+            observe.schedule_watch(storage, upload, 29.5)
+            observe.schedule_watch(storage, upload, 3600, 1000)
+            observe.schedule_watch(storage, upload, -10)
+        
+        send_kwargs1, send_kwargs2, send_kwargs3 = [call[2] for call in boto3_client.return_value.send_message.mock_calls]
+        self.assertEqual(boto3_client.mock_calls[0][1], ('sqs', ))
+        self.assertEqual(send_kwargs1['QueueUrl'], 'https://sqs/queue')
+        self.assertEqual(send_kwargs1['DelaySeconds'], 30)
+        self.assertEqual(json.loads(send_kwargs1['MessageBody']), dict(upload=upload.to_reference(),
+            storage=storage.to_event(), merge_time=None))
+        self.assertEqual(send_kwargs2['DelaySeconds'], constants.WATCH_MAX_DELAY)
+        self.assertEqual(json.loads(send_kwargs2['MessageBody'])['merge_time'], 1000)
+        self.assertEqual(send_kwargs3['DelaySeconds'], 0)
+        
+        # A missing queue fails loudly
+        with unittest.mock.patch('planscore.constants.WATCH_QUEUE_URL', None):
+            with self.assertRaises(ValueError):
+                observe.schedule_watch(storage, upload, 30)
+        
+        self.assertEqual(len(boto3_client.return_value.send_message.mock_calls), 3)
+    
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    @unittest.mock.patch('planscore.observe.watch_tile_batches')
+    def test_lambda_handler_watch(self, watch_tile_batches, load_tile_index, boto3_client):
+        ''' Messages from the watch queue are each checked once by the watcher
+        '''
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        body1 = json.dumps(dict(upload=upload.to_reference(), storage=storage.to_event(), merge_time=None))
+        body2 = json.dumps(dict(upload=upload.to_reference(), storage=storage.to_event(), merge_time=1000))
+        
+        observe.lambda_handler(dict(Records=[dict(body=body1), dict(body=body2)]), None)
+        
+        self.assertEqual(len(watch_tile_batches.mock_calls), 2)
+        self.assertEqual(watch_tile_batches.mock_calls[0][1][0].bucket, 'bucket-name')
+        self.assertIs(watch_tile_batches.mock_calls[0][1][0].s3, boto3_client.return_value)
+        self.assertEqual(watch_tile_batches.mock_calls[0][1][1].id, 'ID')
+        self.assertEqual([call[1][2] for call in watch_tile_batches.mock_calls], [None, 1000])
+        self.assertEqual(len(load_tile_index.mock_calls), 0, 'Should not start scoring')
+    
+    @unittest.mock.patch('boto3.client')
+    def test_invoke_observer_lambda(self, boto3_client):
+        ''' Observer is invoked with a reference to the upload
+        '''
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', start_time=1)
+        
+        observe.invoke_observer_lambda(storage, upload)
+        
+        invoke_kwargs = boto3_client.return_value.invoke.mock_calls[0][2]
+        self.assertEqual(invoke_kwargs['FunctionName'], observe.FUNCTION_NAME)
+        self.assertEqual(invoke_kwargs['InvocationType'], 'Event')
+        self.assertEqual(json.loads(invoke_kwargs['Payload'].decode('utf8'))['upload'],
+            dict(id='ID', key='uploads/ID/upload/file.geojson', model=None))
+        self.assertFalse(json.loads(invoke_kwargs['Payload'].decode('utf8'))['provisional'])
+        
+        observe.invoke_observer_lambda(storage, upload, provisional=True)
+        
+        invoke_kwargs = boto3_client.return_value.invoke.mock_calls[1][2]
+        self.assertTrue(json.loads(invoke_kwargs['Payload'].decode('utf8'))['provisional'])
+    
+    def test_update_model_costs(self):
+        ''' Measured runtimes per district are blended into model costs
+        '''
+        timings = {'a': dict(seconds=4, districts=2), 'b': dict(seconds=3, districts=1),
+            'c': dict(seconds=1, districts=0)}
+        costs = observe.update_model_costs({'a': 1, 'd': 5}, timings)
+        
+        self.assertAlmostEqual(costs['a'], 1 + (2 - 1) * constants.TILE_COST_WEIGHT)
+        self.assertEqual(costs['b'], 3)
+        self.assertNotIn('c', costs)
+        self.assertEqual(costs['d'], 5)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_conditional_object')
+    def test_put_model_costs(self, put_conditional_object, stdout):
+        ''' Model costs are updated in S3 once for each upload
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix, put_conditional_object.return_value = 'data/XX/003/', True
+        upload = data.Upload('ID', None, model=model)
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"a": 1}')}
+        
+        observe.put_model_costs(storage, upload, {'b': dict(seconds=2, districts=1)})
+        
+        self.assertEqual(put_conditional_object.mock_calls[0][1], (storage.s3, 'If-None-Match', '*'))
+        self.assertEqual(put_conditional_object.mock_calls[0][2]['Key'], 'uploads/ID/timings.json')
+        storage.s3.get_object.assert_called_once_with(Bucket=storage.bucket, Key='data/XX/003/costs.json')
+        put_kwargs = storage.s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'data/XX/003/costs.json')
+        self.assertEqual(json.loads(put_kwargs['Body'].decode('utf8')), {'a': 1, 'b': 2})
+        
+        # Timings already recorded for this upload are not blended in again
+        put_conditional_object.return_value = False
+        observe.put_model_costs(storage, upload, {'b': dict(seconds=2, districts=1)})
+        self.assertEqual(len(storage.s3.put_object.mock_calls), 1)
+        self.assertEqual(len(storage.s3.get_object.mock_calls), 1)
+        
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertEqual(observe.load_model_costs(storage, model), {})
+        
+        observe.put_model_costs(storage, upload, {})
+        self.assertEqual(len(put_conditional_object.mock_calls), 2, 'Should skip empty timings')
+    
     @unittest.mock.patch('sys.stdout')
-    def test_iterate_tile_totals(self, stdout):
-        ''' Expected counts are returned from tiles.
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    def test_iterate_tile_totals(self, load_upload_index, time_sleep, stdout):
+        ''' Expected counts are returned from tiles in the order they complete.
         '''
         upload = unittest.mock.Mock()
+        upload.id = 'sample-plan'
+        load_upload_index.return_value = data.Upload('sample-plan', None)
         context = unittest.mock.Mock()
         context.get_remaining_time_in_millis.return_value = 9999
-        
-        storage = unittest.mock.Mock()
-        storage.s3.get_object.side_effect = mock_s3_get_object
 
         expected_tiles = [f'uploads/sample-plan/tiles/{zxy}.json' for zxy
             in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048')]
         
-        totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context))
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.side_effect = [
+            {'IsTruncated': False},
+            {'Contents': [{'Key': key} for key in expected_tiles[2:]], 'IsTruncated': False},
+            {'Contents': [{'Key': key} for key in expected_tiles], 'IsTruncated': False},
+            ]
+        
+        timings = {}
+        totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context, timings))
         
         self.assertEqual(len(totals), 4)
-        self.assertEqual(totals[0]['uploads/sample-plan/geometries/0.wkt']['Voters'], 252.45)
-        self.assertEqual(totals[1]['uploads/sample-plan/geometries/0.wkt']['Voters'], 314.64)
-        self.assertNotIn('Voters', totals[2]['uploads/sample-plan/geometries/0.wkt'])
-        self.assertNotIn('Voters', totals[3]['uploads/sample-plan/geometries/0.wkt'])
-        self.assertEqual(totals[0]['uploads/sample-plan/geometries/1.wkt']['Voters'],  87.2)
-        self.assertEqual(totals[1]['uploads/sample-plan/geometries/1.wkt']['Voters'],  15.94)
-        self.assertEqual(totals[2]['uploads/sample-plan/geometries/1.wkt']['Voters'], 455.99)
-        self.assertEqual(totals[3]['uploads/sample-plan/geometries/1.wkt']['Voters'], 373.76)
+        self.assertEqual(timings, {}, 'Older tile outputs have no timings')
+        self.assertEqual(len(time_sleep.mock_calls), 1, 'Should only wait when nothing is new')
+        self.assertEqual(storage.s3.list_objects.mock_calls[0][2]['Prefix'], 'uploads/sample-plan/tiles/12/')
+        
+        self.assertEqual(sorted(total['uploads/sample-plan/geometries/1.wkt']['Voters']
+            for total in totals[:2]), [373.76, 455.99], 'Later tiles should come first')
+        self.assertEqual(sorted(total['uploads/sample-plan/geometries/1.wkt']['Voters']
+            for total in totals[2:]), [15.94, 87.2])
+        self.assertEqual(sorted(total['uploads/sample-plan/geometries/0.wkt'].get('Voters', 0)
+            for total in totals), [0, 0, 252.45, 314.64])
+        
+        # Waiting stops once the upload is given up on
+        load_upload_index.return_value = data.Upload('sample-plan', None, message=observe.OVERDUE_MESSAGE)
+        storage.s3.list_objects.side_effect = [{'IsTruncated': False}]
+        totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context))
+        
+        self.assertEqual(totals, [])
+        self.assertEqual(len(time_sleep.mock_calls), 1)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('time.sleep')
+    def test_iterate_tile_totals_overdue(self, time_sleep, stdout):
+        ''' Iteration stops early when the observer runs out of time.
+        '''
+        upload = data.Upload('sample-plan', None)
+        context = unittest.mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 1000
+        
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.return_value = {'Contents': [
+            {'Key': 'uploads/sample-plan/tiles/12/2047/2047.json'}], 'IsTruncated': False}
+        
+        expected_tiles = ['uploads/sample-plan/tiles/12/2047/2047.json',
+            'uploads/sample-plan/tiles/12/2047/2048.json']
+        consumed = set()
+        totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context, None, consumed))
+        
+        self.assertEqual(len(totals), 1)
+        self.assertEqual(consumed, {'uploads/sample-plan/tiles/12/2047/2047.json'})
+        self.assertEqual(len(storage.s3.put_object.mock_calls), 0, 'Should not give up')
+        
+        # Consumed tiles are not read again
+        storage.s3.list_objects.return_value = {'Contents': [
+            {'Key': key} for key in expected_tiles], 'IsTruncated': False}
+        totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context, None, consumed))
+        
+        self.assertEqual(len(totals), 1)
+        self.assertEqual(consumed, set(expected_tiles))
+        self.assertEqual(storage.s3.get_object.mock_calls[-1][2]['Key'], expected_tiles[1])
+    
+    def test_observer_checkpoint(self):
+        ''' Unfinished district totals and consumed tiles are saved and loaded
+        '''
+        storage, upload = unittest.mock.Mock(), data.Upload('ID', None)
+        districts = [dict(totals={'Voters': 1.5, 'REP': numpy.array([1., 2.])}, compactness={})]
+        
+        observe.put_observer_checkpoint(storage, upload, districts, {'b', 'a'}, {'t': dict(seconds=1)})
+        
+        put_kwargs = storage.s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/checkpoint.json')
+        
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(put_kwargs['Body'])}
+        checkpoint = observe.load_observer_checkpoint(storage, upload)
+        
+        self.assertEqual(checkpoint['consumed'], {'a', 'b'})
+        self.assertEqual(checkpoint['timings'], {'t': dict(seconds=1)})
+        self.assertEqual(checkpoint['districts'], [dict(totals={'Voters': 1.5, 'REP': [1, 2]}, compactness={})])
+        
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertIsNone(observe.load_observer_checkpoint(storage, upload))
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    @unittest.mock.patch('planscore.observe.put_model_costs')
+    @unittest.mock.patch('planscore.observe.put_observer_checkpoint')
+    @unittest.mock.patch('planscore.observe.load_observer_checkpoint')
+    @unittest.mock.patch('planscore.observe.invoke_observer_lambda')
+    @unittest.mock.patch('planscore.observe.iterate_tile_totals')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_lambda_handler_continuation(self, load_tile_index, load_upload_index, iterate_tile_totals,
+        invoke_observer_lambda, load_observer_checkpoint, put_observer_checkpoint, put_model_costs,
+        put_upload_index, boto3_client, stdout):
+        ''' Observer saves a checkpoint and continues itself when out of time
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        load_tile_index.return_value = upload, [['tile1'], ['tile2']]
+        load_upload_index.return_value = upload
+        load_observer_checkpoint.return_value = dict(consumed=set(), timings={},
+            districts=[dict(totals={'Voters': 1}), dict(totals={'Voters': 2})])
+        iterate_tile_totals.return_value = iter([])
+        
+        event = dict(upload=upload.to_reference(), storage=dict(bucket='bucket-name', prefix='data/XX'))
+        
+        with unittest.mock.patch('planscore.constants.REDUCE_FAN_IN', 1):
+            observe.lambda_handler(event, None)
+        
+        self.assertEqual(iterate_tile_totals.mock_calls[0][1][0],
+            ['uploads/sample-plan/partials/0.json', 'uploads/sample-plan/partials/1.json'])
+        self.assertEqual(put_observer_checkpoint.mock_calls[0][1][2][1]['totals'], {'Voters': 2})
+        self.assertEqual(invoke_observer_lambda.mock_calls[0][1][2], 1)
+        self.assertEqual(len(put_model_costs.mock_calls), 0)
+        self.assertEqual(len(put_upload_index.mock_calls), 0)
+        
+        # Gives up without finishing after too many continuations
+        event.update(continuation=constants.OBSERVE_MAX_CONTINUATIONS)
+        iterate_tile_totals.return_value = iter([])
+        
+        with unittest.mock.patch('planscore.constants.REDUCE_FAN_IN', 1):
+            observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(invoke_observer_lambda.mock_calls), 1)
+        self.assertNotIn([4, 4], [call[1][1].progress.to_list() for call in put_upload_index.mock_calls])
+        self.assertIn('Giving up', put_upload_index.mock_calls[0][1][1].message)
+        self.assertEqual(put_upload_index.mock_calls[0][1][1].progress.to_list(), [0, 2])
+        
+        # Stops without continuing once the watcher gives up
+        event.update(continuation=1)
+        iterate_tile_totals.return_value = iter([])
+        load_upload_index.side_effect = [upload, upload.clone(message=observe.OVERDUE_MESSAGE)]
+        
+        with unittest.mock.patch('planscore.constants.REDUCE_FAN_IN', 1):
+            observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(invoke_observer_lambda.mock_calls), 1)
+        self.assertEqual(len(put_observer_checkpoint.mock_calls), 1)
+        
+        # Does nothing for an upload already given up on
+        load_upload_index.side_effect = None
+        load_upload_index.return_value = upload.clone(message=observe.OVERDUE_MESSAGE)
+        
+        with unittest.mock.patch('planscore.constants.REDUCE_FAN_IN', 1):
+            observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(iterate_tile_totals.mock_calls), 3)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    @unittest.mock.patch('planscore.observe.put_model_costs')
+    @unittest.mock.patch('planscore.observe.load_upload_geometries')
+    @unittest.mock.patch('planscore.observe.load_observer_checkpoint')
+    @unittest.mock.patch('planscore.observe.iterate_tile_totals')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_lambda_handler_compactness(self, load_tile_index, load_upload_index, iterate_tile_totals,
+        load_observer_checkpoint, load_upload_geometries, put_model_costs, put_upload_index, boto3_client, stdout):
+        ''' Observer uses compactness forwarded with the upload instead of loading geometries
+        '''
+        upload = data.Upload('sample-plan', None, districts=[
+            dict(compactness={'Reock': .5}), dict(compactness={'Reock': .6})])
+        load_tile_index.return_value = upload, [['tile1']]
+        load_upload_index.return_value = data.Upload('sample-plan', None)
+        load_observer_checkpoint.return_value = None
+        
+        def iterate_tile_totals_(expected_tiles, storage, upload, context, timings, consumed):
+            consumed.update(expected_tiles)
+            yield {'uploads/sample-plan/geometries/0.wkt': {'Voters': 1},
+                'uploads/sample-plan/geometries/1.wkt': {'Voters': 2}}
+        
+        iterate_tile_totals.side_effect = iterate_tile_totals_
+        event = dict(upload=upload.to_reference(), storage=dict(bucket='bucket-name', prefix='data/XX'))
+        observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(load_upload_geometries.mock_calls), 0)
+        final_upload = put_upload_index.mock_calls[-1][1][1]
+        self.assertEqual(final_upload.districts[1]['compactness'], {'Reock': .6})
+        self.assertEqual(final_upload.districts[1]['totals']['Voters'], 2)
     
-    def test_accumulate_district_totals(self):
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    @unittest.mock.patch('planscore.observe.put_model_costs')
+    @unittest.mock.patch('planscore.observe.load_observer_checkpoint')
+    @unittest.mock.patch('planscore.observe.iterate_tile_totals')
+    @unittest.mock.patch('planscore.observe.load_upload_index')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_lambda_handler_twice(self, load_tile_index, load_upload_index, iterate_tile_totals,
+        load_observer_checkpoint, put_model_costs, put_upload_index, boto3_client, stdout):
+        ''' Observer invoked twice for the same tiles publishes and records costs once
         '''
+        upload = data.Upload('sample-plan', None, districts=[dict(compactness={}), dict(compactness={})])
+        finished_upload = upload.clone(progress=data.Progress(1, 1), summary={'Efficiency Gap': 0})
+        load_tile_index.return_value = upload, [['tile1']]
+        load_observer_checkpoint.return_value = None
+        
+        def iterate_tile_totals_(expected_tiles, storage, upload, context, timings, consumed):
+            consumed.update(expected_tiles)
+            timings.update(tile1=dict(seconds=1, districts=2))
+            yield {'uploads/sample-plan/geometries/0.wkt': {'Voters': 1}}
+        
+        iterate_tile_totals.side_effect = iterate_tile_totals_
+        event = dict(upload=upload.to_reference(), storage=dict(bucket='bucket-name', prefix='data/XX'))
+        
+        # Another observer finished while this one was scoring
+        load_upload_index.side_effect = [upload, finished_upload]
+        observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(put_model_costs.mock_calls), 0)
+        self.assertEqual(len(put_upload_index.mock_calls), 0)
+        
+        # Another observer finished before this one started
+        load_upload_index.side_effect = [finished_upload]
+        observe.lambda_handler(event, None)
+        
+        self.assertEqual(len(iterate_tile_totals.mock_calls), 1)
+        self.assertEqual(len(put_upload_index.mock_calls), 0)
+    
+    def test_add_tile_totals(self):
+        ''' District totals are accumulated from tiles, preserving existing values
         '''
         upload = unittest.mock.Mock()
         upload.id = 'sample-plan'
@@ -145,6 +897,9 @@ class TestObserveTiles (unittest.TestCase):
         self.assertEqual(districts1[1]['totals']['Households 2016'], 466.45)
         self.assertAlmostEqual(districts1[0]['totals']['Household Income 2016'], 59000, -1)
         self.assertAlmostEqual(districts1[1]['totals']['Household Income 2016'], 59000, -1)
+        self.assertEqual(len(districts1[0]['totals']['REP']), 10)
+        self.assertEqual(len(districts1[1]['totals']['DEM']), 10)
+        self.assertAlmostEqual(districts1[0]['totals']['REP'][0], 310.01, 2)
 
         upload.districts = [{'compactness': True}, {'compactness': False}]
         districts2 = observe.accumulate_district_totals(inputs, upload)
@@ -166,6 +921,202 @@ class TestObserveTiles (unittest.TestCase):
         self.assertEqual(districts3[0]['totals']['Voters'], 567.09)
         self.assertEqual(districts3[1]['totals']['Voters'], 932.89)
 
+    def test_add_tile_totals_precision(self):
+        ''' Small tile totals add up without losing precision to rounding
+        '''
+        upload = unittest.mock.Mock()
+        upload.id, upload.districts = 'sample-plan', [None]
+        
+        inputs = [{'uploads/sample-plan/geometries/0.wkt': {'Voters': .004, 'REP': [.004, 1]}}] * 1000
+        districts = observe.accumulate_district_totals(inputs, upload)
+        
+        self.assertEqual(districts[0]['totals']['Voters'], 4.)
+        self.assertAlmostEqual(districts[0]['totals']['REP'][0], 4., 9)
+        self.assertAlmostEqual(districts[0]['totals']['REP'][1], 1000., 9)
+    
+    def test_round_totals_stages(self):
+        ''' Rounding tile outputs and partial sums leaves published totals unchanged
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None])
+        geometry_key = 'uploads/sample-plan/geometries/0.wkt'
+        tile_value = numpy.array([.0041234567891, 1.2345678912345])
+        tile_outputs = [tiles.round_tile_totals({geometry_key: {'Voters': tile_value[0], 'REP': tile_value}})
+            for _ in range(5000)]
+        partial_outputs = []
+        
+        for start in range(0, len(tile_outputs), 64):
+            partial_totals = {}
+            for tile_output in tile_outputs[start:start+64]:
+                tiles.add_batch_totals(partial_totals, tile_output)
+            partial_outputs.append(tiles.round_tile_totals(partial_totals))
+        
+        districts = observe.start_district_totals(upload)
+        for partial_output in partial_outputs:
+            observe.add_tile_totals(districts, partial_output, upload)
+        totals = observe.finish_district_totals(districts)[0]['totals']
+        
+        self.assertEqual(totals['Voters'], round(5000 * tile_value[0], constants.ROUND_COUNT))
+        self.assertEqual(totals['Voters'], 20.62)
+        self.assertAlmostEqual(totals['REP'][0], 5000 * tile_value[0], 3)
+        self.assertAlmostEqual(totals['REP'][1], 5000 * tile_value[1], 3)
+    
+    def test_round_totals(self):
+        ''' Plain totals are rounded for publishing while simulations are not
+        '''
+        totals = observe.round_totals({'Voters': 1.23456, 'REP': numpy.array([1.23456])})
+        
+        self.assertEqual(totals['Voters'], 1.23)
+        self.assertEqual(totals['REP'].tolist(), [1.23456])
+
+    def test_score_provisional_upload(self):
+        ''' Provisional scores for all tiles match final scores.
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        inputs = []
+        
+        for zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
+            tile_key = f'uploads/sample-plan/tiles/{zxy}.json'
+            filename = os.path.join(os.path.dirname(__file__), 'data', tile_key)
+            with open(filename) as file:
+                inputs.append(json.load(file).get('totals'))
+        
+        districts1 = observe.start_district_totals(upload)
+        observe.add_tile_totals(districts1, inputs[0], upload)
+        upload1 = observe.score_provisional_upload(upload, districts1)
+
+        self.assertTrue(upload1.summary['Provisional'])
+        self.assertIn('Efficiency Gap', upload1.summary)
+        self.assertEqual(upload1.districts[0]['totals']['Voters'], 252.45)
+        self.assertNotIn('REP', upload1.districts[0]['totals'])
+        upload1.to_json()
+
+        for tile_total in inputs[1:]:
+            observe.add_tile_totals(districts1, tile_total, upload)
+
+        upload2 = observe.score_provisional_upload(upload, districts1)
+        districts3 = observe.accumulate_district_totals(inputs, upload)
+        upload3 = score.calculate_biases(score.calculate_bias(upload.clone(districts=districts3)))
+        
+        self.assertTrue(upload2.summary.pop('Provisional'))
+        self.assertEqual(upload2.summary, upload3.summary)
+        self.assertEqual(upload2.districts, upload3.districts)
+    
+    def test_score_provisional_upload_incomplete(self):
+        ''' Provisional scores are left out for incompletely-scored districts.
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        districts = observe.start_district_totals(upload)
+        observe.add_tile_totals(districts, {'uploads/sample-plan/geometries/0.wkt':
+            {'Voters': 1, 'REP': [1, 2], 'DEM': [2, 1]}}, upload)
+        
+        upload1 = observe.score_provisional_upload(upload, districts)
+        self.assertEqual(upload1.summary, {'Provisional': True})
+        self.assertEqual(upload1.districts[0]['totals'], {'Voters': 1})
+        upload1.to_json()
+    
+    def test_score_provisional_upload_plaintext(self):
+        ''' Provisional scores keep compactness forwarded with the upload.
+        '''
+        upload = data.Upload('sample-plan', None, districts=[
+            dict(compactness={'Reock': .5}), dict(compactness={'Reock': .6})])
+        districts = observe.start_district_totals(upload)
+        observe.add_tile_totals(districts, {'uploads/sample-plan/geometries/0.wkt': {'Voters': 1},
+            'uploads/sample-plan/geometries/1.wkt': {'Voters': 2}}, upload)
+        
+        plaintext = observe.score_provisional_upload(upload, districts).to_plaintext()
+        self.assertEqual(plaintext.splitlines()[0].split('\t'), ['District', 'Voters', 'Reock'])
+        self.assertEqual(plaintext.splitlines()[2].split('\t'), ['2', '2.0', '0.6'])
+    
+    def test_accumulate_district_totals_unfinished(self):
+        ''' District totals continue accumulating into an unfinished district array.
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        inputs = []
+        
+        for zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
+            tile_key = f'uploads/sample-plan/tiles/{zxy}.json'
+            filename = os.path.join(os.path.dirname(__file__), 'data', tile_key)
+            with open(filename) as file:
+                inputs.append(json.load(file).get('totals'))
+        
+        districts1 = observe.accumulate_district_totals(inputs, upload)
+        
+        districts = observe.start_district_totals(upload)
+        observe.accumulate_district_totals(iter(inputs[:2]), upload, districts)
+        districts2 = observe.accumulate_district_totals(iter(inputs[2:]), upload, districts)
+        self.assertEqual(districts2[0]['totals']['Voters'], districts1[0]['totals']['Voters'])
+        self.assertEqual(districts2[1]['totals']['REP'].tolist(), districts1[1]['totals']['REP'].tolist())
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_provisional_upload')
+    @unittest.mock.patch('planscore.observe.fetch_tile_output')
+    @unittest.mock.patch('planscore.observe.list_completed_keys')
+    @unittest.mock.patch('planscore.observe.load_upload_index_etag')
+    def test_publish_provisional_scores(self, load_upload_index_etag, list_completed_keys,
+        fetch_tile_output, put_provisional_upload, stdout):
+        ''' Provisional scores are published from partial sums merged so far.
+        '''
+        storage = unittest.mock.Mock()
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        tile_batches = [['a'], ['b'], ['c'], ['d'], ['e']]
+        inputs = {}
+        
+        for (index, zxy) in enumerate(('12/2047/2047', '12/2047/2048')):
+            tile_key = f'uploads/sample-plan/tiles/{zxy}.json'
+            filename = os.path.join(os.path.dirname(__file__), 'data', tile_key)
+            with open(filename) as file:
+                inputs[f'uploads/sample-plan/partials/{index}.json'] = json.load(file)
+        
+        load_upload_index_etag.return_value = upload, '"1"'
+        list_completed_keys.side_effect = [set(inputs), {'uploads/sample-plan/groups/0/a.json',
+            'uploads/sample-plan/groups/0/b.json', 'uploads/sample-plan/groups/1/c.json'}]
+        fetch_tile_output.side_effect = lambda storage, key: inputs[key]
+        
+        observe.publish_provisional_scores(storage, upload, tile_batches)
+        self.assertEqual(list_completed_keys.mock_calls[0][1][1], 'uploads/sample-plan/partials/')
+        self.assertEqual(list_completed_keys.mock_calls[1][1][1], 'uploads/sample-plan/groups/')
+        
+        _, put_upload, progress, index_etag = put_provisional_upload.mock_calls[0][1]
+        districts = observe.accumulate_district_totals([input['totals'] for input in inputs.values()], upload)
+        self.assertTrue(put_upload.summary['Provisional'])
+        self.assertIn('Efficiency Gap', put_upload.summary)
+        self.assertEqual(put_upload.districts[0]['totals']['Voters'], districts[0]['totals']['Voters'])
+        self.assertEqual(progress.to_list(), [3, 5], 'Should count tile batches')
+        self.assertEqual(index_etag, '"1"')
+        
+        # Final scores are never replaced
+        load_upload_index_etag.return_value = upload.clone(progress=data.Progress(4, 4),
+            summary={'Efficiency Gap': 0}), '"2"'
+        observe.publish_provisional_scores(storage, upload, tile_batches)
+        self.assertEqual(len(put_provisional_upload.mock_calls), 1)
+        
+        # Uploads given up on stay that way
+        load_upload_index_etag.return_value = upload.clone(message=observe.OVERDUE_MESSAGE), '"3"'
+        observe.publish_provisional_scores(storage, upload, tile_batches)
+        self.assertEqual(len(put_provisional_upload.mock_calls), 1)
+        self.assertEqual(len(fetch_tile_output.mock_calls), 2)
+    
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.observe.iterate_tile_totals')
+    @unittest.mock.patch('planscore.observe.publish_provisional_scores')
+    @unittest.mock.patch('planscore.observe.load_tile_index')
+    def test_lambda_handler_provisional(self, load_tile_index, publish_provisional_scores,
+        iterate_tile_totals, boto3_client):
+        ''' Provisional invocations publish scores so far and do not wait for tiles
+        '''
+        upload = data.Upload('sample-plan', None, districts=[None, None])
+        load_tile_index.return_value = upload, [['tile1'], ['tile2']]
+        event = dict(upload=upload.to_reference(), storage=dict(bucket='bucket-name', prefix='data/XX'),
+            provisional=True)
+        
+        observe.lambda_handler(event, None)
+        
+        storage, upload2, tile_batches = publish_provisional_scores.mock_calls[0][1]
+        self.assertEqual(storage.bucket, 'bucket-name')
+        self.assertIs(upload2, upload)
+        self.assertEqual(tile_batches, [['tile1'], ['tile2']])
+        self.assertEqual(len(iterate_tile_totals.mock_calls), 0)
+    
     def test_adjust_household_income(self):
         '''
         '''
@@ -227,3 +227,56 @@ class TestPrepareState (unittest.TestCase):
         self.assertEqual(feature['geometry']['type'], 'Polygon')
         self.assertEqual(len(feature['geometry']['coordinates'][0]), 5)
         self.assertEqual(feature['geometry']['coordinates'][0][0], [1, 1])
+        
+    def test_feature_bundle_parts(self):
+        ''' feature_bundle_parts() returns properties, WKB, envelope, and simulations.
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.INDEX_FIELD, ogr.OFTInteger))
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        
+        feature = ogr.Feature(feature_defn)
+        feature.SetField(prepare_state.INDEX_FIELD, 7)
+        feature.SetField(prepare_state.FRACTION_FIELD, .5)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 3], [2, 3], [2, 1], [1, 1]]]}'))
+        
+        properties, wkb, envelope, simulations = prepare_state.feature_bundle_parts(feature,
+            {'Population': 999, 'REP000': 3, 'REP001': 4, 'DEM000': 5})
+        
+        self.assertEqual(properties, {'Population': 999,
+            prepare_state.INDEX_FIELD: 7, prepare_state.FRACTION_FIELD: .5})
+        self.assertEqual(ogr.CreateGeometryFromWkb(wkb).GetArea(), 2)
+        self.assertEqual(envelope, (1, 2, 1, 3))
+        self.assertEqual(simulations, {'REP': [3, 4], 'DEM': [5]})
+    
+    def test_count_vertices(self):
+        ''' count_vertices() counts points in every part of a geometry.
+        '''
+        self.assertEqual(prepare_state.count_vertices(None), 0)
+        self.assertEqual(prepare_state.count_vertices(ogr.CreateGeometryFromWkt('POINT (1 1)')), 1)
+        self.assertEqual(prepare_state.count_vertices(ogr.CreateGeometryFromWkt(
+            'MULTIPOLYGON (((0 0, 0 1, 1 1, 0 0)), ((2 2, 2 3, 3 3, 3 2, 2 2)))')), 9)
+    
+    def test_tile_manifest_entry(self):
+        ''' tile_manifest_entry() returns cost signals and weighted totals.
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        
+        feature1, feature2 = ogr.Feature(feature_defn), ogr.Feature(feature_defn)
+        feature1.SetField(prepare_state.FRACTION_FIELD, .5)
+        feature1.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 1, 1 1, 0 0))'))
+        feature2.SetGeometry(ogr.CreateGeometryFromWkt('POINT (1 1)'))
+        bbox_geom = ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 2, 2 2, 2 0, 0 0))')
+        
+        entry = prepare_state.tile_manifest_entry('data/XX/12/1/2.psb', '12/1/2', 99, bbox_geom,
+            [feature1, feature2], [{'Voters': 10, 'Household Income 2016': 5}, {'Voters': 3}])
+        
+        self.assertEqual(entry['key'], 'data/XX/12/1/2.psb')
+        self.assertEqual(entry['zxy'], '12/1/2')
+        self.assertEqual(entry['size'], 99)
+        self.assertEqual(entry['features'], 2)
+        self.assertEqual(entry['vertices'], 5)
+        self.assertEqual(entry['envelope'], [0, 2, 0, 2])
+        self.assertEqual(dict(entry['totals']), {'Voters': 8})
@@ -1,7 +1,8 @@
-import unittest, unittest.mock, io, os, contextlib, json, gzip, itertools
+import unittest, unittest.mock, io, os, contextlib, json, gzip, itertools, statistics, random
 from .. import score, data
 import botocore.exceptions
 from osgeo import ogr, gdal
+import numpy
 
 should_gzip = itertools.cycle([True, False])
 
@@ -110,10 +111,125 @@ class TestScore (unittest.TestCase):
         self.assertAlmostEqual(pb4, .2, places=2,
             msg='Should see +blue PB with 40% blue vote share and 60% blue seats')
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_bias(self, calculate_EG, calculate_PB, calculate_MMD):
+    def test_swing_votes(self):
+        ''' Vote swing is correctly calculated for simulation arrays
+        '''
+        reds1, blues1 = score.swing_votes(numpy.array([[1, 2, 3]]), numpy.array([[3, 2, 1]]), 0)
+        self.assertEqual(reds1.tolist(), [[1, 2, 3]])
+        self.assertEqual(blues1.tolist(), [[3, 2, 1]])
+
+        reds2, blues2 = score.swing_votes(numpy.array([[1, 2, 3], [1, 2, 3]]),
+            numpy.array([[3, 2, 1], [3, 2, 1]]), numpy.array([.1, -.1]))
+        self.assertEqual(reds2[0].tolist(), score.swing_vote((1, 2, 3), (3, 2, 1), .1)[0])
+        self.assertEqual(blues2[1].tolist(), score.swing_vote((1, 2, 3), (3, 2, 1), -.1)[1])
+
+    def test_calculate_arrays_match(self):
+        ''' Array metrics match single-election metrics for each simulation
+        '''
+        rand = random.Random(0)
+        reds = numpy.array([[rand.randint(1, 999) for d in range(13)] for s in range(20)], dtype=float)
+        blues = numpy.array([[rand.randint(1, 999) for d in range(13)] for s in range(20)], dtype=float)
+        
+        EGs, MMDs, PBs = score.calculate_EGs(reds, blues, .02), \
+            score.calculate_MMDs(reds, blues), score.calculate_PBs(reds, blues)
+        
+        for (sim, (sim_reds, sim_blues)) in enumerate(zip(reds.tolist(), blues.tolist())):
+            self.assertAlmostEqual(EGs[sim], score.calculate_EG(sim_reds, sim_blues, .02), places=9)
+            self.assertAlmostEqual(MMDs[sim], score.calculate_MMD(sim_reds, sim_blues), places=9)
+            self.assertAlmostEqual(PBs[sim], score.calculate_PB(sim_reds, sim_blues), places=9)
+    
+    def test_calculate_swing_curves(self):
+        ''' Seats-votes and EG curves can be correctly calculated for an election
+        '''
+        reds, blues = (2, 3, 5, 6), (6, 5, 3, 2)
+        curves1 = score.calculate_swing_curves(reds, blues)
+        zero, plus1 = 150, 160
+        
+        self.assertAlmostEqual(score.SWING_CURVE_POINTS[zero], 0)
+        self.assertAlmostEqual(score.SWING_CURVE_POINTS[plus1], .01)
+        self.assertEqual(curves1['Efficiency Gap'].shape, (301, 1))
+        self.assertAlmostEqual(curves1['Vote Share'][zero][0], .5)
+        self.assertAlmostEqual(curves1['Seat Share'][zero][0], .5)
+        self.assertAlmostEqual(curves1['Efficiency Gap'][zero][0], score.calculate_EG(reds, blues))
+        self.assertAlmostEqual(curves1['Efficiency Gap'][plus1][0], score.calculate_EG(reds, blues, .01))
+        self.assertEqual(curves1['Seat Share'][0][0], .25)
+        self.assertEqual(curves1['Seat Share'][-1][0], .75)
+        self.assertTrue((numpy.diff(curves1['Seat Share'][:,0]) >= 0).all(),
+            'Should see seat share grow with vote share')
+
+        curves2 = score.calculate_swing_curves(reds, blues, proportional=True)
+        self.assertAlmostEqual(curves2['Vote Share'][zero][0], .5)
+        self.assertAlmostEqual(curves2['Vote Share'][plus1][0], .51)
+        self.assertAlmostEqual(curves2['Vote Share'][-1][0], .65)
+        self.assertAlmostEqual(curves2['Efficiency Gap'][zero][0], score.calculate_EG(reds, blues))
+        
+        curves3 = score.calculate_swing_curves(numpy.array([reds, blues]), numpy.array([blues, reds]))
+        self.assertEqual(curves3['Seat Share'].shape, (301, 2))
+        self.assertAlmostEqual(curves3['Efficiency Gap'][plus1][1], score.calculate_EG(blues, reds, .01))
+    
+    def test_summarize_swing_curves(self):
+        ''' Mean swing curves are summarized for simulations
+        '''
+        reds, blues = numpy.array([(2, 3, 5, 6), (1, 5, 5, 5)]), numpy.array([(6, 5, 3, 2), (7, 3, 3, 3)])
+        summary = score.summarize_swing_curves(reds, blues)
+        
+        for name in ('Uniform Swing Curve', 'Proportional Swing Curve'):
+            self.assertEqual(len(summary[name]['Swing']), 301)
+            self.assertEqual(summary[name]['Swing'][0], -.15)
+            self.assertEqual(summary[name]['Swing'][150], 0)
+            self.assertEqual(len(summary[name]['Seat Share']), 301)
+            self.assertEqual(len(summary[name]['Vote Share']), 301)
+            self.assertAlmostEqual(summary[name]['Efficiency Gap'][150],
+                statistics.mean([score.calculate_EG(*sim) for sim in zip(reds, blues)]), places=4)
+    
+    def test_simulation_fields(self):
+        ''' Simulated vote fields are kept out of plain field names
+        '''
+        self.assertEqual(len(score.SIMULATION_FIELDS['REP']), 1000)
+        self.assertEqual(len(score.SIMULATION_FIELDS['DEM']), 1000)
+        self.assertEqual(score.SIMULATION_FIELDS['DEM'][999], 'DEM999')
+        self.assertNotIn('REP000', score.FIELD_NAMES)
+
+    def test_register_metric(self):
+        ''' Registered metric kernels are evaluated alongside built-in metrics
+        '''
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
+        reds, blues = numpy.array(votes[:1]), numpy.array(votes[1:])
+        
+        with unittest.mock.patch.dict(score.METRICS):
+            score.register_metric('Districts', lambda reds, blues: numpy.full(len(reds), reds.shape[1]))
+            metrics = score.calculate_metrics(reds, blues)
+        
+        self.assertEqual(metrics['Districts'].tolist(), [4])
+        self.assertAlmostEqual(metrics['Efficiency Gap'][0], score.calculate_EG(*votes))
+        self.assertAlmostEqual(metrics['Efficiency Gap +2 {Dem}'][0], score.calculate_EG(*votes, .02))
+        self.assertEqual(metrics['Seat Share'].tolist(), [.5])
+        self.assertEqual(metrics['Vote Share'].tolist(), [.5])
+        self.assertNotIn('Districts', score.calculate_metrics(reds, blues))
+
+    def test_calculate_declinations(self):
+        ''' Declination can be correctly calculated for simulations
+        '''
+        reds = numpy.array([[2, 3, 5, 6], [4, 4, 5, 6], [1, 1, 1, 1]])
+        blues = numpy.array([[6, 5, 3, 2], [6, 6, 3, 2], [9, 9, 9, 9]])
+        declinations = score.calculate_declinations(reds, blues)
+        
+        self.assertAlmostEqual(declinations[0], 0)
+        self.assertGreater(declinations[1], 0, 'Red votes should be packed into lopsided wins')
+        
+        # Blue wins .6 and .6, red wins .375 and .25 blue share, each half the seats:
+        # 2 * (arctan((1 - 2 * .3125) / .5) - arctan((2 * .6 - 1) / .5)) / pi
+        self.assertAlmostEqual(declinations[1], 0.167428, 6)
+        self.assertTrue(numpy.isnan(declinations[2]), 'Should be undefined without red seats')
+
+    def test_summarize_metric(self):
+        ''' Metric summaries ignore undefined values
+        '''
+        self.assertEqual(score.summarize_metric(numpy.array([1., 3., numpy.nan])), (2., 2**.5))
+        self.assertEqual(score.summarize_metric(numpy.array([1., numpy.nan])), (1., None))
+        self.assertEqual(score.summarize_metric(numpy.array([numpy.nan])), (None, None))
+
+    def test_calculate_bias(self):
         ''' Efficiency gap can be correctly calculated for an election
         '''
         input = data.Upload(id=None, key=None,
@@ -124,27 +240,61 @@ class TestScore (unittest.TestCase):
                 dict(totals={'Voters': 10, 'Red Votes': 6, 'Blue Votes': 2}, tile=None),
                 ])
         
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
         output = score.calculate_biases(score.calculate_bias(input))
 
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
+        self.assertAlmostEqual(output.summary['Mean-Median'], score.calculate_MMD(*votes))
+        self.assertAlmostEqual(output.summary['Partisan Bias'], score.calculate_PB(*votes))
+        self.assertAlmostEqual(output.summary['Efficiency Gap'], score.calculate_EG(*votes))
+        self.assertAlmostEqual(output.summary['Efficiency Gap +1 Blue'], score.calculate_EG(*votes, .01))
+        self.assertAlmostEqual(output.summary['Efficiency Gap +1 Red'], score.calculate_EG(*votes, -.01))
 
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
+    def test_calculate_bias_swing_curves(self):
+        ''' Swing curves are calculated for plain vote counts
+        '''
+        input = data.Upload(id=None, key=None,
+            districts = [
+                dict(totals={'Red Votes': 2, 'Blue Votes': 6, 'US House Rep Votes': 2, 'US House Dem Votes': 6}),
+                dict(totals={'Red Votes': 3, 'Blue Votes': 5, 'US House Rep Votes': 3, 'US House Dem Votes': 5}),
+                dict(totals={'Red Votes': 5, 'Blue Votes': 3, 'US House Rep Votes': 5, 'US House Dem Votes': 3}),
+                dict(totals={'Red Votes': 6, 'Blue Votes': 2, 'US House Rep Votes': 6, 'US House Dem Votes': 2}),
+                ])
+        
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
+        output = score.calculate_bias(input)
+        
+        for name in ('Uniform Swing Curve', 'Proportional Swing Curve', 'US House Uniform Swing Curve'):
+            self.assertEqual(len(output.summary[name]['Swing']), 301)
+            self.assertEqual(output.summary[name]['Seat Share'][150], .5)
+            self.assertAlmostEqual(output.summary[name]['Efficiency Gap'][150],
+                score.calculate_EG(*votes), places=4)
+        
+        self.assertAlmostEqual(output.summary['Uniform Swing Curve']['Efficiency Gap'][151],
+            score.calculate_EG(*votes, .001), places=4)
 
-        self.assertEqual(output.summary['Efficiency Gap +1 Blue'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
+    def test_calculate_bias_swing_curves_lopsided(self):
+        ''' Uniform swing curves agree with swung efficiency gaps for lopsided districts
+        '''
+        input = data.Upload(id=None, key=None,
+            districts = [
+                dict(totals={'Red Votes': 1, 'Blue Votes': 199}),
+                dict(totals={'Red Votes': 3, 'Blue Votes': 97}),
+                dict(totals={'Red Votes': 55, 'Blue Votes': 45}),
+                dict(totals={'Red Votes': 60, 'Blue Votes': 40}),
+                dict(totals={'Red Votes': 99, 'Blue Votes': 1}),
+                ])
 
-        self.assertEqual(output.summary['Efficiency Gap +1 Red'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
+        output = score.calculate_bias(input)
+        curve = output.summary['Uniform Swing Curve']
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_ushouse(self, calculate_EG, calculate_PB, calculate_MMD):
+        for points in (1, 2, 3, 4, 5):
+            plus, minus = curve['Swing'].index(points/100), curve['Swing'].index(-points/100)
+            self.assertAlmostEqual(curve['Efficiency Gap'][plus],
+                output.summary[f'Efficiency Gap +{points} Blue'], places=4)
+            self.assertAlmostEqual(curve['Efficiency Gap'][minus],
+                output.summary[f'Efficiency Gap +{points} Red'], places=4)
+    
+    def test_calculate_gap_ushouse(self):
         ''' Efficiency gap can be correctly calculated for a U.S. House election
         '''
         input = data.Upload(id=None, key=None,
@@ -155,27 +305,16 @@ class TestScore (unittest.TestCase):
                 dict(totals={'US House Rep Votes': 6, 'US House Dem Votes': 2}, tile=None),
                 ])
         
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
         output = score.calculate_biases(score.calculate_bias(input))
 
-        self.assertEqual(output.summary['US House Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['US House Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['US House Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['US House Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
-
-        self.assertEqual(output.summary['US House Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
+        self.assertAlmostEqual(output.summary['US House Mean-Median'], score.calculate_MMD(*votes))
+        self.assertAlmostEqual(output.summary['US House Partisan Bias'], score.calculate_PB(*votes))
+        self.assertAlmostEqual(output.summary['US House Efficiency Gap'], score.calculate_EG(*votes))
+        self.assertAlmostEqual(output.summary['US House Efficiency Gap +1 Dem'], score.calculate_EG(*votes, .01))
+        self.assertAlmostEqual(output.summary['US House Efficiency Gap +1 Rep'], score.calculate_EG(*votes, -.01))
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_upperhouse(self, calculate_EG, calculate_PB, calculate_MMD):
+    def test_calculate_gap_upperhouse(self):
         ''' Efficiency gap can be correctly calculated for a State upper house election
         '''
         input = data.Upload(id=None, key=None,
@@ -186,27 +325,16 @@ class TestScore (unittest.TestCase):
                 dict(totals={'SLDU Rep Votes': 6, 'SLDU Dem Votes': 2}, tile=None),
                 ])
         
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
         output = score.calculate_biases(score.calculate_bias(input))
 
-        self.assertEqual(output.summary['SLDU Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
+        self.assertAlmostEqual(output.summary['SLDU Mean-Median'], score.calculate_MMD(*votes))
+        self.assertAlmostEqual(output.summary['SLDU Partisan Bias'], score.calculate_PB(*votes))
+        self.assertAlmostEqual(output.summary['SLDU Efficiency Gap'], score.calculate_EG(*votes))
+        self.assertAlmostEqual(output.summary['SLDU Efficiency Gap +1 Dem'], score.calculate_EG(*votes, .01))
+        self.assertAlmostEqual(output.summary['SLDU Efficiency Gap +1 Rep'], score.calculate_EG(*votes, -.01))
 
-        self.assertEqual(output.summary['SLDU Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['SLDU Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['SLDU Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
-
-        self.assertEqual(output.summary['SLDU Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
-
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_lowerhouse(self, calculate_EG, calculate_PB, calculate_MMD):
+    def test_calculate_gap_lowerhouse(self):
         ''' Efficiency gap can be correctly calculated for a State lower house election
         '''
         input = data.Upload(id=None, key=None,
@@ -217,59 +345,52 @@ class TestScore (unittest.TestCase):
                 dict(totals={'SLDL Rep Votes': 6, 'SLDL Dem Votes': 2}, tile=None),
                 ])
         
+        votes = ([2, 3, 5, 6], [6, 5, 3, 2])
         output = score.calculate_biases(score.calculate_bias(input))
 
-        self.assertEqual(output.summary['SLDL Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['SLDL Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['SLDL Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2]))
-
-        self.assertEqual(output.summary['SLDL Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
+        self.assertAlmostEqual(output.summary['SLDL Mean-Median'], score.calculate_MMD(*votes))
+        self.assertAlmostEqual(output.summary['SLDL Partisan Bias'], score.calculate_PB(*votes))
+        self.assertAlmostEqual(output.summary['SLDL Efficiency Gap'], score.calculate_EG(*votes))
+        self.assertAlmostEqual(output.summary['SLDL Efficiency Gap +1 Dem'], score.calculate_EG(*votes, .01))
+        self.assertAlmostEqual(output.summary['SLDL Efficiency Gap +1 Rep'], score.calculate_EG(*votes, -.01))
 
-        self.assertEqual(output.summary['SLDL Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
-
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_sims(self, calculate_EG, calculate_PB, calculate_MMD):
+    def test_calculate_gap_sims(self):
         ''' Efficiency gap can be correctly calculated using input sims.
         '''
         input = data.Upload(id=None, key=None,
             districts = [
-                dict(totals={"REP000": 2, "DEM000": 6, "REP001": 1, "DEM001": 7}, tile=None),
-                dict(totals={"REP000": 3, "DEM000": 5, "REP001": 5, "DEM001": 3}, tile=None),
-                dict(totals={"REP000": 5, "DEM000": 3, "REP001": 5, "DEM001": 3}, tile=None),
-                dict(totals={"REP000": 6, "DEM000": 2, "REP001": 5, "DEM001": 3}, tile=None),
+                dict(totals={"REP": [2, 1], "DEM": [6, 7]}, tile=None),
+                dict(totals={"REP": [3, 5], "DEM": [5, 3]}, tile=None),
+                dict(totals={"REP": [5, 5], "DEM": [3, 3]}, tile=None),
+                dict(totals={"REP": [6, 5], "DEM": [2, 3]}, tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        sim0, sim1 = ([2, 3, 5, 6], [6, 5, 3, 2]), ([1, 5, 5, 5], [7, 3, 3, 3])
         output = score.calculate_biases(score.calculate_bias(input))
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(output.summary['Efficiency Gap SD'], 0)
-        self.assertIn('Efficiency Gap +1 Dem', output.summary)
-        self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
-        self.assertIn('Efficiency Gap +1 Rep', output.summary)
-        self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2], 0))
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
-        self.assertEqual(calculate_EG.mock_calls[11][1], ([1, 5, 5, 5], [7, 3, 3, 3], 0))
-        self.assertEqual(calculate_EG.mock_calls[12][1], ([1, 5, 5, 5], [7, 3, 3, 3], .01))
-        self.assertEqual(calculate_EG.mock_calls[13][1], ([1, 5, 5, 5], [7, 3, 3, 3], -.01))
+
+        MMDs = [score.calculate_MMD(*sim0), score.calculate_MMD(*sim1)]
+        self.assertAlmostEqual(output.summary['Mean-Median'], statistics.mean(MMDs), places=4)
+        self.assertAlmostEqual(output.summary['Mean-Median SD'], statistics.stdev(MMDs), places=4)
+
+        PBs = [score.calculate_PB(*sim0), score.calculate_PB(*sim1)]
+        self.assertAlmostEqual(output.summary['Partisan Bias'], statistics.mean(PBs), places=4)
+        self.assertAlmostEqual(output.summary['Partisan Bias SD'], statistics.stdev(PBs), places=4)
+
+        EGs = [score.calculate_EG(*sim0), score.calculate_EG(*sim1)]
+        self.assertAlmostEqual(output.summary['Efficiency Gap'], statistics.mean(EGs), places=4)
+        self.assertAlmostEqual(output.summary['Efficiency Gap SD'], statistics.stdev(EGs), places=4)
+
+        EGs_dem = [score.calculate_EG(*sim0, .01), score.calculate_EG(*sim1, .01)]
+        self.assertAlmostEqual(output.summary['Efficiency Gap +1 Dem'], statistics.mean(EGs_dem), places=4)
+        self.assertAlmostEqual(output.summary['Efficiency Gap +1 Dem SD'], statistics.stdev(EGs_dem), places=4)
+
+        EGs_rep = [score.calculate_EG(*sim0, -.05), score.calculate_EG(*sim1, -.05)]
+        self.assertAlmostEqual(output.summary['Efficiency Gap +5 Rep'], statistics.mean(EGs_rep), places=4)
+        self.assertAlmostEqual(output.summary['Efficiency Gap +5 Rep SD'], statistics.stdev(EGs_rep), places=4)
+        self.assertIn('Uniform Swing Curve', output.summary)
+        self.assertIn('Proportional Swing Curve', output.summary)
         
-        for field in ('REP000', 'DEM000', 'REP001', 'DEM001'):
+        for field in ('REP', 'DEM'):
             for district in output.districts:
                 self.assertNotIn(field, district['totals'])
 
@@ -1,6 +1,6 @@
 import unittest, unittest.mock, os, json, io, gzip, itertools, collections
-import osgeo.ogr, botocore.exceptions
-from .. import tiles, data, constants
+import osgeo.ogr, botocore.exceptions, numpy
+from .. import tiles, data, bundle
 
 should_gzip = itertools.cycle([True, False])
 
@@ -62,6 +62,56 @@ class TestTiles (unittest.TestCase):
         s3.list_objects.assert_called_once_with(Bucket='bucket-name',
             Prefix="uploads/sample-plan/geometries/")
 
+    def test_load_upload_geometries_bundle(self):
+        ''' Expected geometries are retrieved from a single S3 bundle.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'sample-plan'
+        
+        geometries = [osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0))'),
+            osgeo.ogr.CreateGeometryFromWkt('POLYGON ((5 5, 5 6, 6 6, 6 5, 5 5))')]
+        body = bundle.dumps([{}, {}], [geom.ExportToWkb() for geom in geometries],
+            [geom.GetEnvelope() for geom in geometries])
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(body)), 'ContentEncoding': 'gzip'}
+
+        geometries1 = tiles.load_upload_geometries(storage, upload)
+
+        self.assertEqual(list(geometries1.keys()), ["uploads/sample-plan/geometries/0.wkt",
+            "uploads/sample-plan/geometries/1.wkt"])
+        self.assertTrue(geometries1["uploads/sample-plan/geometries/1.wkt"].Equals(geometries[1]))
+        
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key="uploads/sample-plan/geometries.psb")
+        self.assertFalse(s3.list_objects.called)
+        
+        s3.get_object.return_value = {'Body': io.BytesIO(body)}
+        tile_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((.5 .5, .5 2, 2 2, 2 .5, .5 .5))')
+        geometries2 = tiles.load_upload_geometries(storage, upload, tile_geom)
+        
+        self.assertEqual(list(geometries2.keys()), ["uploads/sample-plan/geometries/0.wkt"])
+
+    def test_load_tile_district_pieces(self):
+        ''' District pieces for a tile are retrieved from S3.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'sample-plan'
+        
+        piece_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0))')
+        body = bundle.dumps([{'key': 'uploads/sample-plan/geometries/1.wkt'}],
+            [piece_geom.ExportToWkb()], [piece_geom.GetEnvelope()])
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(body)), 'ContentEncoding': 'gzip'}
+
+        pieces = tiles.load_tile_district_pieces(storage, upload, '12/2047/2047')
+
+        self.assertEqual(list(pieces.keys()), ['uploads/sample-plan/geometries/1.wkt'])
+        self.assertTrue(pieces['uploads/sample-plan/geometries/1.wkt'].Equals(piece_geom))
+        s3.get_object.assert_called_once_with(Bucket='bucket-name',
+            Key='uploads/sample-plan/pieces/12/2047/2047.psb')
+        
+        s3.get_object.side_effect = mock_s3_get_object
+        self.assertIsNone(tiles.load_tile_district_pieces(storage, upload, '12/-1/-1'))
+
     def test_load_tile_precincts(self):
         ''' Expected tiles are loaded from S3.
         '''
@@ -76,34 +126,459 @@ class TestTiles (unittest.TestCase):
         precincts2 = tiles.load_tile_precincts(storage, '12/-1/-1')
         self.assertEqual(len(precincts2), 0)
     
-    @unittest.mock.patch('planscore.tiles.score_precinct')
-    def test_score_district(self, score_precinct):
+    def test_load_tile_bundle(self):
+        ''' Expected tiles in bundle format are loaded from S3.
+        '''
+        path = os.path.join(os.path.dirname(__file__), 'data', 'XX/12/2047/2047.geojson')
+        
+        with open(path) as file:
+            features = json.load(file)['features']
+        
+        geometries = [osgeo.ogr.CreateGeometryFromJson(json.dumps(f['geometry'])) for f in features]
+        simulations = [{'REP': [i, i + 1], 'DEM': [i + 2]} for i in range(len(features))]
+        body = bundle.dumps([f['properties'] for f in features],
+            [geom.ExportToWkb() for geom in geometries], [geom.GetEnvelope() for geom in geometries],
+            simulations)
+        
+        s3 = unittest.mock.Mock()
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(body)), 'ContentEncoding': 'gzip'}
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+
+        precincts1 = tiles.load_tile_bundle(storage, 'XX/12/2047/2047.psb')
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='XX/12/2047/2047.psb')
+        self.assertEqual(len(precincts1), 4)
+        
+        for (precinct, feature, geometry, sims) in zip(precincts1, features, geometries, simulations):
+            self.assertEqual(precinct['properties'], feature['properties'])
+            self.assertTrue(numpy.allclose(precinct['simulations']['REP'], sims['REP']))
+            self.assertTrue(numpy.allclose(precinct['simulations']['DEM'], sims['DEM']))
+            self.assertEqual(precinct['envelope'], geometry.GetEnvelope())
+            self.assertAlmostEqual(precinct['area'], geometry.Area(), 12)
+            self.assertTrue(precinct['ogr_geometry'].Equals(geometry))
+        
+        s3.get_object.side_effect = mock_s3_get_object
+        precincts2 = tiles.load_tile_bundle(storage, 'XX/12/-1/-1.psb')
+        self.assertEqual(len(precincts2), 0)
+    
+    @unittest.mock.patch('planscore.tiles.prepare_precinct')
+    @unittest.mock.patch('planscore.tiles.load_tile_precincts')
+    @unittest.mock.patch('planscore.tiles.load_tile_bundle')
+    def test_load_prepared_precincts(self, load_tile_bundle, load_tile_precincts, prepare_precinct):
+        ''' Tile format is chosen based on the tile key.
+        '''
+        load_tile_precincts.return_value = ['P1', 'P2']
+        storage = data.Storage(None, 'bucket-name', 'XX')
+        
+        precincts1 = tiles.load_prepared_precincts(storage, 'XX/12/2047/2047.psb')
+        self.assertIs(precincts1, load_tile_bundle.return_value)
+        self.assertEqual(load_tile_bundle.mock_calls[0][1], (storage, 'XX/12/2047/2047.psb'))
+        
+        precincts2 = tiles.load_prepared_precincts(storage, 'XX/12/2047/2047.geojson')
+        self.assertEqual(precincts2, [prepare_precinct.return_value] * 2)
+        self.assertEqual(load_tile_precincts.mock_calls[0][1], (storage, '12/2047/2047'))
+    
+    @unittest.mock.patch('planscore.tiles.get_precinct_fraction')
+    def test_score_district(self, get_precinct_fraction):
         ''' Correct values appears in totals dict after scoring a district.
         '''
-        score_precinct.return_value = {'Voters': 1.111111111}
+        get_precinct_fraction.return_value = 1.111111111
         
         district_geom, tile_geom = unittest.mock.Mock(), unittest.mock.Mock()
-        precincts = [unittest.mock.Mock(), unittest.mock.Mock()]
+        precincts = [dict(properties={'Voters': 1}, simulations={'REP': numpy.array([1, 2])}),
+            dict(properties={'Voters': 1}, simulations={'REP': numpy.array([3, 4])})]
         intersection = district_geom.Intersection.return_value
         district_geom.Disjoint.return_value = False
 
         totals = tiles.score_district(district_geom, precincts, tile_geom)
-        self.assertEqual(totals['Voters'], round(2.222222222, constants.ROUND_COUNT))
+        self.assertAlmostEqual(totals['Voters'], 2.222222222, 9)
+        self.assertAlmostEqual(totals['REP'][0], 4.444444444, 9)
+        self.assertAlmostEqual(totals['REP'][1], 6.666666666, 9)
         
-        self.assertEqual(len(score_precinct.mock_calls), 2)
-        self.assertEqual(score_precinct.mock_calls[0][1], (intersection, precincts[0], tile_geom))
-        self.assertEqual(score_precinct.mock_calls[1][1], (intersection, precincts[1], tile_geom))
+        self.assertEqual(len(get_precinct_fraction.mock_calls), 2)
+        self.assertEqual(get_precinct_fraction.mock_calls[0][1], (intersection, precincts[0], tile_geom, tile_geom.Within.return_value))
+        self.assertEqual(get_precinct_fraction.mock_calls[1][1], (intersection, precincts[1], tile_geom, tile_geom.Within.return_value))
+        self.assertEqual(len(tile_geom.Within.mock_calls), 1)
     
-    @unittest.mock.patch('planscore.tiles.score_precinct')
-    def test_score_district_disjoint(self, score_precinct):
+    @unittest.mock.patch('planscore.tiles.get_precinct_fraction')
+    def test_score_district_disjoint(self, get_precinct_fraction):
         ''' No precincts are scored for a disjoint tile/district.
         '''
         district_geom, tile_geom = unittest.mock.Mock(), unittest.mock.Mock()
-        precincts = [unittest.mock.Mock(), unittest.mock.Mock()]
+        precincts = [dict(properties={'Voters': 1}, simulations={}),
+            dict(properties={'Voters': 1}, simulations={})]
         district_geom.Disjoint.return_value = True
 
-        tiles.score_district(district_geom, precincts, tile_geom)
-        self.assertEqual(len(score_precinct.mock_calls), 0)
+        totals = tiles.score_district(district_geom, precincts, tile_geom)
+        self.assertEqual(len(get_precinct_fraction.mock_calls), 0)
+        self.assertEqual(dict(totals), {})
+    
+    @unittest.mock.patch('planscore.tiles.get_precinct_fraction')
+    def test_score_districts(self, get_precinct_fraction):
+        ''' Many districts are scored with one precinct attributes array.
+        '''
+        get_precinct_fraction.side_effect = [.5, 0, 1, .25]
+        
+        district_geoms = [unittest.mock.Mock(), unittest.mock.Mock(), unittest.mock.Mock()]
+        tile_geom = unittest.mock.Mock()
+        district_geoms[0].Disjoint.return_value = False
+        district_geoms[1].Disjoint.return_value = True
+        district_geoms[2].Disjoint.return_value = False
+        precincts = [
+            dict(properties={'Voters': 2, 'Households 2016': 2, 'Household Income 2016': 10}, simulations={}),
+            dict(properties={'Voters': 4, 'Blue Votes': None}, simulations={}),
+            ]
+
+        totals = tiles.score_districts(district_geoms, precincts, tile_geom)
+        self.assertEqual(len(totals), 3)
+        self.assertEqual(dict(totals[0]), {'Voters': 1, 'Blue Votes': 0, 'Households 2016': 1,
+            'Household Income 2016': 0, 'Sum Household Income 2016': 10})
+        self.assertEqual(dict(totals[1]), {})
+        self.assertEqual(dict(totals[2]), {'Voters': 3, 'Blue Votes': 0, 'Households 2016': 2,
+            'Household Income 2016': 0, 'Sum Household Income 2016': 20})
+    
+    @unittest.mock.patch('planscore.tiles.get_precinct_fraction')
+    def test_score_districts_clipped(self, get_precinct_fraction):
+        ''' District pieces already clipped to the tile are used as-is.
+        '''
+        get_precinct_fraction.return_value = 1
+        
+        piece_geom, tile_geom = unittest.mock.Mock(), unittest.mock.Mock()
+        precincts = [dict(properties={'Voters': 2}, simulations={})]
+
+        totals = tiles.score_districts([piece_geom], precincts, tile_geom, clipped=True)
+        self.assertEqual(dict(totals[0]), {'Voters': 2})
+        self.assertFalse(piece_geom.Disjoint.called)
+        self.assertFalse(piece_geom.Intersection.called)
+        self.assertIs(get_precinct_fraction.mock_calls[0][1][0], piece_geom)
+    
+    @unittest.mock.patch('planscore.tiles.score_districts')
+    @unittest.mock.patch('planscore.tiles.load_prepared_precincts')
+    @unittest.mock.patch('planscore.tiles.load_tile_district_pieces')
+    @unittest.mock.patch('planscore.tiles.tile_geometry')
+    def test_score_tile(self, tile_geometry, load_tile_district_pieces, load_prepared_precincts, score_districts):
+        ''' District pieces clipped to the tile are scored against its precincts.
+        '''
+        load_prepared_precincts.return_value = []
+        load_tile_district_pieces.return_value = {'uploads/ID/geometries/0.wkt': 'PIECE 0'}
+        score_districts.return_value = [{'Voters': 1}]
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        load_geometries = unittest.mock.Mock()
+        
+        totals = tiles.score_tile(storage, upload, 'data/XX/12/2047/2047.psb', load_geometries)
+        
+        self.assertEqual(totals, {'uploads/ID/geometries/0.wkt': {'Voters': 1}})
+        self.assertEqual(tile_geometry.mock_calls[0][1], ('12/2047/2047', ))
+        self.assertEqual(load_tile_district_pieces.mock_calls[0][1], (storage, upload, '12/2047/2047'))
+        self.assertEqual(score_districts.mock_calls[0][1][0], ['PIECE 0'])
+        self.assertIs(score_districts.mock_calls[0][1][2], tile_geometry.return_value)
+        self.assertTrue(score_districts.mock_calls[0][1][5], 'Should skip clipping pieces again')
+        self.assertFalse(load_geometries.called)
+    
+    @unittest.mock.patch('planscore.tiles.score_districts')
+    @unittest.mock.patch('planscore.tiles.load_prepared_precincts')
+    @unittest.mock.patch('planscore.tiles.load_tile_district_pieces')
+    @unittest.mock.patch('planscore.tiles.tile_geometry')
+    def test_score_tile_unclipped(self, tile_geometry, load_tile_district_pieces, load_prepared_precincts, score_districts):
+        ''' District geometries near the tile are scored when no pieces were saved.
+        '''
+        load_prepared_precincts.return_value = []
+        load_tile_district_pieces.return_value = None
+        score_districts.return_value = [{'Voters': 1}]
+        storage = data.Storage(None, 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', None, model=data.Model(data.State.XX, data.House.ushouse, 2, 'data/XX'))
+        load_geometries = unittest.mock.Mock(return_value={'uploads/ID/geometries/0.wkt': 'GEOM 0'})
+        
+        totals = tiles.score_tile(storage, upload, 'data/XX/12/2047/2047.psb', load_geometries)
+        
+        self.assertEqual(totals, {'uploads/ID/geometries/0.wkt': {'Voters': 1}})
+        self.assertEqual(score_districts.mock_calls[0][1][0], ['GEOM 0'])
+        self.assertIs(score_districts.mock_calls[0][1][2], tile_geometry.return_value)
+        self.assertFalse(score_districts.mock_calls[0][1][5], 'Should clip geometries to the tile')
+        self.assertIs(load_geometries.mock_calls[0][1][0], tile_geometry.return_value)
+    
+    def test_add_batch_totals(self):
+        ''' Totals from several tiles are summed for each district.
+        '''
+        batch_totals = {}
+        tiles.add_batch_totals(batch_totals, {'A': {'Voters': 1, 'REP': numpy.array([1, 2])}})
+        tiles.add_batch_totals(batch_totals, {'A': {'Voters': 2, 'REP': numpy.array([3, 4])}, 'B': {'Voters': 5}})
+        
+        self.assertEqual(batch_totals['A']['Voters'], 3)
+        self.assertEqual(batch_totals['A']['REP'].tolist(), [4, 6])
+        self.assertEqual(batch_totals['B'], {'Voters': 5})
+    
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.tiles.read_upload_geometries')
+    @unittest.mock.patch('planscore.tiles.fetch_upload_geometries_bundle')
+    @unittest.mock.patch('planscore.tiles.score_tile')
+    def test_lambda_handler_batch(self, score_tile, fetch_upload_geometries_bundle, read_upload_geometries, boto3_client):
+        ''' A batch of tiles is scored and written to one output file.
+        '''
+        def mock_score_tile(storage, upload, tile_key, load_geometries):
+            if tile_key.endswith('2049.psb'):
+                raise ValueError('Bad tile')
+            load_geometries(tile_key)
+            return {'uploads/ID/geometries/0.wkt': {'Voters': 1}}
+        
+        score_tile.side_effect = mock_score_tile
+        event = dict(storage=dict(bucket='bucket-name', prefix='data/XX'),
+            upload=dict(id='ID', key=None, model=dict(state='XX', house='ushouse', seats=2, key_prefix='data/XX')),
+            tile_keys=['data/XX/12/2047/2047.psb', 'data/XX/12/2048/2048.psb', 'data/XX/12/2049/2049.psb'])
+        
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(score_tile.mock_calls), 3)
+        self.assertEqual(len(fetch_upload_geometries_bundle.mock_calls), 1, 'Should fetch geometries once')
+        self.assertEqual(sorted(call[1][2] for call in read_upload_geometries.mock_calls),
+            ['data/XX/12/2047/2047.psb', 'data/XX/12/2048/2048.psb'], 'Should read geometries near each tile')
+        
+        put_kwargs = boto3_client.return_value.put_object.mock_calls[0][2]
+        output = json.loads(put_kwargs['Body'].decode('utf8'))
+        
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/tiles/12/2047/2047.json')
+        self.assertEqual(output['totals'], {'uploads/ID/geometries/0.wkt': {'Voters': 2}})
+        self.assertEqual(output['errors'], {'data/XX/12/2049/2049.psb': 'Bad tile'})
+        self.assertEqual(set(output['timings'].keys()), {'data/XX/12/2047/2047.psb', 'data/XX/12/2048/2048.psb'})
+        self.assertEqual(output['timings']['data/XX/12/2047/2047.psb']['districts'], 1)
+    
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.tiles.load_upload_geometries')
+    @unittest.mock.patch('planscore.tiles.score_tile')
+    @unittest.mock.patch('planscore.tiles.tile_output_exists')
+    @unittest.mock.patch('planscore.tiles.is_upload_stopped')
+    @unittest.mock.patch('planscore.observe.record_tile_completion')
+    def test_lambda_handler_completion(self, record_tile_completion, is_upload_stopped, tile_output_exists, score_tile, load_upload_geometries, boto3_client):
+        ''' Tile completion is recorded after output is written.
+        '''
+        tile_output_exists.return_value, is_upload_stopped.return_value = False, False
+        score_tile.return_value = {'uploads/ID/geometries/0.wkt': {'Voters': 1}}
+        event = dict(storage=dict(bucket='bucket-name', prefix='data/XX'),
+            upload=dict(id='ID', key=None, model=dict(state='XX', house='ushouse', seats=2, key_prefix='data/XX')),
+            tile_keys=['data/XX/12/2047/2047.psb'], group=dict(index=0, size=3, count=1))
+        
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(boto3_client.return_value.put_object.mock_calls), 1)
+        self.assertEqual(len(record_tile_completion.mock_calls), 1)
+        self.assertEqual(record_tile_completion.mock_calls[0][1][1].id, 'ID')
+        self.assertEqual(record_tile_completion.mock_calls[0][1][2], '12/2047/2047')
+        self.assertEqual(record_tile_completion.mock_calls[0][1][3], dict(index=0, size=3, count=1))
+        
+        # A duplicate that started after the first output skips scoring
+        tile_output_exists.return_value = True
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(score_tile.mock_calls), 1)
+        self.assertEqual(len(boto3_client.return_value.put_object.mock_calls), 1)
+        self.assertEqual(len(record_tile_completion.mock_calls), 2)
+        
+        # A duplicate that finished after the first output keeps it
+        tile_output_exists.side_effect = [False, True]
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(score_tile.mock_calls), 2)
+        self.assertEqual(len(boto3_client.return_value.put_object.mock_calls), 1, 'First output should win')
+        self.assertEqual(len(record_tile_completion.mock_calls), 3)
+        
+        # Nothing is done for an upload already finished or given up on
+        is_upload_stopped.return_value = True
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(is_upload_stopped.mock_calls[-1][1][1].id, 'ID')
+        self.assertEqual(len(score_tile.mock_calls), 2)
+        self.assertEqual(len(record_tile_completion.mock_calls), 3)
+    
+    def test_tile_output_exists(self):
+        ''' Existing tile outputs are found with a HEAD request.
+        '''
+        storage = unittest.mock.Mock()
+        self.assertTrue(tiles.tile_output_exists(storage, 'uploads/ID/tiles/12/2047/2047.json'))
+        storage.s3.head_object.assert_called_once_with(Bucket=storage.bucket, Key='uploads/ID/tiles/12/2047/2047.json')
+        
+        storage.s3.head_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        self.assertFalse(tiles.tile_output_exists(storage, 'uploads/ID/tiles/12/2047/2047.json'))
+    
+    def test_round_tile_totals(self):
+        ''' Tile output totals are rounded finely to keep output compact.
+        '''
+        rounded = tiles.round_tile_totals({'uploads/ID/geometries/0.wkt':
+            {'Voters': 2.2542337123456, 'REP': numpy.array([1.6906751234567, 0.00000004])}})
+        
+        self.assertEqual(rounded['uploads/ID/geometries/0.wkt']['Voters'], 2.2542337)
+        self.assertEqual(rounded['uploads/ID/geometries/0.wkt']['REP'].tolist(), [1.6906751, 0])
+        self.assertEqual(json.dumps(rounded, default=tiles.list_array),
+            '{"uploads/ID/geometries/0.wkt": {"Voters": 2.2542337, "REP": [1.6906751, 0.0]}}')
+    
+    def test_get_precinct_attributes(self):
+        ''' Precinct properties and simulations are gathered into one array.
+        '''
+        precincts = [
+            dict(properties={'Voters': 2, 'Households 2016': 2, 'Household Income 2016': 10},
+                simulations={'REP': numpy.array([1, 2]), 'DEM': numpy.array([3, 4])}),
+            dict(properties={'Voters': None, 'Household Income 2016': 10}, simulations={'REP': numpy.array([5])}),
+            ]
+        
+        columns, values = tiles.get_precinct_attributes(precincts)
+        self.assertEqual(list(columns.keys()), ['Voters', 'Households 2016',
+            'Household Income 2016', 'Sum Household Income 2016', 'REP', 'DEM'])
+        self.assertEqual(values.tolist(), [[2, 2, 0, 20, 1, 2, 3, 4], [0, 0, 10, 0, 5, 0, 0, 0]])
+        
+        totals = tiles.unpack_attributes(columns, values[0])
+        self.assertEqual(totals['Voters'], 2)
+        self.assertEqual(totals['REP'].tolist(), [1, 2])
+    
+    def test_get_precinct_envelopes(self):
+        ''' Precinct envelopes are gathered into one array.
+        '''
+        precincts = [dict(envelope=(1, 1, 2, 2)), dict(envelope=(0, 3, 0, 2)),
+            dict(envelope=(numpy.nan, ) * 4)]
+        
+        envelopes = tiles.get_precinct_envelopes(precincts)
+        
+        self.assertEqual(envelopes[:2].tolist(), [[1, 1, 2, 2], [0, 3, 0, 2]])
+        self.assertTrue(numpy.isnan(envelopes[2]).all())
+        self.assertEqual(tiles.get_precinct_envelopes([]).shape, (0, 4))
+    
+    def test_select_precinct_indexes(self):
+        ''' Only precincts with envelopes intersecting a geometry are selected.
+        '''
+        envelopes = numpy.array([[0, 1, 0, 1], [2, 3, 2, 3], [1, 2, 1, 2], [numpy.nan] * 4])
+        geometry = unittest.mock.Mock()
+        
+        geometry.GetEnvelope.return_value = (0.5, 0.9, 0.5, 0.9)
+        self.assertEqual(tiles.select_precinct_indexes(envelopes, geometry).tolist(), [0])
+        
+        geometry.GetEnvelope.return_value = (1, 2, 1, 2)
+        self.assertEqual(tiles.select_precinct_indexes(envelopes, geometry).tolist(), [0, 1, 2])
+        
+        geometry.GetEnvelope.return_value = (5, 6, 5, 6)
+        self.assertEqual(tiles.select_precinct_indexes(envelopes, geometry).tolist(), [])
+    
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.tiles.load_upload_geometries')
+    @unittest.mock.patch('planscore.tiles.score_tile')
+    @unittest.mock.patch('planscore.tiles.tile_output_exists')
+    @unittest.mock.patch('planscore.tiles.is_upload_stopped')
+    @unittest.mock.patch('planscore.observe.record_tile_completion')
+    def test_lambda_handler_failed_tile(self, record_tile_completion, is_upload_stopped, tile_output_exists, score_tile, load_upload_geometries, boto3_client):
+        ''' A batch with a failed tile is left unfinished to be dispatched again.
+        '''
+        def mock_score_tile(storage, upload, tile_key, load_geometries):
+            if tile_key.endswith('2049.psb'):
+                raise ValueError('Bad tile')
+            return {'uploads/ID/geometries/0.wkt': {'Voters': 1}}
+        
+        tile_output_exists.return_value, is_upload_stopped.return_value = False, False
+        score_tile.side_effect = mock_score_tile
+        event = dict(storage=dict(bucket='bucket-name', prefix='data/XX'),
+            upload=dict(id='ID', key=None, model=dict(state='XX', house='ushouse', seats=2, key_prefix='data/XX')),
+            tile_keys=['data/XX/12/2047/2047.psb', 'data/XX/12/2049/2049.psb'], group=dict(index=0, size=3, count=1))
+        
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(score_tile.mock_calls), 2)
+        self.assertFalse(boto3_client.return_value.put_object.mock_calls, 'Should not write output')
+        self.assertFalse(record_tile_completion.mock_calls, 'Should not record completion')
+    
+    @unittest.mock.patch('planscore.tiles.get_precinct_fraction')
+    def test_score_district_envelopes(self, get_precinct_fraction):
+        ''' Precincts outside the partial district envelope are not scored.
+        '''
+        get_precinct_fraction.return_value = 1
+        
+        district_geom, tile_geom = unittest.mock.Mock(), unittest.mock.Mock()
+        precincts = [dict(properties={'Voters': 1}, simulations={}), dict(properties={'Voters': 1}, simulations={})]
+        envelopes = numpy.array([[0, 1, 0, 1], [2, 3, 2, 3]])
+        intersection = district_geom.Intersection.return_value
+        intersection.GetEnvelope.return_value = (0, 1, 0, 1)
+        district_geom.Disjoint.return_value = False
+
+        totals = tiles.score_district(district_geom, precincts, tile_geom, envelopes)
+        self.assertEqual(totals['Voters'], 1)
+        
+        self.assertEqual(len(get_precinct_fraction.mock_calls), 1)
+        self.assertEqual(get_precinct_fraction.mock_calls[0][1], (intersection, precincts[0], tile_geom, tile_geom.Within.return_value))
+    
+    @unittest.mock.patch('osgeo.ogr.CreateGeometryFromJson')
+    def test_prepare_precinct(self, CreateGeometryFromJson):
+        ''' Precinct geometry is parsed once with details kept for reuse.
+        '''
+        feature = {"type": "Feature", "properties": {"Voters": 1, "REP000": 2, "DEM000": 3}, "geometry": None}
+        precinct_geom = CreateGeometryFromJson.return_value
+        precinct_geom.IsEmpty.return_value = False
+        precinct_geom.Area.return_value = 4
+        precinct_geom.GetEnvelope.return_value = (0, 1, 0, 1)
+        
+        precinct = tiles.prepare_precinct(feature)
+        self.assertIs(precinct['ogr_geometry'], precinct_geom)
+        self.assertIs(precinct['properties'], feature['properties'])
+        self.assertEqual(precinct['area'], 4)
+        self.assertFalse(precinct['is_empty'])
+        self.assertFalse(precinct['is_point'])
+        self.assertEqual(precinct['simulations']['REP'].tolist(), [2])
+        self.assertEqual(precinct['envelope'], (0, 1, 0, 1))
+        self.assertEqual(CreateGeometryFromJson.call_count, 1)
+    
+    def test_score_precinct_contained(self):
+        ''' No overlay is calculated for a precinct wholly inside a district piece.
+        '''
+        precinct_geom = unittest.mock.Mock()
+        precinct = dict(properties={"Voters": 1, "PlanScore:Fraction": 0.5}, ogr_geometry=precinct_geom,
+            is_empty=False, is_point=False, area=4, simulations={})
+        partial_district_geom, tile_geom = unittest.mock.Mock(), unittest.mock.Mock()
+        partial_district_geom.IsEmpty.return_value = False
+        
+        partial_district_geom.Contains.return_value = True
+        totals1 = tiles.score_precinct(partial_district_geom, precinct, tile_geom, False)
+        self.assertAlmostEqual(totals1['Voters'], .5, 9)
+        self.assertEqual(precinct_geom.Intersection.call_count, 0)
+        self.assertEqual(precinct_geom.Area.call_count, 0)
+        self.assertEqual(tile_geom.Within.call_count, 0)
+        
+        partial_district_geom.Contains.side_effect = RuntimeError('TopologyException')
+        precinct_geom.Intersection.return_value.Area.return_value = 1
+        totals2 = tiles.score_precinct(partial_district_geom, precinct, tile_geom, False)
+        self.assertAlmostEqual(totals2['Voters'], .125, 9)
+        self.assertEqual(precinct_geom.Intersection.call_count, 1)
+        self.assertEqual(precinct_geom.Area.call_count, 0)
+    
+    def test_contains_precinct_envelope(self):
+        ''' Precincts reaching outside a district piece's envelope skip the GEOS predicate.
+        '''
+        partial_district_geom, precinct_geom = unittest.mock.Mock(), unittest.mock.Mock()
+        partial_district_geom.Contains.return_value = True
+        
+        self.assertFalse(tiles.contains_precinct(partial_district_geom, precinct_geom,
+            (0, 2, 0, 2), (1, 3, 1, 2)))
+        self.assertEqual(partial_district_geom.Contains.call_count, 0)
+        
+        self.assertTrue(tiles.contains_precinct(partial_district_geom, precinct_geom,
+            (0, 2, 0, 2), (1, 2, 0, 1)))
+        self.assertEqual(partial_district_geom.Contains.call_count, 1)
+        
+        self.assertTrue(tiles.contains_precinct(partial_district_geom, precinct_geom))
+        self.assertEqual(partial_district_geom.Contains.call_count, 2)
+    
+    def test_envelope_contains(self):
+        ''' Envelopes in (xmin, xmax, ymin, ymax) order are compared inclusively.
+        '''
+        self.assertTrue(tiles.envelope_contains((0, 2, 0, 2), (0, 2, 0, 2)))
+        self.assertTrue(tiles.envelope_contains((0, 2, 0, 2), (.5, 1, .5, 1)))
+        self.assertFalse(tiles.envelope_contains((0, 2, 0, 2), (-1, 1, .5, 1)))
+        self.assertFalse(tiles.envelope_contains((0, 2, 0, 2), (.5, 1, .5, 3)))
+        self.assertFalse(tiles.envelope_contains((.5, 1, .5, 1), (0, 2, 0, 2)))
+    
+    def test_load_simulation_arrays(self):
+        ''' Simulated votes are read from precinct properties into arrays.
+        '''
+        arrays1 = tiles.load_simulation_arrays({'Voters': 1, 'REP000': 3, 'REP001': None,
+            'DEM000': 1, 'DEM001': 2})
+        self.assertEqual(arrays1['REP'].tolist(), [3, 0])
+        self.assertEqual(arrays1['DEM'].tolist(), [1, 2])
+
+        arrays2 = tiles.load_simulation_arrays({'Voters': 1})
+        self.assertEqual(arrays2, {})
     
     def test_score_precinct(self):
         ''' Correct values appears in totals dict after scoring a precinct.
@@ -115,15 +590,17 @@ class TestTiles (unittest.TestCase):
         # Check each overlapping tile
         for tile_zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
             tile_geom = tiles.tile_geometry(tile_zxy)
-            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
             for (key, value) in tile_totals.items():
                 totals[key] += value
         
         self.assertAlmostEqual(totals['Voters'], 2.25423371, places=2)
         self.assertAlmostEqual(totals['Red Votes'], 1.69067528, places=2)
-        self.assertAlmostEqual(totals['REP999'], 1.69067528, places=2)
+        self.assertAlmostEqual(totals['REP'][0], 1.69067528, places=2)
         self.assertAlmostEqual(totals['Blue Votes'], 0, places=2)
-        self.assertAlmostEqual(totals['DEM999'], 0, places=2)
+        self.assertAlmostEqual(totals['DEM'][0], 0, places=2)
+        self.assertEqual(len(totals['REP']), 1)
+        self.assertEqual(len(totals['DEM']), 1)
     
     def test_score_precinct_incomes(self):
         ''' Correct values appears in totals dict after scoring a precinct.
@@ -135,7 +612,7 @@ class TestTiles (unittest.TestCase):
         # Check each overlapping tile
         for tile_zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
             tile_geom = tiles.tile_geometry(tile_zxy)
-            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
             for (key, value) in tile_totals.items():
                 totals[key] += value
         
@@ -154,7 +631,7 @@ class TestTiles (unittest.TestCase):
         # Check each overlapping tile
         for tile_zxy in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048'):
             tile_geom = tiles.tile_geometry(tile_zxy)
-            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+            tile_totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
             for (key, value) in tile_totals.items():
                 totals[key] += value
         
@@ -187,7 +664,7 @@ class TestTiles (unittest.TestCase):
         self.assertTrue(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.02, .02], [.02, .06], [.06, .06], [.06, .02], [.02, .02]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], .5, 9)
     
     def test_score_precinct_2a_tile_overlaps_precinct_within(self):
@@ -198,7 +675,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], .5, 9)
     
     def test_score_precinct_2b_tile_overlaps_precinct_overlaps(self):
@@ -209,7 +686,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], .25, 9)
     
     def test_score_precinct_2c_tile_overlaps_precinct_touches(self):
@@ -220,7 +697,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_2d_tile_overlaps_precinct_outside(self):
@@ -231,7 +708,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_2e_tile_overlaps_blockpoint_within(self):
@@ -242,7 +719,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         blockpoint = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.14, .14]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), blockpoint, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(blockpoint), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 1, 9)
     
     def test_score_precinct_2f_tile_overlaps_blockpoint_outside(self):
@@ -253,7 +730,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         blockpoint = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.14, .14]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), blockpoint, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(blockpoint), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_3_tile_touches(self):
@@ -264,7 +741,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_4_tile_outside(self):
@@ -275,7 +752,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.02, .02], [.02, .06], [.06, .06], [.06, .02], [.02, .02]]]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(precinct), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_5_blockpoint_within(self):
@@ -286,7 +763,7 @@ class TestTiles (unittest.TestCase):
         self.assertTrue(district_geom.Contains(tile_geom))
 
         blockpoint = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.04, .04]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), blockpoint, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(blockpoint), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 1, 9)
     
     def test_score_precinct_6_blockpoint_outside(self):
@@ -297,7 +774,7 @@ class TestTiles (unittest.TestCase):
         self.assertFalse(district_geom.Contains(tile_geom))
 
         blockpoint = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [1.00, 0.05]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), blockpoint, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(blockpoint), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
     def test_score_precinct_7_empty(self):
@@ -308,5 +785,5 @@ class TestTiles (unittest.TestCase):
         self.assertTrue(district_geom.Contains(tile_geom))
 
         empty = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "GeometryCollection", "geometries": [ ]}}
-        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), empty, tile_geom)
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), tiles.prepare_precinct(empty), tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
@@ -1,14 +1,99 @@
-import json, io, gzip, posixpath, functools, collections
-import osgeo.ogr, boto3, botocore.exceptions, ModestMaps.OpenStreetMap, ModestMaps.Core
-from . import constants, data, util, prepare_state, score
+import json, io, gzip, posixpath, functools, collections, threading, concurrent.futures, time
+import osgeo.ogr, boto3, botocore.exceptions, ModestMaps.OpenStreetMap, ModestMaps.Core, numpy
+from . import constants, data, util, prepare_state, score, bundle
 
 FUNCTION_NAME = 'PlanScore-RunTile'
 
 # Borrow some Modest Maps tile math
 _mercator = ModestMaps.OpenStreetMap.Provider().projection
 
-def load_upload_geometries(storage, upload):
+def load_upload_geometries(storage, upload, tile_geom=None):
     ''' Get dictionary of OGR geometries for an upload.
+    
+        Reads a single planscore.bundle file of district geometries, falling
+        back to one WKT file per district for older uploads. With a tile
+        geometry, districts whose envelopes miss the tile are left out.
+    '''
+    body = fetch_upload_geometries_bundle(storage, upload)
+    
+    if body is None:
+        return load_upload_wkt_geometries(storage, upload)
+    
+    return read_upload_geometries(upload, body, tile_geom)
+
+def fetch_upload_geometries_bundle(storage, upload):
+    ''' Get planscore.bundle body of district geometries for an upload, or None.
+    
+        None means an older upload with one WKT file per district.
+    '''
+    bundle_key = data.UPLOAD_GEOMETRIES_BUNDLE_KEY.format(id=upload.id)
+
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=bundle_key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    body = object['Body'].read()
+
+    if object.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    
+    return body
+
+def read_upload_geometries(upload, body, tile_geom=None):
+    ''' Get dictionary of OGR geometries from a planscore.bundle body for an upload.
+    
+        With a tile geometry, districts whose envelopes miss the tile are
+        left out without being parsed.
+    '''
+    _, wkbs, envelopes, _ = bundle.loads(body)
+    geometries = {}
+    
+    if tile_geom is not None:
+        xmin, xmax, ymin, ymax = tile_geom.GetEnvelope()
+        with numpy.errstate(invalid='ignore'):
+            is_nearby = (envelopes[:,0] <= xmax) & (envelopes[:,1] >= xmin) \
+                      & (envelopes[:,2] <= ymax) & (envelopes[:,3] >= ymin)
+    else:
+        is_nearby = numpy.ones(len(wkbs), dtype=bool)
+    
+    for (index, wkb) in enumerate(wkbs):
+        if wkb is None or not is_nearby[index]:
+            continue
+        geometry_key = data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
+        geometries[geometry_key] = osgeo.ogr.CreateGeometryFromWkb(wkb)
+    
+    return geometries
+
+def load_tile_district_pieces(storage, upload, tile_zxy):
+    ''' Get dictionary of district pieces already clipped to a tile, or None.
+    
+        Pieces are written by planscore.after_upload.put_tile_district_pieces(),
+        and None means they are not available for this upload.
+    '''
+    pieces_key = data.UPLOAD_TILE_PIECES_KEY.format(id=upload.id, zxy=tile_zxy)
+
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=pieces_key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    body = object['Body'].read()
+
+    if object.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    
+    properties, wkbs, _, _ = bundle.loads(body)
+    
+    return {props['key']: osgeo.ogr.CreateGeometryFromWkb(wkb)
+        for (props, wkb) in zip(properties, wkbs)}
+
+def load_upload_wkt_geometries(storage, upload):
+    ''' Get dictionary of OGR geometries for an upload from per-district WKT files.
     '''
     geometries = {}
     
@@ -45,6 +130,36 @@ def load_tile_precincts(storage, tile_zxy):
     geojson = json.load(object['Body'])
     return geojson['features']
 
+def load_tile_bundle(storage, tile_key):
+    ''' Get prepared precincts for a specific tile in planscore.bundle format.
+    '''
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=tile_key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return []
+        raise
+
+    body = object['Body'].read()
+
+    if object.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    
+    properties, geometries, envelopes, simulations = bundle.loads(body)
+    
+    return [prepare_precinct_geometry(props,
+        None if (wkb is None) else osgeo.ogr.CreateGeometryFromWkb(wkb), envelope, sims)
+        for (props, wkb, envelope, sims) in zip(properties, geometries, envelopes.tolist(), simulations)]
+
+def load_prepared_precincts(storage, tile_key):
+    ''' Get prepared precincts for a tile in any format, based on its key.
+    '''
+    if tile_key.endswith(prepare_state.BUNDLE_EXTENSION):
+        return load_tile_bundle(storage, tile_key)
+
+    tile_zxy = get_tile_zxy(storage.prefix, tile_key)
+    return [prepare_precinct(feature) for feature in load_tile_precincts(storage, tile_zxy)]
+
 def get_tile_zxy(model_key_prefix, tile_key):
     '''
     '''
@@ -64,115 +179,452 @@ def tile_geometry(tile_zxy):
 
     return osgeo.ogr.CreateGeometryFromWkt(wkt)
 
-def score_district(district_geom, precincts, tile_geom):
+def get_precinct_envelopes(precincts):
+    ''' Return an array of (xmin, xmax, ymin, ymax) rows for prepared precincts.
+    
+        Rows match OGR GetEnvelope() order. Precincts with no geometry have
+        NaN envelopes, which never match in select_precinct_indexes().
+    '''
+    return numpy.array([precinct['envelope'] for precinct in precincts], dtype=float).reshape(-1, 4)
+
+def select_precinct_indexes(envelopes, geometry):
+    ''' Return array of indexes for precinct envelopes intersecting an OGR geometry.
+    '''
+    xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+    
+    matches = (envelopes[:,0] <= xmax) & (envelopes[:,1] >= xmin) \
+            & (envelopes[:,2] <= ymax) & (envelopes[:,3] >= ymin)
+    
+    return numpy.nonzero(matches)[0]
+
+def get_district_fractions(district_geom, precincts, tile_geom, envelopes=None, clipped=False):
+    ''' Return arrays of precinct indexes and their nonzero fractions in a district.
+    
+        This is one row of a sparse district × precinct overlap matrix. Precincts
+        come from prepare_precinct(). If given, precinct envelopes from
+        get_precinct_envelopes() are used to skip precincts that could not
+        possibly overlap the district. If clipped is true, the district
+        geometry is already a piece clipped to the tile.
+    '''
+    partial_district_geom = district_geom if clipped else district_geom.Intersection(tile_geom)
+    district_envelope = partial_district_geom.GetEnvelope()
+    
+    if envelopes is None:
+        candidates = numpy.arange(len(precincts))
+    else:
+        candidates = select_precinct_indexes(envelopes, partial_district_geom)
+    
+    # Same answer for every precinct in the tile, so only ask once
+    tile_is_covered = tile_geom.Within(partial_district_geom)
+    
+    fractions = numpy.array([get_precinct_fraction(partial_district_geom,
+        precincts[index], tile_geom, tile_is_covered, district_envelope=district_envelope)
+        for index in candidates], dtype=float)
+    
+    nonzero = fractions != 0
+    return candidates[nonzero], fractions[nonzero]
+
+def score_districts(district_geoms, precincts, tile_geom, envelopes=None, attributes=None, clipped=False):
+    ''' Return list of weighted precinct totals for a list of districts over a tile.
+    
+        Totals are a product of the sparse district × precinct overlap matrix
+        and the precinct attribute array, one row for each district. Attributes
+        from get_precinct_attributes() are reused if given. If clipped is true,
+        district geometries are pieces already clipped to the tile.
+    '''
+    columns, values = attributes or get_precinct_attributes(precincts)
+    district_totals = []
+    
+    for district_geom in district_geoms:
+        if not clipped and district_geom.Disjoint(tile_geom):
+            district_totals.append(collections.defaultdict(int))
+            continue
+        
+        indexes, fractions = get_district_fractions(district_geom,
+            precincts, tile_geom, envelopes, clipped)
+        
+        # Keep full precision, see round_tile_totals() for when rounding happens
+        sums = fractions.dot(values[indexes])
+        district_totals.append(collections.defaultdict(int, unpack_attributes(columns, sums)))
+    
+    return district_totals
+
+def score_district(district_geom, precincts, tile_geom, envelopes=None, attributes=None):
     ''' Return weighted precinct totals for a district over a tile.
+    
+        Arguments are passed along to score_districts().
     '''
-    totals = collections.defaultdict(int)
+    return score_districts([district_geom], precincts, tile_geom, envelopes, attributes)[0]
+
+def get_precinct_attributes(precincts):
+    ''' Return columns and a precinct × attribute array for prepared precincts.
+    
+        Columns are an ordered dictionary of attribute names and their array
+        slices. Plain fields get one column each, and simulated votes get one
+        column per simulation.
+    '''
+    properties = [precinct['properties'] for precinct in precincts]
+    columns, widths = collections.OrderedDict(), collections.OrderedDict()
+    
+    for name in score.FIELD_NAMES:
+        if any(name in props for props in properties):
+            widths[name] = 1
+    
+    if 'Household Income 2016' in widths and any('Households 2016' in props for props in properties):
+        # Household income can't be summed up like populations,
+        # and needs to be weighted by number of households.
+        widths['Sum Household Income 2016'] = 1
     
-    if district_geom.Disjoint(tile_geom):
-        return totals
+    for name in score.SIMULATION_FIELDS:
+        width = max([len(precinct['simulations'].get(name, [])) for precinct in precincts] or [0])
+        if width:
+            widths[name] = width
     
-    partial_district_geom = district_geom.Intersection(tile_geom)
+    offset = 0
+    
+    for (name, width) in widths.items():
+        columns[name] = slice(offset, offset + width)
+        offset += width
+    
+    values = numpy.zeros((len(precincts), offset))
+    
+    for (index, (precinct, props)) in enumerate(zip(precincts, properties)):
+        row = values[index]
+        
+        for name in score.FIELD_NAMES:
+            if name in props:
+                row[columns[name]] = props[name] or 0
+        
+        if 'Household Income 2016' in props and 'Households 2016' in props:
+            row[columns['Sum Household Income 2016']] = \
+                (props['Household Income 2016'] or 0) * (props['Households 2016'] or 0)
+            row[columns['Household Income 2016']] = 0
+        
+        for (name, array) in precinct['simulations'].items():
+            row[columns[name].start:columns[name].start + len(array)] = array
+    
+    return columns, values
+
+def unpack_attributes(columns, row):
+    ''' Return dictionary of totals for one row of attribute values.
+    '''
+    return {name: (row[column].copy() if name in score.SIMULATION_FIELDS else float(row[column][0]))
+        for (name, column) in columns.items()}
+
+def load_simulation_arrays(properties):
+    ''' Return dictionary of simulated vote arrays found in precinct properties.
+    '''
+    arrays = {}
+    
+    for (array_name, field_names) in score.SIMULATION_FIELDS.items():
+        values = [properties[name] for name in field_names if name in properties]
+        if values:
+            arrays[array_name] = numpy.array([value or 0 for value in values], dtype=float)
+    
+    return arrays
+
+def envelope_contains(outer_envelope, inner_envelope):
+    ''' Return True if one (xmin, xmax, ymin, ymax) envelope wholly covers another.
+    '''
+    return outer_envelope[0] <= inner_envelope[0] and inner_envelope[1] <= outer_envelope[1] \
+        and outer_envelope[2] <= inner_envelope[2] and inner_envelope[3] <= outer_envelope[3]
+
+def contains_precinct(partial_district_geom, precinct_geom, district_envelope=None, precinct_envelope=None):
+    ''' Return True if a precinct geometry is wholly inside a district piece.
+    
+        When both envelopes are given, precincts reaching outside the district
+        piece's envelope are rejected without asking GEOS for a full relate.
+        Invalid geometries can fail this predicate, and are left to the
+        overlay in get_precinct_fraction() which knows how to repair them.
+    '''
+    if district_envelope is not None and precinct_envelope is not None:
+        if not envelope_contains(district_envelope, precinct_envelope):
+            return False
+
+    try:
+        return bool(partial_district_geom.Contains(precinct_geom))
+    except RuntimeError:
+        return False
+
+def prepare_precinct(precinct_feat):
+    ''' Return a prepared precinct for a GeoJSON feature, see prepare_precinct_geometry().
+    '''
+    precinct_geom = osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+    return prepare_precinct_geometry(precinct_feat['properties'], precinct_geom)
 
-    for precinct_feat in precincts:
-        subtotals = score_precinct(partial_district_geom, precinct_feat, tile_geom)
-        for (name, value) in subtotals.items():
-            totals[name] = round(value + totals[name], constants.ROUND_COUNT)
+def prepare_precinct_geometry(properties, precinct_geom, envelope=None, simulations=None):
+    ''' Return a precinct with its OGR geometry and details used for scoring.
+    
+        Done once per tile so that nothing here is repeated for each district.
+        Simulated vote arrays already decoded from a bundle can be passed in,
+        otherwise they are read from properties.
+    '''
+    precinct_is_empty = precinct_geom is None or precinct_geom.IsEmpty()
+    precinct_is_point = not precinct_is_empty and precinct_geom.GetGeometryType() \
+        in (osgeo.ogr.wkbPoint, osgeo.ogr.wkbPoint25D, osgeo.ogr.wkbMultiPoint, osgeo.ogr.wkbMultiPoint25D)
+    
+    if envelope is None:
+        envelope = (numpy.nan, ) * 4 if precinct_is_empty else precinct_geom.GetEnvelope()
 
-    return totals
+    return dict(
+        properties = properties,
+        ogr_geometry = precinct_geom,
+        envelope = tuple(envelope),
+        is_empty = precinct_is_empty,
+        is_point = precinct_is_point,
+        area = 0 if (precinct_is_empty or precinct_is_point) else precinct_geom.Area(),
+        simulations = load_simulation_arrays(properties) if (simulations is None) else simulations,
+        )
 
-def score_precinct(partial_district_geom, precinct_feat, tile_geom):
-    ''' Return weighted single-district totals for a precinct feature within a tile.
+def get_precinct_fraction(partial_district_geom, precinct, tile_geom, tile_is_covered=None, district_envelope=None):
+    ''' Return fraction of a prepared precinct found within a district piece.
         
         partial_district_geom is the intersection of district and tile geometries.
+        tile_is_covered is whether the tile falls entirely within the district,
+        and will be checked here if not already known by the caller. Likewise
+        district_envelope is the envelope of partial_district_geom, if known.
     '''
-    # Initialize totals to zero
-    totals = {name: 0 for name in score.FIELD_NAMES if name in precinct_feat['properties']}
-    precinct_geom = osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+    precinct_geom = precinct['ogr_geometry']
     
-    if precinct_geom is None or precinct_geom.IsEmpty():
+    if precinct['is_empty']:
         # If there's no precinct geometry here, don't bother.
-        return totals
+        return 0
     elif partial_district_geom is None or partial_district_geom.IsEmpty():
         # If there's no district geometry here, don't bother.
-        return totals
-    elif precinct_geom.GetGeometryType() in (osgeo.ogr.wkbPoint,
-        osgeo.ogr.wkbPoint25D, osgeo.ogr.wkbMultiPoint, osgeo.ogr.wkbMultiPoint25D):
+        return 0
+    elif precinct['is_point']:
         # Points have no area
-        precinct_is_point = True
         precinct_frac = 1
     else:
-        precinct_is_point = False
-        precinct_frac = precinct_feat['properties'][prepare_state.FRACTION_FIELD]
+        precinct_frac = precinct['properties'][prepare_state.FRACTION_FIELD]
 
     if precinct_frac == 0:
         # If there's no overlap here, don't bother.
-        return totals
+        return 0
 
-    if tile_geom.Within(partial_district_geom):
+    if tile_is_covered is None:
+        tile_is_covered = tile_geom.Within(partial_district_geom)
+
+    if tile_is_covered:
         # Don't laboriously calculate precinct fraction if we know it's all there.
         # This is safe because precincts are clipped on tile boundaries, so a
         # fully-contained tile necessarily means the precinct is also contained.
-        precinct_fraction = precinct_frac
-    elif precinct_is_point:
+        return precinct_frac
+    elif precinct['is_point']:
         # Do simple inside/outside check for points
-        precinct_fraction = precinct_frac if precinct_geom.Within(partial_district_geom) else 0
-    else:
-        try:
+        return precinct_frac if precinct_geom.Within(partial_district_geom) else 0
+    elif precinct['area'] == 0:
+        # If we're about to divide by zero, don't bother.
+        return 0
+    elif contains_precinct(partial_district_geom, precinct_geom,
+        district_envelope, precinct.get('envelope')):
+        # Skip the costly overlay for precincts wholly inside the district,
+        # so only precincts crossing the district boundary pay for it.
+        return precinct_frac
+
+    precinct_area = precinct['area']
+
+    try:
+        overlap_geom = precinct_geom.Intersection(partial_district_geom)
+    except RuntimeError as e:
+        if 'TopologyException' in str(e) and not precinct_geom.IsValid():
+            # Sometimes, a precinct geometry can be invalid
+            # so inflate it by a tiny amount to smooth out problems
+            precinct_geom = precinct_geom.Buffer(0.0000001)
+            precinct_area = precinct_geom.Area()
             overlap_geom = precinct_geom.Intersection(partial_district_geom)
-        except RuntimeError as e:
-            if 'TopologyException' in str(e) and not precinct_geom.IsValid():
-                # Sometimes, a precinct geometry can be invalid
-                # so inflate it by a tiny amount to smooth out problems
-                precinct_geom = precinct_geom.Buffer(0.0000001)
-                overlap_geom = precinct_geom.Intersection(partial_district_geom)
-            else:
-                raise
-        if precinct_geom.Area() == 0:
-            # If we're about to divide by zero, don't bother.
-            return totals
+        else:
+            raise
 
-        overlap_area = overlap_geom.Area() / precinct_geom.Area()
-        precinct_fraction = overlap_area * precinct_frac
-    
-    for name in list(totals.keys()):
-        precinct_value = precinct_fraction * (precinct_feat['properties'][name] or 0)
+    overlap_area = overlap_geom.Area() / precinct_area
+    return overlap_area * precinct_frac
+
+def score_precinct(partial_district_geom, precinct, tile_geom, tile_is_covered=None):
+    ''' Return weighted single-district totals for a prepared precinct within a tile.
         
-        if name == 'Household Income 2016' and 'Households 2016' in precinct_feat['properties']:
-            # Household income can't be summed up like populations,
-            # and needs to be weighted by number of households.
-            precinct_value *= (precinct_feat['properties']['Households 2016'] or 0)
-            totals['Sum Household Income 2016'] = \
-                round(totals.get('Sum Household Income 2016', 0)
-                    + precinct_value, constants.ROUND_COUNT)
+        Precincts come from prepare_precinct(), other arguments are passed
+        along to get_precinct_fraction().
+    '''
+    columns, values = get_precinct_attributes([precinct])
+    precinct_fraction = get_precinct_fraction(partial_district_geom,
+        precinct, tile_geom, tile_is_covered)
+    
+    return unpack_attributes(columns, precinct_fraction * values[0])
 
-            continue
+def list_array(value):
+    ''' Convert numpy arrays to lists for JSON output.
+    '''
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    
+    raise TypeError(f'{value!r} is not JSON serializable')
 
-        totals[name] = round(precinct_value, constants.ROUND_COUNT)
+def round_tile_totals(tile_totals):
+    ''' Return district totals rounded for tile output, keyed by geometry key.
     
-    return totals
+        Totals are summed at full precision within each stage and rounded in
+        three places: here for tile outputs, here again for partial sums in
+        planscore.observe.reduce_tile_group(), and to constants.ROUND_COUNT
+        by planscore.observe.round_totals() when published. The first two
+        keep constants.ROUND_TILE places, which keeps output JSON compact
+        without changing published counts.
+    '''
+    return {geometry_key: {name: numpy.round(value, constants.ROUND_TILE)
+        if (name in score.SIMULATION_FIELDS) else round(value, constants.ROUND_TILE)
+        for (name, value) in totals.items()} for (geometry_key, totals) in tile_totals.items()}
 
-def lambda_handler(event, context):
+def score_tile(storage, upload, tile_key, load_geometries):
+    ''' Return dictionary of district totals for one tile, keyed by geometry key.
+    
+        District pieces already clipped to the tile are scored if available.
+        Otherwise, for older uploads, load_geometries() is called with the tile
+        geometry for upload district geometries near the tile, which are each
+        clipped to the tile here.
     '''
+    tile_zxy = get_tile_zxy(upload.model.key_prefix, tile_key)
+    tile_geom = tile_geometry(tile_zxy)
+
+    precincts = load_prepared_precincts(storage, tile_key)
+    envelopes = get_precinct_envelopes(precincts)
+    attributes = get_precinct_attributes(precincts)
+    geometries = load_tile_district_pieces(storage, upload, tile_zxy)
+    clipped = geometries is not None
+    
+    if not clipped:
+        geometries = load_geometries(tile_geom)
+    
+    geometry_keys = list(geometries.keys())
+    district_totals = score_districts([geometries[key] for key in geometry_keys],
+        precincts, tile_geom, envelopes, attributes, clipped)
+    
+    return dict(zip(geometry_keys, district_totals))
+
+def add_batch_totals(batch_totals, tile_totals):
+    ''' Update batch totals in place with district totals from one tile.
+    '''
+    for (geometry_key, input_values) in tile_totals.items():
+        totals = batch_totals.setdefault(geometry_key, {})
+        for (key, value) in input_values.items():
+            if key in score.SIMULATION_FIELDS:
+                totals[key] = numpy.add(totals.get(key, 0), value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+def tile_output_exists(storage, output_key):
+    ''' Return true if a tile Lambda output has already been written.
+    '''
+    try:
+        storage.s3.head_object(Bucket=storage.bucket, Key=output_key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+    
+    return True
+
+def is_upload_stopped(storage, upload):
+    ''' Return true if an upload was finished or given up on, see planscore.observe.
+    '''
+    # Imported here because planscore.observe imports this module
+    from . import observe
+    return observe.is_upload_stopped(observe.load_upload_index(storage, upload))
+
+def record_batch_completion(storage, upload, tile_zxy, group):
+    ''' Record a written batch output, see planscore.observe.record_tile_completion().
+    '''
+    # Imported here because planscore.observe imports this module
+    from . import observe
+    observe.record_tile_completion(storage, upload, tile_zxy, group)
+
+def lambda_handler(event, context):
+    ''' Score a batch of tiles and write their summed totals to one output file.
+    
+        Tiles are scored over a small pool of threads that share one S3
+        client. Each tile reads its own district pieces, and older uploads
+        without pieces share one download of upload geometries. Older
+        single-tile events with a tile_key instead of tile_keys are still
+        accepted.
+        
+        Batches may be dispatched more than once for stragglers, and the
+        first output written wins. Later duplicates only record completion,
+        and batches of an upload already finished or given up on are skipped.
+        A batch with any failed tile is left without output or completion, so
+        the watcher dispatches it again or gives up on the whole upload.
     '''
     s3 = boto3.client('s3', endpoint_url=constants.S3_ENDPOINT_URL)
     storage = data.Storage.from_event(event['storage'], s3)
     upload = data.Upload.from_dict(event['upload'])
+    tile_keys = event.get('tile_keys') or [event['tile_key']]
+    
+    # Output is named for the first tile, see planscore.observe.get_group_tile()
+    tile_zxy = get_tile_zxy(upload.model.key_prefix, tile_keys[0])
+    output_key = data.UPLOAD_TILES_KEY.format(id=upload.id, zxy=tile_zxy)
+    
+    if 'group' in event and is_upload_stopped(storage, upload):
+        print('lambda_handler: upload', upload.id, 'already finished or given up on')
+        return
+    
+    if 'group' in event and tile_output_exists(storage, output_key):
+        print('lambda_handler: already have', output_key)
+        return record_batch_completion(storage, upload, tile_zxy, event['group'])
+    
+    loaded, loaded_lock = {}, threading.Lock()
+    
+    def load_geometries(tile_geom):
+        # Older uploads without pieces: fetch district geometries once,
+        # and parse only those near each tile
+        with loaded_lock:
+            if 'body' not in loaded:
+                loaded['body'] = fetch_upload_geometries_bundle(storage, upload)
+                if loaded['body'] is None:
+                    loaded['geometries'] = load_upload_wkt_geometries(storage, upload)
+        
+        if loaded['body'] is None:
+            return loaded['geometries']
+        
+        return read_upload_geometries(upload, loaded['body'], tile_geom)
+    
+    def score_batch_tile(tile_key):
+        start_time = time.time()
+        try:
+            tile_totals = score_tile(storage, upload, tile_key, load_geometries)
+        except Exception as err:
+            return tile_key, str(err), None
+        else:
+            return tile_key, tile_totals, time.time() - start_time
+    
+    batch_totals, errors, timings = {}, {}, {}
+    
+    with concurrent.futures.ThreadPoolExecutor(constants.TILE_BATCH_THREADS) as executor:
+        for (tile_key, tile_totals, seconds) in executor.map(score_batch_tile, tile_keys):
+            if type(tile_totals) is str:
+                print('lambda_handler: error in', tile_key, tile_totals)
+                errors[tile_key] = tile_totals
+            else:
+                add_batch_totals(batch_totals, tile_totals)
+                
+                # Measured runtimes feed the cost model, see planscore.observe
+                timings[tile_key] = dict(seconds=seconds, districts=len(tile_totals))
+    
+    if errors and 'group' in event:
+        # Scores missing these tiles would be wrong, see planscore.observe.redispatch_stragglers()
+        print('lambda_handler: not writing', output_key, 'after', len(errors), 'failed tiles')
+        return
+    
+    if errors and len(errors) == len(tile_keys):
+        # Nothing could be scored, report as a failed tile
+        totals = '; '.join(errors.values())
+    else:
+        totals = round_tile_totals(batch_totals)
 
-    try:
-        tile_zxy = get_tile_zxy(upload.model.key_prefix, event['tile_key'])
-        output_key = data.UPLOAD_TILES_KEY.format(id=upload.id, zxy=tile_zxy)
-        tile_geom = tile_geometry(tile_zxy)
-
-        totals = {}
-        precincts = load_tile_precincts(storage, tile_zxy)
-        geometries = load_upload_geometries(storage, upload)
-    
-        for (geometry_key, district_geom) in geometries.items():
-            totals[geometry_key] = score_district(district_geom, precincts, tile_geom)
-    except Exception as err:
-        totals = str(err)
-
-    s3.put_object(Bucket=storage.bucket, Key=output_key,
-        Body=json.dumps(dict(event, totals=totals)).encode('utf8'),
-        ContentType='text/plain', ACL='public-read')
+    if 'group' in event and tile_output_exists(storage, output_key):
+        # Another attempt at this batch finished first
+        print('lambda_handler: already have', output_key)
+    else:
+        s3.put_object(Bucket=storage.bucket, Key=output_key,
+            Body=json.dumps(dict(event, totals=totals, errors=errors, timings=timings),
+                default=list_array).encode('utf8'),
+            ContentType='text/plain', ACL='public-read')
+    
+    if 'group' in event:
+        record_batch_completion(storage, upload, tile_zxy, event['group'])
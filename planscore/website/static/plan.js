@@ -68,6 +68,11 @@ function date_age(date)
     return (new Date()).getTime() / 1000 - date.getTime() / 1000;
 }
 
+function is_plan_provisional(plan)
+{
+    return Boolean(plan['summary'] && plan.summary['Provisional']);
+}
+
 function what_score_description_html(plan)
 {
     if(typeof plan['description'] === 'string')
@@ -596,6 +601,13 @@ function load_plan_score(url, message_section, score_section,
         description.appendChild(document.createElement('br'));
         description.appendChild(
             document.createTextNode(get_explanation(plan)));
+        
+        if(is_plan_provisional(plan))
+        {
+            description.appendChild(document.createElement('br'));
+            description.appendChild(document.createElement('b'));
+            description.lastChild.appendChild(document.createTextNode(plan.message));
+        }
 
         // Build the results table
         var table_array = plan_array(plan),
@@ -736,6 +748,7 @@ if(typeof module !== 'undefined' && module.exports)
     module.exports = {
         format_url: format_url, nice_count: nice_count, nice_string: nice_string,
         nice_percent: nice_percent, nice_gap: nice_gap, date_age: date_age,
+        is_plan_provisional: is_plan_provisional,
         what_score_description_html: what_score_description_html,
         which_score_summary_name: which_score_summary_name,
         which_score_column_names: which_score_column_names,
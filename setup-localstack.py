@@ -14,6 +14,8 @@ host_address = socket.gethostbyname(socket.gethostname())
 BUCKETNAME = 'planscore'
 ENDPOINT_S3 = 'http://{}:4572'.format(host_address)
 ENDPOINT_LAM = 'http://{}:4574'.format(host_address)
+ENDPOINT_SQS = 'http://{}:4576'.format(host_address)
+QUEUENAME = 'planscore-watch'
 AWS_CREDS = dict(aws_access_key_id='nobody', aws_secret_access_key='nothing')
 CODE_PATH = arguments.code_path
 
@@ -70,6 +72,15 @@ basedir6 = pp.join(pp.dirname(__file__), 'data', 'sample-NC5.1')
 upload(prefix6, basedir6, pp.join(basedir6, '*.*'))
 upload(prefix6, basedir6, pp.join(basedir6, '*', '*.*'))
 
+# SQS queue setup
+
+print('--> Set up SQS', ENDPOINT_SQS)
+sqs = boto3.client('sqs', endpoint_url=ENDPOINT_SQS, region_name='us-east-1', **AWS_CREDS)
+
+print('    Create queue', QUEUENAME)
+queue_url = sqs.create_queue(QueueName=QUEUENAME, Attributes=dict(VisibilityTimeout='300'))['QueueUrl']
+queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+
 # Lambda function setup
 
 print('--> Set up Lambda', ENDPOINT_LAM)
@@ -80,9 +91,12 @@ env = {
     'WEBSITE_BASE': 'http://127.0.0.1:5000/',
     'S3_ENDPOINT_URL': ENDPOINT_S3,
     'LAMBDA_ENDPOINT_URL': ENDPOINT_LAM,
+    'SQS_ENDPOINT_URL': ENDPOINT_SQS,
+    'WATCH_QUEUE_URL': queue_url,
     }
 
 print('    Environment:', ' '.join(['='.join(kv) for kv in env.items()]))
 
 for function_name in deploy.functions.keys():
     deploy.publish_function(lam, function_name, CODE_PATH, env, 'nobody')
+    deploy.map_watch_queue(lam, function_name, queue_arn)
@@ -25,6 +25,7 @@ setup(
         'Jinja2 == 2.9.6',
         'Frozen-Flask == 0.14',
         'Markdown == 2.6.8',
+        'numpy == 1.14.2',
         ],
     extras_require = {
         'GDAL': ['GDAL == 2.1.3'],
@@ -33,6 +34,7 @@ setup(
         console_scripts = [
             'planscore-prepare-state = planscore.prepare_state:main',
             'planscore-empty-queue = planscore.empty_queue:main',
+            'planscore-score-ensemble = planscore.ensemble:main',
             ]
         ),
 )
@@ -41,6 +41,12 @@ assert.deepEqual(plan.which_score_column_names(NC_incomplete_index),
 var plan_array2 = plan.plan_array(NC_incomplete_index);
 assert.equal(plan_array2, undefined, 'Should have an undefined table');
 
+assert.strictEqual(plan.is_plan_provisional(NC_incomplete_index),
+    false, 'Should not be provisional');
+
+assert.strictEqual(plan.is_plan_provisional({summary: {'Provisional': true}}),
+    true, 'Should be provisional');
+
 // North Carolina plan with named house and parties
 
 assert.equal(plan.what_score_description_html(NC_index),